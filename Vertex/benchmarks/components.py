@@ -0,0 +1,281 @@
+"""
+Self-checks and micro-benchmarks of the gateway building blocks: TopicRouter, SwapBuffer, CommandOutbox,
+Tracer, InstanceAllocator and the Gateway lookups
+
+Usage (from Vertex/benchmarks): python components.py [--only router|swap_buffer|outbox|tracer|allocator|gateway]
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import timeit
+import tracemalloc
+
+import fake_bntest
+
+fake_bntest.install()
+
+from helper.TopicRouter import TopicRouter
+from helper.SwapBuffer import SwapBuffer
+from helper.CommandOutbox import CommandOutbox, GROUP, DEVICE
+from helper.Tracer import Tracer, LIGHT, TO_BACNET, WRITE
+from vertex.InstanceAllocator import InstanceAllocator
+from vertex.Gateway import Gateway
+from vertex.Vertex import Vertex
+from vertex.Device import Device
+from vertex.Group import Group
+
+
+def router():
+    """
+    Throughput, messages/sec through the router with the gateway topic families
+    """
+    received = []
+
+    def handler(*args):
+        received.append(args[-1])
+
+    topic_router = TopicRouter()
+    for topic_filter in ("discovery/edges", "discovery/devices", "discovery/groups",
+                         "vertex3/light/+/state", "vertex3/light/+/+/state",
+                         "vertex3/group/+/feedback/state",
+                         "vertex3/sensor/+/+/+/state", "vertex3/button/+/+/+/state"):
+        topic_router.register(topic_filter, handler)
+
+    messages = [
+        ("vertex3/light/B827EB0C25C4/0055CBB07C626804E8/state", b'{"brightness": 50}'),
+        ("vertex3/group/7b8d807b552e0ea1507f15dc986659d1/feedback/state", b'{"value_type": "direct", "value": 20}'),
+        ("vertex3/sensor/B827EB0C25C4/0055CBB07C626804E8/motion/state", b'{"motion": 1}'),
+        ("vertex3/button/B827EB0C25C4/0055CBB07C626804E8/3/state", b'{"state": 1}'),
+    ]
+    unrouted = [
+        ("vertex3/light/B827EB0C25C4/0055CBB07C626804E8/brightness/set", b'{"brightness": 50}'),
+        ("vertex3/other/B827EB0C25C4/state", b'{"value": 1}'),
+    ]
+
+    number = 200000
+    for name, batch in (("routed", messages), ("unrouted", unrouted)):
+        start = time.perf_counter()
+        for i in range(number):
+            topic, payload = batch[i % len(batch)]
+            topic_router.dispatch(topic, payload)
+        elapsed = time.perf_counter() - start
+        print(f"router {name}: {number / elapsed:,.0f} messages/sec")
+
+
+def swap_buffer():
+    """
+    Stress test, several producers against one consumer, no update may be lost
+    """
+    producers = 8
+    keys = 500
+    rounds = 200
+    buffer = SwapBuffer(capacity=producers * keys)
+    received = dict()
+    finished = threading.Event()
+
+    def produce(number):
+        for value in range(rounds):
+            for key in range(keys):
+                buffer.put((number, key), value)
+
+    def consume():
+        while True:
+            done = finished.is_set()
+            for key, value in buffer.take().items():
+                # Values of a key only grow, an older value must never replace a newer one
+                assert received.get(key, -1) <= value, key
+                received[key] = value
+            if done:
+                return
+            time.sleep(0.001)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=produce, args=(number,)) for number in range(producers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    finished.set()
+    consumer.join()
+    elapsed = time.perf_counter() - start
+
+    assert len(received) == producers * keys, len(received)
+    assert all(value == rounds - 1 for value in received.values())
+    assert buffer.dropped == 0
+    print(f"swap buffer: {producers * keys * rounds / elapsed:,.0f} puts/sec, no update lost, {buffer.stats()}")
+
+    # Overflow accounting
+    small = SwapBuffer(capacity=10)
+    for key in range(15):
+        small.put(key)
+    small.put(0)
+    assert small.stats() == {"pending": 10, "coalesced": 1, "dropped": 5}, small.stats()
+    print("swap buffer: overflow accounting OK")
+
+
+def outbox():
+    """
+    Soak test, the outbox must stay flat and publish each distinct command once
+    """
+    commands = CommandOutbox(capacity=1000)
+    published = dict()
+    tracemalloc.start()
+    sizes = []
+    start = time.perf_counter()
+    for cycle in range(2000):
+        for point in range(200):
+            commands.put(DEVICE, ("B827EB0C25C4", f"dev{point}"), cycle)
+            commands.put(GROUP, f"vertex3/group/g{point % 20}/brightness/set", {"value": cycle})
+        for kind, target, value in commands.drain():
+            if kind == GROUP:
+                value = value["value"]
+            assert published.get((kind, target), -1) < value, (kind, target)
+            published[(kind, target)] = value
+        if cycle % 200 == 0:
+            sizes.append(tracemalloc.get_traced_memory()[0])
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+
+    assert len(published) == 220, len(published)
+    assert commands.dropped == 0
+    assert max(sizes[1:]) - min(sizes[1:]) < 64 * 1024, sizes
+    print(f"outbox: {2000 * 400 / elapsed:,.0f} puts/sec, memory {sizes[1]:,} -> {sizes[-1]:,} bytes, "
+          f"{commands.stats()}")
+
+    # Bound and restore
+    small = CommandOutbox(capacity=2)
+    small.put(GROUP, "a", 1)
+    small.put(GROUP, "b", 1)
+    assert not small.put(GROUP, "c", 1)
+    small.put(GROUP, "a", 2)
+    taken = small.drain()
+    small.put(GROUP, "a", 3)
+    for kind, target, value in taken:
+        small.restore(kind, target, value)
+    assert small.drain() == [(GROUP, "b", 1), (GROUP, "a", 3)], small.stats()
+    print("outbox: bound and restore OK")
+
+
+def tracer():
+    """
+    Overhead per message of the tracing calls, disabled and enabled
+    """
+    number = 200000
+    for enabled in (False, True):
+        trace = Tracer(enabled)
+        start = time.perf_counter()
+        for i in range(number):
+            if trace.enabled:
+                now = time.monotonic()
+                trace.message(LIGHT, now, now, now, now)
+            if i % 100 == 0:
+                trace.begin()
+                with trace.stage(TO_BACNET, WRITE):
+                    pass
+                trace.end()
+        elapsed = time.perf_counter() - start
+        print(f"tracer enabled={enabled}: {elapsed / number * 1e9:,.0f} ns/message")
+    print(json.dumps(trace.snapshot()["kinds"][LIGHT], indent=1))
+
+
+def allocator():
+    """
+    Property check against a plain model: allocations are unique, aligned to the stride, always the lowest free
+    instance, held instances are given out only once no other is free (oldest first), released ones are reused
+    """
+    for seed in range(200):
+        rng = random.Random(seed)
+        size, stride = rng.choice(((10, 1), (1000, 1), (1000, 10), (100, 10)))
+        instances = InstanceAllocator(size, stride)
+        model = set()
+        held = dict()
+        slots = set(range(0, size, stride))
+        for _ in range(2000):
+            operation = rng.random()
+            if operation < 0.5:
+                instance = instances.allocate()
+                free = slots - model - held.keys()
+                expected = min(free) if free else next(iter(held), None)
+                assert instance == expected, (seed, instance, expected)
+                if instance is not None:
+                    assert instance not in model and instance % stride == 0
+                    held.pop(instance, None)
+                    model.add(instance)
+            elif operation < 0.65:
+                instance = rng.randrange(0, size, stride)
+                assert instances.reserve(instance) == (instance not in model), (seed, instance)
+                held.pop(instance, None)
+                model.add(instance)
+            else:
+                instance = rng.randrange(0, size, stride)
+                hold = rng.random() < 0.5
+                if hold and instance in model:
+                    held[instance] = None
+                instances.release(instance, hold=hold)
+                model.discard(instance)
+            assert len(instances) == len(slots - model), seed
+            assert instances.used == model, seed
+            assert list(instances.held) == list(held), seed
+    print("allocator: allocations unique, lowest free first, held last - OK!")
+
+    start = time.perf_counter()
+    for _ in range(100):
+        instances = InstanceAllocator(1000)
+        for _ in range(999):
+            instances.allocate()
+    elapsed = time.perf_counter() - start
+    print(f"allocator: 999 allocations {elapsed / 100 * 1000:.2f} ms")
+
+
+def gateway():
+    """
+    Lookup micro-benchmark at the 10 Vertex x 999 points target
+    """
+    bench = Gateway("", [], max_vertex=10, max_points=1000)
+    for i in range(10):
+        ver = Vertex(f"B827EB0C2{i:03}", i, "vertex3")
+        bench.addVertex(ver)
+        for j in range(999):
+            bench.addDevice(ver, Device(f"GF27EB0C{i:02}{j:03}", j, dev_type=0))
+            bench.addGroup(ver, Group(f"GF29EB0D{i:02}{j:03}", j, dev_type=1))
+
+    number = 100000
+    lookups = {
+        "getVertex": lambda: bench.getVertex("B827EB0C2009"),
+        "getDevice": lambda: bench.getDevice("B827EB0C2009", "GF27EB0C09998"),
+        "getGroup": lambda: bench.getGroup("GF29EB0D09998"),
+        "getVertexFromGroup": lambda: bench.getVertexFromGroup("GF29EB0D09998"),
+        "getIdFromInstance": lambda: bench.getIdFromInstance("av3009998"),
+        "getReference": lambda: bench.getReference("B827EB0C2009", "GF27EB0C09998"),
+    }
+    for name, lookup in lookups.items():
+        elapsed = timeit.timeit(lookup, number=number)
+        print(f"gateway {name}: {elapsed / number * 1e9:.0f} ns")
+
+
+CHECKS = {
+    "router": router,
+    "swap_buffer": swap_buffer,
+    "outbox": outbox,
+    "tracer": tracer,
+    "allocator": allocator,
+    "gateway": gateway,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway component checks")
+    parser.add_argument("--only", choices=sorted(CHECKS), help="Run a single check")
+    options = parser.parse_args()
+
+    for name, check in CHECKS.items():
+        if options.only is None or options.only == name:
+            check()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+"""
+In-process stand-in for the Delta bntest module, used by the benchmarks
+
+Property values are kept in memory, every call the gateway makes to bntest is counted
+so the benchmarks can report parses and bnserver requests next to the timings.
+"""
+import datetime
+import sys
+import time
+from collections import Counter
+from os.path import dirname, abspath, join
+
+LANGUAGE_ID_ENGLISH = 0
+OBJECT_READ = 1
+OBJECT_WRITE = 2
+OBJECT_CREATE = 3
+PRIORITY_DEFAULT = 16
+WILD_ARRAY_INDEX = 0xFFFFFFFF
+WILD_OBJECT_INSTANCE = 0x3FFFFF
+ALARM_ADD = 1
+REINITDEV_COLDSTART = 0
+
+SITE = "BenchSite"
+DEVICE = 1000
+
+# Calls made to the module, ex: calls["parsereference"], calls["executeobjectrequest"]
+calls = Counter()
+# Values of the site, {"1000.av3000055.present_value": "0"}
+values = dict()
+# Simulated bnserver round trip of executeobjectrequest, in seconds
+rpc_delay = 0
+# Trend logs generated on request, {"1000.tl1.log_buffer": (first datetime, seconds between records, records)}
+trend_logs = dict()
+# Called with (key, value) for every written property, ex: to timestamp the end of a pipeline
+on_write = None
+
+
+def install():
+    """
+    Make the gateway sources import this module as bntest
+    """
+    root = dirname(dirname(dirname(abspath(__file__))))
+    source = join(root, 'Vertex', 'source')
+    packages = join(root, 'Vertex', 'packages')
+    # MqttParseHelper imports the vertex package from the repository root
+    for path in (root, source):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    # Last, like Main.py does: the bundled packages are built for the controller, installed ones come first
+    if packages not in sys.path:
+        sys.path.append(packages)
+    sys.modules['bntest'] = sys.modules[__name__]
+
+
+def reset():
+    global rpc_delay, on_write
+    calls.clear()
+    values.clear()
+    trend_logs.clear()
+    rpc_delay = 0
+    on_write = None
+
+
+class ctext(str):
+    pass
+
+
+class ctimedate:
+
+    def __init__(self, fields=None):
+        self.fields = dict() if fields is None else dict(fields)
+
+    def build(self, fields):
+        self.fields = dict(fields)
+
+    def split(self):
+        return self.fields
+
+    def datetime(self):
+        return datetime.datetime(self.fields["Year"], self.fields["Month"], self.fields["Day"],
+                                 self.fields["Hour"], self.fields["Minute"], self.fields["Seconds"])
+
+
+class creference:
+
+    def __init__(self, reference=None):
+        self.reference = ""
+        self.depth = 0
+        self.index = 0
+        # Log_Buffer item property selected with setpropertybyname
+        self.property = None
+        if reference is not None:
+            self.reference = reference
+
+    def parsereference(self, reference, language=LANGUAGE_ID_ENGLISH, user_key=None):
+        calls["parsereference"] += 1
+        # Lookup of the object and property names, which is what makes a real parse expensive
+        site, _, rest = reference.rpartition('/')
+        dev, obj, prop = rest.split('.', 2)
+        if not dev.isdigit() or not obj[:2].isalpha():
+            raise RuntimeError("QERR_CLASS_OBJECT::QERR_CODE_UNKNOWN_OBJECT")
+        self.reference = reference
+        self.depth = prop.count('.')
+        self.index = 0
+        if prop.endswith(']'):
+            self.index = int(prop[prop.rfind('[') + 1:-1])
+
+    def setpropertybyname(self, name, language=LANGUAGE_ID_ENGLISH, depth=1):
+        self.property = name
+
+    def setpropertybyid(self, property_id, depth=1):
+        pass
+
+    def getpropertyname(self, language=LANGUAGE_ID_ENGLISH, depth=1):
+        return "real-value"
+
+    def splitreference(self, reference):
+        return {"Site": SITE}
+
+    def getdepth(self):
+        return self.depth
+
+    def setdepth(self, depth):
+        self.depth = depth
+
+    def changesubpropertydepth(self, depth):
+        self.depth += depth
+
+    def getarrayindex(self):
+        return self.index
+
+    def setarrayindex(self, index):
+        self.index = index
+
+    def islistproperty(self):
+        return False
+
+    def isarrayorlistproperty(self):
+        return self.index != 0
+
+    def isarrayproperty(self):
+        return self.index != 0
+
+    def isfixedarray(self):
+        return False
+
+    def iswholeobjectproperty(self):
+        return False
+
+    def isgroupproperty(self):
+        return False
+
+    def isunionproperty(self):
+        return False
+
+    def __str__(self):
+        return self.reference
+
+
+class cpropertylist:
+
+    def __init__(self):
+        self.items = []
+        self.positions = dict()
+        self.position = 0
+        self.status = 'OK'
+        # Records of a range read, [(datetime, value)], and the one being read
+        self.range = None
+        self.records = []
+        self.record = -1
+
+    def __key(self, reference):
+        key = str(reference)
+        return key[key.rfind('/') + 1:].lower()
+
+    def addreference(self, reference):
+        calls["addreference"] += 1
+        key = self.__key(reference)
+        self.positions[key] = len(self.items)
+        self.position = len(self.items)
+        self.items.append([key, None, 'OK'])
+
+    def finditem(self, reference):
+        position = self.positions.get(self.__key(reference))
+        if position is None:
+            raise RuntimeError("Item not found")
+        self.position = position
+
+    def modifyitem(self, reference, data, language=LANGUAGE_ID_ENGLISH):
+        self.finditem(reference)
+        self.items[self.position][1] = data
+
+    def setitempriority(self, priority):
+        pass
+
+    def addrangebytime(self, reference, start, count):
+        self.addreference(reference)
+        self.range = (self.items[-1][0], start.datetime(), count)
+
+    def getarraycount(self, reference=None):
+        return len(self.records)
+
+    def nextarrayitem(self):
+        self.record += 1
+
+    def getvariant(self, reference):
+        return 0
+
+    def __str__(self):
+        return " ".join(item[0] for item in self.items)
+
+    def islistitem(self):
+        return False
+
+    def setarraycount(self, reference, count):
+        pass
+
+    def getpropertyliststatus(self):
+        return self.status
+
+    def rewind(self):
+        self.position = 0
+
+    def getreference(self):
+        return creference(f"//{SITE}/{self.items[self.position][0]}")
+
+    def nextproperty(self):
+        if self.position + 1 < len(self.items):
+            self.position += 1
+            return True
+        return False
+
+    def nextobject(self):
+        return False
+
+    def getitemstatus(self):
+        return self.items[self.position][2]
+
+    def readitem(self, reference, language=LANGUAGE_ID_ENGLISH):
+        if self.range is not None:
+            stamp, value = self.records[self.record]
+            if reference.property == "timestamp":
+                return {"Year": stamp.year, "Month": stamp.month, "Day": stamp.day, "Hour": stamp.hour,
+                        "Minute": stamp.minute, "Seconds": stamp.second}
+            return value
+        return self.items[self.position][1]
+
+
+class cserver:
+
+    def connect(self, monitored=False):
+        pass
+
+    def login(self, user, password):
+        return 1
+
+    def sitegetlist(self, user_key):
+        # Delta.LoadableModules.Logger opens the default site of BACnetInterface
+        return [SITE, "Techniczny"]
+
+    def siteisopen(self, user_key, site):
+        return True
+
+    def siteopen(self, user_key, site):
+        pass
+
+    def setupgetparameter(self, user_key, site, name, default):
+        calls["setupgetparameter"] += 1
+        return DEVICE
+
+    def sitegetdevicenumber(self, user_key, site):
+        calls["sitegetdevicenumber"] += 1
+        return DEVICE
+
+    def executeobjectrequest(self, user_key, request_type, prop_list):
+        calls["executeobjectrequest"] += 1
+        calls["request_properties"] += len(prop_list.items)
+        if request_type == OBJECT_CREATE:
+            calls["created_objects"] += len({item[0].rsplit('.', 1)[0] for item in prop_list.items})
+        if rpc_delay:
+            time.sleep(rpc_delay)
+        if prop_list.range is not None:
+            read_range(prop_list)
+            return
+        for item in prop_list.items:
+            if request_type == OBJECT_READ:
+                if item[0] in values:
+                    item[1], item[2] = values[item[0]], 'OK'
+                else:
+                    item[2] = "QERR_CLASS_OBJECT::QERR_CODE_UNKNOWN_OBJECT"
+            else:
+                values[item[0]] = item[1]
+                if on_write is not None:
+                    on_write(item[0], item[1])
+
+    def setalarmnotifycallback(self, callback):
+        pass
+
+    def registerforalarmnotification(self, user_key, site):
+        pass
+
+    def setcovnotificationcallback(self, callback):
+        pass
+
+    def registerforcovnotification(self, user_key, site):
+        pass
+
+    def subscribecov(self, user_key, reference, lifetime):
+        calls["subscribecov"] += 1
+
+
+def read_range(prop_list):
+    """
+    Records of a generated trend log newer than the start time of the range
+    """
+    key, start, count = prop_list.range
+    if key not in trend_logs:
+        prop_list.items[0][2] = "QERR_CLASS_OBJECT::QERR_CODE_UNKNOWN_OBJECT"
+        return
+    first, interval, total = trend_logs[key]
+    position = 0
+    if start >= first:
+        position = int((start - first).total_seconds() // interval) + 1
+    prop_list.records = [(first + datetime.timedelta(seconds=interval * number), str(number % 1000 / 10))
+                         for number in range(position, min(position + count, total))]
+    calls["records"] += len(prop_list.records)
+
+
+class calarmnotification:
+    """
+    Alarm raised by a command object, as received by the callback of setalarmnotifycallback
+    """
+
+    def __init__(self, reference, alarm_type=ALARM_ADD):
+        self.reference = creference(reference)
+        self.alarm_type = alarm_type
+
+    def gettype(self):
+        return self.alarm_type
+
+    def getalarminfo(self):
+        return self
+
+    def getinputref(self):
+        return self.reference
+
+
+class ccovnotification:
+    """
+    Present_Value change, as received by the callback of setcovnotificationcallback
+    """
+
+    def __init__(self, reference, value):
+        self.reference = creference(reference)
+        self.value = value
+
+    def getreference(self):
+        return self.reference
+
+    def getvalue(self):
+        return self.value
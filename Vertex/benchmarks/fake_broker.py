@@ -0,0 +1,169 @@
+"""
+Local stand-in of the Vertex MQTT broker, used by the benchmarks
+
+Serves a single paho client over TCP with the MQTT 3.1.1 packets the gateway uses.
+Messages from the gateway are timestamped and can be answered by responders, messages to the
+gateway are sent with send().
+"""
+import socket
+import struct
+import threading
+import time
+
+CONNECT = 0x10
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x80
+PINGREQ = 0xC0
+DISCONNECT = 0xE0
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def publish_packet(topic, payload):
+    topic = topic.encode('utf-8')
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    body = struct.pack("!H", len(topic)) + topic + payload
+    return bytes([PUBLISH]) + encode_length(len(body)) + body
+
+
+class FakeBroker(threading.Thread):
+
+    def __init__(self, port=0):
+        """
+        :param port: Port to listen on, ex: the one of a closed broker to stand in for its restart
+        """
+        super().__init__(daemon=True)
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("127.0.0.1", port))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.connection = None
+        self.connected = threading.Event()
+        self.subscribed = threading.Event()
+        self.send_lock = threading.Lock()
+        # {topic: function(payload) returning a list of (topic, payload) sent back to the gateway}
+        self.responders = dict()
+        # Called with (topic, payload, monotonic time) for every message published by the gateway
+        self.on_publish = None
+        self.received = 0
+        self.sent = 0
+
+    def send(self, topic, payload):
+        """
+        Publish a message to the gateway, returns the monotonic time it was handed to the socket
+        """
+        packet = publish_packet(topic, payload)
+        with self.send_lock:
+            sent_at = time.monotonic()
+            self.connection.sendall(packet)
+            self.sent += 1
+        return sent_at
+
+    def send_many(self, messages):
+        """
+        Publish a list of (topic, payload) in one socket write
+        """
+        data = b''.join(publish_packet(topic, payload) for topic, payload in messages)
+        with self.send_lock:
+            sent_at = time.monotonic()
+            self.connection.sendall(data)
+            self.sent += len(messages)
+        return sent_at
+
+    def close(self):
+        try:
+            # Shutdown first, a close alone does not end the recv of the broker thread
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.connection.close()
+        except Exception:
+            pass
+        self.server.close()
+
+    def __read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def run(self):
+        self.connection, _ = self.server.accept()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                header = self.__read(1)[0]
+                length, multiplier = 0, 1
+                while True:
+                    byte = self.__read(1)[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = self.__read(length)
+                self.__handle(header, body)
+        except (ConnectionError, OSError):
+            return
+
+    def __handle(self, header, body):
+        command = header & 0xF0
+        if command == CONNECT:
+            with self.send_lock:
+                self.connection.sendall(b'\x20\x02\x00\x00')
+            self.connected.set()
+
+        elif command == SUBSCRIBE:
+            # Grant QoS 0 to every filter of the request
+            mid = body[:2]
+            filters = 0
+            position = 2
+            while position < len(body):
+                size = struct.unpack("!H", body[position:position + 2])[0]
+                position += 2 + size + 1
+                filters += 1
+            packet = mid + b'\x00' * filters
+            with self.send_lock:
+                self.connection.sendall(bytes([0x90]) + encode_length(len(packet)) + packet)
+            self.subscribed.set()
+
+        elif command == PUBLISH:
+            received_at = time.monotonic()
+            qos = (header >> 1) & 0x03
+            size = struct.unpack("!H", body[:2])[0]
+            topic = body[2:2 + size].decode('utf-8')
+            position = 2 + size
+            if qos:
+                with self.send_lock:
+                    self.connection.sendall(bytes([PUBACK, 2]) + body[position:position + 2])
+                position += 2
+            payload = body[position:]
+            self.received += 1
+
+            if self.on_publish is not None:
+                self.on_publish(topic, payload, received_at)
+            responder = self.responders.get(topic)
+            if responder is not None:
+                responses = responder(payload)
+                if responses:
+                    self.send_many(responses)
+
+        elif command == PINGREQ:
+            with self.send_lock:
+                self.connection.sendall(b'\xd0\x00')
+
+        elif command == DISCONNECT:
+            raise ConnectionError
@@ -0,0 +1,131 @@
+"""
+Gateway assembled like Main.__init__ does, on top of the bntest and broker stand-ins
+
+Only what needs a controller or a settings CSV object is replaced: the configuration is a plain
+object with the non developer defaults of ConfigFileHelper and the BACnet site is fake_bntest.
+Messages go through real paho clients, the TopicRouter and the Main handlers, the main loop
+runs Main.process in a thread. With several brokers the gateway runs in multi-broker mode.
+"""
+import queue
+import tempfile
+import threading
+from os.path import join
+
+import fake_bntest
+
+fake_bntest.install()
+
+import schedule
+import Main as gateway_main
+from vertex.Gateway import Gateway
+from vertex.StateStore import StateStore
+from PDS.BACnet import Interface
+from PDS.Log import Logger, LEVEL_NONE
+
+FIL_INSTANCE = 100
+
+
+class BenchConfig:
+    """
+    Settings of ConfigFileHelper outside of developer mode
+    """
+
+    def __init__(self, **overrides):
+        self.configuration_license = ""
+        self.configuration_use_tags = False
+        self.configuration_use_auto_create = True
+        self.configuration_rename_with_port_and_short_address = True
+        self.configuration_setting_file_refresh = 20
+        self.configuration_batch_window_ms = 10
+        self.configuration_queue_capacity = 40000
+        self.configuration_use_cov = False
+        self.configuration_cov_lifetime = 300
+        self.configuration_publish_qos = 0
+        self.configuration_max_inflight = 20
+        self.configuration_trace = False
+        self.configuration_trace_interval = 60
+        self.configuration_multi_broker = False
+        self.vertex_ip_vertex = ["127.0.0.1"]
+        self.vertex_uid_vertex = []
+        self.vertex_max_vertex = 10
+        self.vertex_max_bacnet_points = 999
+        self.vertex_timeout = 60
+        for name, value in overrides.items():
+            setattr(self, name, value)
+
+
+class Harness:
+
+    def __init__(self, brokers, **config):
+        if not isinstance(brokers, list):
+            brokers = [brokers]
+        config.setdefault("vertex_ip_vertex", [f"127.0.0.1:{broker.port}" for broker in brokers])
+        config.setdefault("configuration_multi_broker", len(brokers) > 1)
+        fake_bntest.values[f"{fake_bntest.DEVICE}.fil{FIL_INSTANCE}.description"] = ""
+        self.state_directory = tempfile.TemporaryDirectory()
+        self.running = threading.Event()
+        self.loop = None
+        # Functions to run in the main loop thread, like the scheduled jobs of Main
+        self.calls = queue.Queue()
+
+        # Main.__init__ without its controller steps (settings object, identity, saved registry)
+        main = gateway_main.Main.__new__(gateway_main.Main)
+        main.device = None
+        main.setup_runtime()
+        main.ready.set()
+        main.logger = Logger(fil_instance=FIL_INSTANCE, level=LEVEL_NONE)
+        main.bacnet = Interface(user="Delta", password="", site=fake_bntest.SITE)
+        main.bacnet.register_alarm_callback(main.alarm_callback)
+        main.config_file_helper = BenchConfig(**config)
+        main.setup_dispatcher()
+        main.setup_brokers("benchmark")
+        # Scenarios start the discovery themselves, the connection logs read a Windows path
+        main.brokers.connect_callback = None
+        main.brokers.disconnect_callback = None
+        main.gateway = Gateway("", [], main.logger)
+        main.setup_gateway("")
+        main.state_store = StateStore(join(self.state_directory.name, 'gateway'), main.logger)
+        main.setup_helpers()
+        main.init_completed = True
+        self.main = main
+
+        main.connect_to_vertex()
+        for broker in brokers:
+            broker.connected.wait(5)
+
+    def start(self):
+        """
+        Run the gateway main loop in a thread
+        """
+        self.running.set()
+        self.loop = threading.Thread(target=self.__run, daemon=True)
+        self.loop.start()
+
+    def __run(self):
+        while self.running.is_set():
+            self.main.process()
+            while not self.calls.empty():
+                function, done = self.calls.get()
+                try:
+                    function()
+                finally:
+                    done.set()
+
+    def call(self, function):
+        """
+        Run a function in the main loop thread between two passes and wait for it
+        """
+        done = threading.Event()
+        self.calls.put((function, done))
+        self.main.dispatcher.notify()
+        done.wait()
+
+    def stop(self):
+        self.running.clear()
+        self.main.dispatcher.notify()
+        if self.loop is not None:
+            self.loop.join()
+        self.main.brokers.disconnect()
+        # Jobs of Main, the next harness schedules its own
+        schedule.clear()
+        self.state_directory.cleanup()
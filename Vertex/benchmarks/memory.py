@@ -0,0 +1,169 @@
+"""
+Memory of the gateway registry of a 10 Vertex x 999 devices site
+
+Builds the registry with the vertex classes as they were before __slots__ (a per-instance __dict__)
+and with the current ones, and reports the bytes allocated per point for the
+objects alone and for the whole Gateway with its indexes.
+Also checks that a gateway.pickle written with the old classes is still imported by the StateStore.
+
+Usage (from Vertex/benchmarks): python memory.py [--vertex 10] [--devices 999] [--groups 64]
+"""
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import tracemalloc
+import types
+
+import fake_bntest
+
+fake_bntest.install()
+
+from vertex.Gateway import Gateway
+from vertex.StateStore import StateStore
+from vertex.Vertex import Vertex
+from vertex.Device import Device
+from vertex.Group import Group
+from PDS.Log import Logger, LEVEL_NONE
+from suite import vertex_uid, device_uid, group_uid
+
+FIL_INSTANCE = 100
+
+
+class LegacyVertex:
+
+    def __init__(self, _id, bacnet_instance, _type=""):
+        self.id = _id
+        self.bacnet_instance = bacnet_instance
+        self.groups = []
+        self.devices = []
+        self.type = _type
+        self.status = False
+
+    def addDevice(self, device):
+        self.devices.append(device)
+
+    def addGroup(self, group):
+        self.groups.append(group)
+
+
+class LegacyDevice:
+
+    def __init__(self, _id, bacnet_instance, dev_type=None):
+        self.id = _id
+        self.bacnet_instance = bacnet_instance
+        self.bacnet_instance_if_button = None
+        self.status = False
+        self.bacnet_point_exist = False
+        self.dev_type = dev_type
+
+
+class LegacyGroup:
+
+    def __init__(self, _id, bacnet_instance, dev_type=None):
+        self.id = _id
+        self.bacnet_instance = bacnet_instance
+        self.status = False
+        self.bacnet_point_exist = False
+        self.dev_type = dev_type
+
+
+def legacy_modules():
+    """
+    Publish the legacy classes under the module paths of an old install, so pickle records them as vertex classes
+    """
+    for name in ("legacy", "legacy.vertex"):
+        sys.modules[name] = types.ModuleType(name)
+    for name, cls in (("Vertex", LegacyVertex), ("Device", LegacyDevice), ("Group", LegacyGroup)):
+        module = types.ModuleType(f"legacy.vertex.{name}")
+        cls.__module__ = module.__name__
+        cls.__qualname__ = name
+        setattr(module, name, cls)
+        sys.modules[module.__name__] = module
+
+
+def uids(options):
+    return [(vertex_uid(v), [device_uid(v, d) for d in range(options.devices)],
+             [group_uid(v, g) for g in range(options.groups)]) for v in range(options.vertex)]
+
+
+def build(classes, site, logger, gateway=True):
+    vertex_class, device_class, group_class = classes
+    registry = Gateway("", [], logger) if gateway else []
+    for v, (vertex_id, device_ids, group_ids) in enumerate(site):
+        vertex = vertex_class(vertex_id, v)
+        if gateway:
+            registry.addVertex(vertex)
+        else:
+            registry.append(vertex)
+        for d, device_id in enumerate(device_ids):
+            device = device_class(device_id, d, 4)
+            if gateway:
+                registry.addDevice(vertex, device)
+            else:
+                vertex.addDevice(device)
+        for g, group_id in enumerate(group_ids):
+            group = group_class(group_id, g)
+            if gateway:
+                registry.addGroup(vertex, group)
+            else:
+                vertex.addGroup(group)
+    return registry
+
+
+def measure(classes, site, logger, gateway):
+    tracemalloc.start()
+    registry = build(classes, site, logger, gateway)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return registry, allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Registry memory benchmark")
+    parser.add_argument("--vertex", type=int, default=10)
+    parser.add_argument("--devices", type=int, default=999)
+    parser.add_argument("--groups", type=int, default=64)
+    options = parser.parse_args()
+
+    fake_bntest.values[f"{fake_bntest.DEVICE}.fil{FIL_INSTANCE}.description"] = ""
+    logger = Logger(fil_instance=FIL_INSTANCE, level=LEVEL_NONE)
+    legacy_modules()
+    site = uids(options)
+    points = options.vertex * (options.devices + options.groups)
+
+    legacy = (LegacyVertex, LegacyDevice, LegacyGroup)
+    current = (Vertex, Device, Group)
+    for gateway in (False, True):
+        results = []
+        for classes in (legacy, current):
+            registry, allocated = measure(classes, site, logger, gateway)
+            results.append(allocated)
+            del registry
+        label = "whole gateway" if gateway else "objects"
+        print(f"{label}: {results[0] / points:.0f} -> {results[1] / points:.0f} bytes per point "
+              f"({points} points, {100 * (1 - results[1] / results[0]):.0f}% less)")
+
+    # A gateway.pickle of an old install is imported with the BACnet instance and type of every point
+    old_gateway = build(legacy, site, logger)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "gateway")
+        with open(f"{path}.pickle", 'wb') as handle:
+            pickle.dump(old_gateway, handle)
+        gateway = Gateway("", [], logger)
+        assert StateStore(path, logger).load(gateway)
+        assert gateway.quantityDevices() == old_gateway.quantityDevices()
+        assert gateway.quantityGroups() == old_gateway.quantityGroups()
+        device = gateway.getDevice(vertex_uid(0), device_uid(0, 1))
+        assert type(device) is Device and device.bacnet_instance == 1 and device.dev_type == 4
+
+        # And the current classes go through pickle unchanged
+        copied = pickle.loads(pickle.dumps(gateway))
+        device = copied.getDevice(vertex_uid(0), device_uid(0, 1))
+        assert device.bacnet_instance == 1 and device.dev_type == 4 and not device.bacnet_point_exist
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Multi-broker mode against several broker stand-ins, each serving its own Vertex
+
+Checks that every broker is connected at once, that discovery answers of all brokers end up in one gateway,
+that group and light commands are published to the broker serving the target Vertex only and that
+losing one broker does not stop the others.
+
+Usage (from Vertex/benchmarks): python multi_broker.py [--brokers 3]
+"""
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+
+import fake_bntest
+
+fake_bntest.install()
+
+from fake_broker import FakeBroker
+from harness import Harness
+from suite import Site, vertex_uid, group_uid, light_keys
+
+TIMEOUT = 30
+
+
+def subset(payload, uids):
+    return {uid: payload[uid] for uid in payload if uid in uids}
+
+
+def responders(site, owned):
+    """
+    Discovery and light state answers of a broker serving the Vertex numbers in owned
+    """
+    uids = {vertex_uid(v) for v in owned}
+    answers = {
+        "discovery/edges/detect": lambda payload: [("discovery/edges", json.dumps(subset(site.edges(), uids)))],
+        "discovery/devices/detect": lambda payload: [
+            ("discovery/devices", json.dumps(subset(site.discovered_devices(), uids)))],
+        "discovery/groups/detect": lambda payload: [
+            ("discovery/groups", json.dumps(subset(site.discovered_groups(), uids)))],
+    }
+    for v in owned:
+        answers[f"vertex3/light/{vertex_uid(v)}/get_state"] = \
+            lambda payload, v=v: [(f"vertex3/light/{vertex_uid(v)}/state", json.dumps(site.light_state(v, 0)))]
+    return answers
+
+
+def wait_for(condition, message):
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError(message)
+        time.sleep(0.02)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway multi-broker check")
+    parser.add_argument("--brokers", type=int, default=3)
+    parser.add_argument("--vertex", type=int, default=2, help="Vertex per broker")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--groups", type=int, default=4)
+    options = parser.parse_args()
+
+    fake_bntest.reset()
+    site = Site(options.brokers * options.vertex, options.devices, options.groups)
+    # Vertex v is served by broker v // options.vertex
+    owned = [range(number * options.vertex, (number + 1) * options.vertex) for number in range(options.brokers)]
+
+    received = defaultdict(list)
+    lock = threading.Lock()
+    brokers = []
+    for number in range(options.brokers):
+        broker = FakeBroker()
+        broker.responders = responders(site, owned[number])
+
+        def on_publish(topic, payload, at, number=number):
+            if topic.endswith("/brightness/set"):
+                with lock:
+                    received[number].append((topic, json.loads(payload)))
+
+        broker.on_publish = on_publish
+        broker.start()
+        brokers.append(broker)
+
+    harness = Harness(brokers)
+    main = harness.main
+    harness.start()
+    try:
+        pool = main.brokers
+        assert len(pool.connections) == options.brokers, "one client per broker"
+        wait_for(lambda: pool.stats()["connected"] == options.brokers, "brokers not connected")
+        print(f"{options.brokers} brokers connected at once")
+
+        # Sent by Main.on_connect of every connection
+        for connection in pool.connections:
+            main.trigger_discovery(connection)
+        keys = [key for v in range(site.vertex) for key in light_keys(site, v)]
+        wait_for(lambda: all(key in fake_bntest.values for key in keys), "discovery did not complete")
+        for number, connection in enumerate(pool.connections):
+            assert connection.vertex == {vertex_uid(v) for v in owned[number]}, connection.vertex
+        print(f"discovery of {site.vertex} Vertex from {options.brokers} brokers complete")
+
+        # One group and one light command per Vertex, raised by BACnet alarms
+        expected = defaultdict(set)
+        for v in range(site.vertex):
+            number = v // options.vertex
+            for obj, topic in ((f"AV311{v}000", f"vertex3/group/{group_uid(v, 0)}/brightness/set"),
+                               (f"AV301{v}000", f"vertex3/light/{vertex_uid(v)}/brightness/set")):
+                fake_bntest.values[f"{fake_bntest.DEVICE}.{obj.lower()}.present_value"] = str(v + 1)
+                fake_bntest.values[f"{fake_bntest.DEVICE}.{obj.lower()}.description"] = ""
+                main.alarm_callback(fake_bntest.calarmnotification(
+                    f"//{fake_bntest.SITE}/{fake_bntest.DEVICE}.{obj}.Present_Value"))
+                expected[number].add(topic)
+        total = sum(len(topics) for topics in expected.values())
+        wait_for(lambda: sum(len(messages) for messages in received.values()) >= total, "commands not published")
+        for number in range(options.brokers):
+            topics = {topic for topic, payload in received[number]}
+            assert topics == expected[number], (number, topics ^ expected[number])
+        print(f"{total} commands published to the broker serving their Vertex")
+
+        # Lose the first broker, the others keep receiving commands
+        brokers[0].close()
+        lost = pool.connections[0]
+        wait_for(lambda: not lost.is_connected(), "lost broker still connected")
+        wait_for(lambda: lost.attempts > 0, "lost broker is not retried")
+        received.clear()
+        for v in range(site.vertex):
+            obj = f"AV311{v}001"
+            fake_bntest.values[f"{fake_bntest.DEVICE}.{obj.lower()}.present_value"] = "50"
+            fake_bntest.values[f"{fake_bntest.DEVICE}.{obj.lower()}.description"] = ""
+            main.alarm_callback(fake_bntest.calarmnotification(
+                f"//{fake_bntest.SITE}/{fake_bntest.DEVICE}.{obj}.Present_Value"))
+        served = site.vertex - options.vertex
+        wait_for(lambda: sum(len(messages) for messages in received.values()) >= served, "commands not published")
+        # Commands of the lost broker stay queued until it is back
+        wait_for(lambda: len(main.bacnet_helper.outbox) == options.vertex, "commands of the lost broker dropped")
+        assert not received[0]
+        print(f"broker 0 lost: {served} commands published, {options.vertex} kept for its reconnect")
+        print("OK")
+    finally:
+        harness.stop()
+        for broker in brokers:
+            broker.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Throughput of MqttPublisher.publish_batch against the local broker stand-in, by QoS and in-flight window
+
+Usage (from Vertex/benchmarks): python publisher.py [--batches 200] [--topics 200]
+"""
+import argparse
+import time
+
+import fake_bntest
+
+fake_bntest.install()
+
+import paho.mqtt.client as mqtt
+
+from helper.MqttPublisher import MqttPublisher, MAX_INFLIGHT
+from fake_broker import FakeBroker
+
+
+class Logger:
+    def debug(self, message, *args):
+        print(message % args)
+
+
+def run(qos, max_inflight, batches, topics):
+    broker = FakeBroker()
+    broker.start()
+    client = mqtt.Client("benchmark")
+    client.connect("127.0.0.1", broker.port)
+    client.loop_start()
+    publisher = MqttPublisher(client, Logger(), qos=qos, max_inflight=max_inflight)
+
+    start = time.perf_counter()
+    for number in range(batches):
+        publisher.publish_batch({f"vertex3/group/{topic:032x}/brightness/set": {"value": number % 100}
+                                 for topic in range(topics)})
+    while broker.received < batches * topics and time.perf_counter() - start < 60:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    client.disconnect()
+    client.loop_stop()
+    broker.close()
+    return broker.received, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MQTT publisher benchmark")
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--topics", type=int, default=200)
+    options = parser.parse_args()
+
+    for qos, max_inflight in ((0, MAX_INFLIGHT), (1, MAX_INFLIGHT), (1, 100), (1, 0)):
+        received, elapsed = run(qos, max_inflight, options.batches, options.topics)
+        print(f"qos={qos} max_inflight={max_inflight}: {received / elapsed:,.0f} messages/sec "
+              f"({received} of {options.batches * options.topics} received)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+ReadResults lookups: property check against the linear scan lookup and cost per lookup for growing reads
+"""
+import random
+import time
+
+import fake_bntest
+
+fake_bntest.install()
+
+from Delta.Results import ReadResults
+
+
+def linear_getitem(self, key):
+    """ReadResults.__getitem__ before the prefix index, reference for the property check"""
+    # return value if key is found in dictionary
+    for self_key, self_value in self.items():
+        if self_key == key.lower():
+            return self_value
+    else:
+        # create a dictionary of subproperties
+        sub_property_dict = {}
+        is_list_prop = False
+        for key_in_dict, value_in_dict in self.items():
+            if key_in_dict.startswith(key.lower() + '.'):
+                sub_property_dict[key_in_dict[len(key) + 1: ]] = value_in_dict
+
+            elif key_in_dict.startswith(key.lower() + '['):
+                # store subvalues with dict key as index so we can find the order
+                is_list_prop = True
+                left_bracket_idx = key_in_dict.find('[', len(key))
+                right_bracket_idx = key_in_dict.find(']', left_bracket_idx)
+                arrayidx = int(key_in_dict[left_bracket_idx + 1 : right_bracket_idx])
+
+                if len(key_in_dict) - 1 == right_bracket_idx:
+                    # add single data entry to array
+                    sub_property_dict[arrayidx] = value_in_dict
+                else:
+                    sub_prop_start = key_in_dict.find('.', right_bracket_idx) + 1
+                    if arrayidx in sub_property_dict.keys():
+                        sub_property_dict[arrayidx][key_in_dict[sub_prop_start : ]] = value_in_dict
+                    else:
+                        sub_property_dict[arrayidx] = {key_in_dict[sub_prop_start : ] : value_in_dict}
+
+        if is_list_prop:
+            # return array sorted by array index
+            return [sub_property_dict[sorted_key] for sorted_key in sorted(sub_property_dict.keys())]
+        if sub_property_dict:
+            return ReadResults(sub_property_dict)
+        else:
+            raise KeyError(key)
+
+
+def random_results(rng, size):
+    """
+    Read results of simple properties and of properties with subproperties and array indexes
+    """
+    data = {}
+    for number in range(size):
+        obj = f"{fake_bntest.DEVICE}.{rng.choice(['av', 'bv', 'sch'])}{number}"
+        shape = rng.randrange(4)
+        if shape == 0:
+            data[f"{obj}.present_value"] = str(rng.randrange(100))
+            data[f"{obj}.description"] = rng.choice(["", "3", "QERR_CLASS_OBJECT::QERR_CODE_UNKNOWN_OBJECT"])
+        elif shape == 1:
+            for index in range(1, rng.randrange(1, 4) + 1):
+                data[f"{obj}.eventtext[{index}]"] = f"text{index}"
+        elif shape == 2:
+            for index in range(1, rng.randrange(1, 3) + 1):
+                data[f"{obj}.exceptionsext[{index}].schedule[1].time"] = "08:00:00.00"
+                data[f"{obj}.exceptionsext[{index}].eventpriority"] = str(index)
+        else:
+            data[f"{obj}.defaultvalue.real"] = "5"
+            data[f"{obj}.defaultvalue.null"] = ""
+    return data
+
+
+def lookup(getitem, results, key):
+    try:
+        value = getitem(results, key)
+    except KeyError:
+        return KeyError
+    if isinstance(value, dict):
+        return dict(value)
+    return value
+
+
+def check(rounds=200):
+    rng = random.Random(7)
+    for _ in range(rounds):
+        data = random_results(rng, rng.randrange(1, 30))
+        results = ReadResults(data)
+        keys = list(data)
+        queries = []
+        for key in keys:
+            # Every property prefix, in random case, and some misses
+            for position in range(1, len(key) + 1):
+                if position == len(key) or key[position] in '.[':
+                    prefix = key[:position]
+                    queries.append(''.join(c.upper() if rng.random() < 0.3 else c for c in prefix))
+            queries.append(key + ".missing")
+            queries.append(key[:-1])
+        for query in queries:
+            expected = lookup(linear_getitem, results, query)
+            assert lookup(ReadResults.__getitem__, results, query) == expected, query
+        # The prefix index follows changes of the dictionary
+        removed = rng.choice(keys)
+        del results[removed]
+        expected = lookup(linear_getitem, results, removed)
+        assert lookup(ReadResults.__getitem__, results, removed) == expected, removed
+    print(f"Property check OK ({rounds} random read results)")
+
+
+def benchmark():
+    for size in (100, 1000, 5000):
+        data = {}
+        for number in range(size):
+            data[f"{fake_bntest.DEVICE}.av3011{number:03}.present_value"] = "50"
+            data[f"{fake_bntest.DEVICE}.av3011{number:03}.description"] = "3"
+        results = ReadResults(data)
+        keys = [f"{fake_bntest.DEVICE}.AV3011{number:03}.Present_Value" for number in range(size)]
+
+        for name, getitem in (("linear", linear_getitem), ("indexed", ReadResults.__getitem__)):
+            if name == "linear" and size > 1000:
+                print(f"{name:>8} {size:>5} points: skipped")
+                continue
+            start = time.perf_counter()
+            for key in keys:
+                getitem(results, key)
+            elapsed = time.perf_counter() - start
+            print(f"{name:>8} {size:>5} points: {elapsed / size * 1e6:.2f} us/lookup")
+
+
+if __name__ == "__main__":
+    check()
+    benchmark()
@@ -0,0 +1,245 @@
+"""
+Discovery reconciliation of a 10 Vertex x 999 devices site
+
+Times MqttParseHelper.discovery for the first answers, the same answers again (skipped by their digest),
+equal answers encoded differently (diffed, nothing to apply), answers with a 1% churn of devices and
+groups, and Gateway.reconfigureStatus on the whole registry.
+Also checks that the instances held for removed points survive a restart of the gateway (StateStore journal
+and snapshot): a removed device discovered again gets its instance back, new ones get other instances.
+And that a Vertex added by a raised max_vertex gets its devices and groups from unchanged answers, and that
+points saved with the instance of another point are given their own.
+
+Usage (from Vertex/benchmarks): python reconcile.py [--vertex 10] [--devices 999] [--groups 64]
+"""
+import argparse
+import json
+import tempfile
+import time
+from os.path import join
+from types import SimpleNamespace
+
+import fake_bntest
+
+fake_bntest.install()
+
+from harness import BenchConfig
+from helper.BacnetHelper import BacnetHelper
+from helper.MqttParseHelper import MqttParseHelper
+from vertex.Gateway import Gateway, POINT_INSTANCES
+from vertex.StateStore import StateStore, STATE_VERSION
+from PDS.Log import Logger, LEVEL_NONE
+from suite import Site, vertex_uid, device_uid, group_uid
+
+FIL_INSTANCE = 100
+
+
+def encode(payload, reverse=False):
+    if reverse:
+        payload = {key: payload[key] for key in reversed(list(payload))}
+    return json.dumps(payload).encode('utf-8')
+
+
+def timed(name, function, *args):
+    started = time.perf_counter()
+    function(*args)
+    elapsed = (time.perf_counter() - started) * 1000
+    print(f"{name}: {elapsed:.2f} ms")
+    return elapsed
+
+
+def restart(options, site, logger, config):
+    """
+    Remove points, restart the gateway from its StateStore, then discover new points
+    """
+    directory = tempfile.TemporaryDirectory()
+    path = join(directory.name, 'gateway')
+
+    def discoverer(gateway):
+        bacnet_helper = BacnetHelper(gateway, None, logger, config)
+        helper = MqttParseHelper(gateway, None, logger, config, SimpleNamespace(current=None), bacnet_helper)
+
+        def discover(devices, groups):
+            helper.discovery("edges", encode(site.edges()), [], options.vertex)
+            helper.discovery("devices", encode(devices))
+            helper.discovery("groups", encode(groups))
+        return discover
+
+    gateway = Gateway("", [], logger)
+    store = StateStore(path, logger)
+    devices = site.discovered_devices()
+    groups = site.discovered_groups()
+    discover = discoverer(gateway)
+    discover(devices, groups)
+    store.save(gateway)
+
+    churn = max(options.devices // 100, 1)
+    removed = {d: gateway.getDevice(vertex_uid(0), device_uid(0, d)).bacnet_instance for d in range(churn)}
+    removed_group = gateway.getGroup(group_uid(0, 0)).bacnet_instance
+    for v in range(options.vertex):
+        for d in range(churn):
+            del devices[vertex_uid(v)]["devices"][device_uid(v, d)]
+        del groups[vertex_uid(v)]["groups"][group_uid(v, 0)]
+    discover(devices, groups)
+    # Removals and held instances go to the journal
+    assert store.save(gateway)
+    retired = dict(gateway.retired)
+    assert len(retired) == options.vertex * (churn + 1), len(retired)
+
+    # Restart from the journal, then from a compacted snapshot
+    restarted = Gateway("", [], logger)
+    StateStore(path, logger).load(restarted)
+    assert restarted.retired == retired, "held instances lost by the journal"
+    StateStore(path, logger).compact(restarted)
+    gateway = Gateway("", [], logger)
+    StateStore(path, logger).load(gateway)
+    assert gateway.retired == retired, "held instances lost by the snapshot"
+
+    # Removed device 0 first, then new devices, groups likewise
+    for v in range(options.vertex):
+        listed = {device_uid(v, 0): {"device_type": site.device_type}}
+        listed.update(devices[vertex_uid(v)]["devices"])
+        for d in range(churn):
+            listed[device_uid(v, options.devices + d)] = {"device_type": site.device_type}
+        devices[vertex_uid(v)]["devices"] = listed
+        listed = {group_uid(v, 0): {}}
+        listed.update(groups[vertex_uid(v)]["groups"])
+        listed[group_uid(v, options.groups)] = {}
+        groups[vertex_uid(v)]["groups"] = listed
+    discoverer(gateway)(devices, groups)
+    assert gateway.getDevice(vertex_uid(0), device_uid(0, 0)).bacnet_instance == removed[0]
+    assert gateway.getGroup(group_uid(0, 0)).bacnet_instance == removed_group
+    assert gateway.getGroup(group_uid(0, options.groups)).bacnet_instance != removed_group
+    reused = sum(gateway.getDevice(vertex_uid(0), device_uid(0, options.devices + d)).bacnet_instance
+                 in removed.values() for d in range(churn))
+    assert reused == max(churn - (POINT_INSTANCES - options.devices), 0), "instances of removed devices reused"
+    directory.cleanup()
+    print("Held instances kept across a restart - OK!")
+
+
+def new_vertex(options, site, logger, config):
+    """
+    Same devices and groups answers after edges added a Vertex, they must be applied to it
+    """
+    gateway = Gateway("", [], logger)
+    bacnet_helper = BacnetHelper(gateway, None, logger, config)
+    helper = MqttParseHelper(gateway, None, logger, config, SimpleNamespace(current=None), bacnet_helper)
+    edges = encode(site.edges())
+    devices = encode(site.discovered_devices())
+    groups = encode(site.discovered_groups())
+
+    # A Vertex is added while the count is up to max_vertex, one less than the site
+    for max_vertex in (options.vertex - 2, options.vertex):
+        helper.discovery("edges", edges, [], max_vertex)
+        helper.discovery("devices", devices)
+        helper.discovery("groups", groups)
+    assert gateway.quantityVertex() == options.vertex
+    last = gateway.vertex[-1]
+    assert len(last.devices) == options.devices, "devices of the new Vertex skipped"
+    assert len(last.groups) == options.groups, "groups of the new Vertex skipped"
+    print("Unchanged answers applied to a new Vertex - OK!")
+
+
+def duplicate_instances(logger):
+    """
+    A saved state where two devices share a BACnet instance, the second one is moved and the move saved
+    """
+    directory = tempfile.TemporaryDirectory()
+    path = join(directory.name, 'gateway')
+    state = {"version": STATE_VERSION, "vertex": [{
+        "id": vertex_uid(0), "bacnet_instance": 0, "type": "vertex3",
+        "devices": [[device_uid(0, 0), 5, 0], [device_uid(0, 1), 5, 0], [device_uid(0, 2), 0, 0]],
+        "groups": [],
+    }]}
+    with open(f"{path}.state", 'w', encoding='utf-8') as handle:
+        json.dump(state, handle)
+
+    gateway = Gateway("", [], logger)
+    store = StateStore(path, logger)
+    store.load(gateway)
+    instances = [gateway.getDevice(vertex_uid(0), device_uid(0, d)).bacnet_instance for d in range(3)]
+    assert instances == [5, 1, 0], instances
+    assert store.save(gateway) == 1, "move of the duplicate not saved"
+
+    restarted = Gateway("", [], logger)
+    StateStore(path, logger).load(restarted)
+    assert [restarted.getDevice(vertex_uid(0), device_uid(0, d)).bacnet_instance for d in range(3)] == instances
+    directory.cleanup()
+    print("Duplicate instances moved - OK!")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Discovery reconciliation benchmark")
+    parser.add_argument("--vertex", type=int, default=10)
+    parser.add_argument("--devices", type=int, default=999)
+    parser.add_argument("--groups", type=int, default=64)
+    options = parser.parse_args()
+
+    fake_bntest.values[f"{fake_bntest.DEVICE}.fil{FIL_INSTANCE}.description"] = ""
+    logger = Logger(fil_instance=FIL_INSTANCE, level=LEVEL_NONE)
+    config = BenchConfig()
+    site = Site(options.vertex, options.devices, options.groups)
+    gateway = Gateway("", [], logger)
+    bacnet_helper = BacnetHelper(gateway, None, logger, config)
+    helper = MqttParseHelper(gateway, None, logger, config, SimpleNamespace(current=None), bacnet_helper)
+
+    def discover(edges, devices, groups):
+        helper.discovery("edges", edges, [], options.vertex)
+        helper.discovery("devices", devices)
+        helper.discovery("groups", groups)
+
+    edges = encode(site.edges())
+    devices = site.discovered_devices()
+    groups = site.discovered_groups()
+    timed("first discovery", discover, edges, encode(devices), encode(groups))
+    points = gateway.quantityDevices() + gateway.quantityGroups()
+    assert gateway.quantityDevices() == options.vertex * options.devices
+    assert helper.take_changed()
+
+    timed("same answers", discover, edges, encode(devices), encode(groups))
+    timed("same answers, other encoding", discover, encode(site.edges(), True), encode(devices, True),
+          encode(groups, True))
+    assert not helper.take_changed(), "unchanged answers changed the registry"
+
+    # 1% of the devices and groups of every Vertex replaced by new ones
+    churn = max(options.devices // 100, 1)
+    churn_groups = max(options.groups // 100, 1)
+    # Instances of the removed points, held for them while other instances are free
+    removed = {d: gateway.getDevice(vertex_uid(0), device_uid(0, d)).bacnet_instance for d in range(churn)}
+    for v in range(options.vertex):
+        listed = devices[vertex_uid(v)]["devices"]
+        for d in range(churn):
+            del listed[device_uid(v, d)]
+            listed[device_uid(v, options.devices + d)] = {"device_type": site.device_type}
+        listed = groups[vertex_uid(v)]["groups"]
+        for g in range(churn_groups):
+            del listed[group_uid(v, g)]
+            listed[group_uid(v, options.groups + g)] = {}
+    timed(f"{churn} devices and {churn_groups} groups replaced per Vertex", discover, edges, encode(devices),
+          encode(groups))
+    assert helper.take_changed()
+    assert gateway.quantityDevices() == options.vertex * options.devices
+    assert gateway.getDevice(vertex_uid(0), device_uid(0, 0)) is None
+    assert gateway.getDevice(vertex_uid(0), device_uid(0, options.devices)) is not None
+    reused = sum(gateway.getDevice(vertex_uid(0), device_uid(0, options.devices + d)).bacnet_instance
+                 in removed.values() for d in range(churn))
+    assert reused == max(churn - (POINT_INSTANCES - options.devices), 0), "instances of removed devices reused"
+
+    gateway.clearStatus()
+    for vertex in gateway.vertex:
+        vertex.setStatus(True)
+        for device in vertex.devices[::2]:
+            device.setStatus(True)
+        for group in vertex.groups[::2]:
+            group.setStatus(True)
+    timed("reconfigureStatus, half of the points stale", gateway.reconfigureStatus)
+    assert gateway.quantityDevices() == options.vertex * ((options.devices + 1) // 2)
+    print(f"{points} points - OK!")
+
+    restart(options, Site(options.vertex, options.devices, options.groups), logger, config)
+    if options.vertex > 1:
+        new_vertex(options, site, logger, config)
+    duplicate_instances(logger)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Broker loss and restart while BACnet writes keep flowing
+
+A writer thread queues a BACnet write every few milliseconds, like the handlers of MQTT messages do,
+and the time until fake_bntest sees each one is measured. The broker is closed, a second configured
+address blackholes its connection attempts, then the broker is started again on the same port.
+Checks that the main loop never waits for the reconnects and that the gateway connects and subscribes again.
+
+Usage (from Vertex/benchmarks): python reconnect.py [--down 3] [--max-stall-ms 500]
+"""
+import argparse
+import threading
+import time
+
+import fake_bntest
+
+fake_bntest.install()
+
+from fake_broker import FakeBroker
+from harness import Harness
+
+TIMEOUT = 60
+# Not routable, connection attempts to it only end with the paho connect timeout
+BLACKHOLE = "10.255.255.1:1883"
+WRITE_INTERVAL = 0.005
+
+
+def wait_for(condition, message, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError(message)
+        time.sleep(0.02)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gateway reconnect check")
+    parser.add_argument("--down", type=float, default=3, help="Seconds the broker stays down")
+    parser.add_argument("--max-stall-ms", type=float, default=500,
+                        help="Longest accepted time from queueing a BACnet write to its request")
+    options = parser.parse_args()
+
+    fake_bntest.reset()
+    broker = FakeBroker()
+    broker.start()
+    port = broker.port
+
+    # {written value: monotonic time queued}, latencies in ms of every write seen by fake_bntest
+    queued = dict()
+    latencies = []
+    lock = threading.Lock()
+
+    def on_write(key, value):
+        if key.endswith("av3000000.present_value"):
+            with lock:
+                at = queued.pop(value, None)
+            if at is not None:
+                latencies.append((time.monotonic() - at) * 1000)
+
+    fake_bntest.on_write = on_write
+
+    harness = Harness(broker, vertex_ip_vertex=[f"127.0.0.1:{port}", BLACKHOLE])
+    main = harness.main
+    connection = main.brokers.connections[0]
+    harness.start()
+
+    writing = threading.Event()
+    writing.set()
+
+    def writer():
+        number = 0
+        while writing.is_set():
+            number += 1
+            with lock:
+                queued[str(number)] = time.monotonic()
+            main.payload_for_bacnet["AV3000000.Present_Value"] = number
+            main.dispatcher.notify()
+            time.sleep(WRITE_INTERVAL)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    restarted = None
+    tries = 0
+    try:
+        wait_for(connection.is_connected, "not connected")
+        thread.start()
+        time.sleep(0.5)
+
+        broker.close()
+        wait_for(lambda: connection.attempts > 0, "lost broker is not retried")
+        print("broker down, writes continue while reconnecting")
+        time.sleep(options.down)
+        tries = connection.attempts
+
+        restarted = FakeBroker(port)
+        restarted.start()
+        wait_for(lambda: restarted.connected.is_set() and connection.is_connected(), "not reconnected")
+        # A clean session, the topics have to be subscribed again
+        wait_for(restarted.subscribed.is_set, "not subscribed after the reconnect")
+        time.sleep(0.5)
+    finally:
+        writing.clear()
+        if thread.is_alive():
+            thread.join()
+        harness.stop()
+        broker.close()
+        if restarted is not None:
+            restarted.close()
+
+    latencies.sort()
+    worst = latencies[-1]
+    print(f"{len(latencies)} BACnet writes, p50 {latencies[len(latencies) // 2]:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)]:.2f} ms, max {worst:.2f} ms")
+    print(f"reconnected after {tries} failed tries")
+    assert worst < options.max_stall_ms, f"BACnet flush stalled {worst:.0f} ms"
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
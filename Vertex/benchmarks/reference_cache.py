@@ -0,0 +1,40 @@
+"""
+Per-property cost of BACnetInterface.read and write, with and without the parsed reference cache
+"""
+import time
+
+import fake_bntest
+
+fake_bntest.install()
+
+from Delta import DeltaEmbedded
+
+POINTS = 2000
+ROUNDS = 20
+
+
+def run(cache_size):
+    DeltaEmbedded.PARSED_REFERENCE_CACHE_SIZE = cache_size
+    DeltaEmbedded.server = None
+    fake_bntest.reset()
+    interface = DeltaEmbedded.BACnetInterface(site=fake_bntest.SITE)
+
+    references = [f"AV3000{number:03}.Present_Value" for number in range(POINTS)]
+    data = {reference: "50" for reference in references}
+
+    results = {}
+    for name, request in (("write", lambda: interface.write(data)), ("read", lambda: interface.read(references))):
+        fake_bntest.calls.clear()
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            request()
+        elapsed = time.perf_counter() - start
+        properties = POINTS * ROUNDS
+        results[name] = (elapsed / properties * 1e6, fake_bntest.calls["parsereference"] / properties)
+    return results
+
+
+if __name__ == "__main__":
+    for label, cache_size in (("no cache", 0), ("cache", DeltaEmbedded.PARSED_REFERENCE_CACHE_SIZE)):
+        for name, (cost, parses) in run(cache_size).items():
+            print(f"{label:>8} {name}: {cost:.2f} us/property, {parses:.2f} parses/property")
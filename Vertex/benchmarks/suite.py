@@ -0,0 +1,503 @@
+"""
+End-to-end benchmarks of the gateway against fake_bntest and a local broker stand-in
+
+Usage (from Vertex/benchmarks, with the packages of requirements.txt installed):
+    python suite.py                          run every scenario, save results/<time>_<commit>.json
+    python suite.py discovery sensor_storm   run some scenarios
+    python suite.py --compare results/a.json compare with an earlier run
+
+Scenarios:
+    discovery            edges, devices and groups of 10 Vertex x 999 lights, point creation
+    rediscovery          the same discovery again, every point exists already
+    all_light_refresh    state of every light of every Vertex sent again with new values
+    sensor_storm         sustained motion and illuminance updates of Dali-2 sensors
+    group_commands       group brightness commands raised by BACnet alarms (alarm -> read -> publish)
+    group_commands_cov   the same commands delivered with COV notifications (no read)
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from os.path import dirname, abspath, join
+
+import fake_bntest
+
+fake_bntest.install()
+
+from fake_broker import FakeBroker
+from harness import Harness
+
+RESULTS_DIRECTORY = join(dirname(abspath(__file__)), 'results')
+TIMEOUT = 120
+
+
+def percentiles(samples):
+    if not len(samples):
+        return {"count": 0}
+    samples = sorted(samples)
+    last = len(samples) - 1
+    return {
+        "count": len(samples),
+        "p50_ms": round(samples[int(last * 0.50)] * 1000, 3),
+        "p99_ms": round(samples[int(last * 0.99)] * 1000, 3),
+        "max_ms": round(samples[last] * 1000, 3),
+    }
+
+
+def rss_kb():
+    with open('/proc/self/status') as handle:
+        for line in handle:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return None
+
+
+def vertex_uid(vertex):
+    return f"B827EB{vertex:06X}"
+
+
+def device_uid(vertex, device):
+    return f"00{vertex:02X}{device:06X}CB07C626804E8"
+
+
+def group_uid(vertex, group):
+    return f"{vertex:04x}{group:028x}"
+
+
+class Site:
+    """
+    Discovery payloads and BACnet references of a generated site
+    """
+
+    def __init__(self, vertex, devices, groups, device_type=4):
+        self.vertex = vertex
+        self.devices = devices
+        self.groups = groups
+        self.device_type = device_type
+
+    def edges(self):
+        return {vertex_uid(v): {"edge_type": "vertex3"} for v in range(self.vertex)}
+
+    def discovered_devices(self):
+        return {vertex_uid(v): {"edge_type": "vertex3",
+                                "devices": {device_uid(v, d): {"device_type": self.device_type}
+                                            for d in range(self.devices)}}
+                for v in range(self.vertex)}
+
+    def discovered_groups(self):
+        return {vertex_uid(v): {"edge_type": "vertex3",
+                                "groups": {group_uid(v, g): {} for g in range(self.groups)}}
+                for v in range(self.vertex)}
+
+    def light_state(self, vertex, brightness):
+        return {str(d): {"vertex_uid": vertex_uid(vertex), "uid": device_uid(vertex, d),
+                         "brightness": (brightness + d) % 101, "dali_port": d % 4, "short_address": d % 64}
+                for d in range(self.devices)}
+
+    def responders(self, brightness=0):
+        responders = {
+            "discovery/edges/detect": lambda payload: [("discovery/edges", json.dumps(self.edges()))],
+            "discovery/devices/detect": lambda payload: [("discovery/devices", json.dumps(self.discovered_devices()))],
+            "discovery/groups/detect": lambda payload: [("discovery/groups", json.dumps(self.discovered_groups()))],
+        }
+        for v in range(self.vertex):
+            responders[f"vertex3/light/{vertex_uid(v)}/get_state"] = \
+                lambda payload, v=v: [(f"vertex3/light/{vertex_uid(v)}/state",
+                                       json.dumps(self.light_state(v, brightness)))]
+        return responders
+
+
+class Scenario:
+
+    def __init__(self, options, site, **config):
+        fake_bntest.reset()
+        fake_bntest.rpc_delay = options.rpc_delay_ms / 1000
+        self.options = options
+        self.site = site
+        self.broker = FakeBroker()
+        self.broker.start()
+        self.broker.responders = site.responders()
+        config.setdefault("configuration_trace", options.trace)
+        self.harness = Harness(self.broker, **config)
+        self.main = self.harness.main
+        self.harness.start()
+        self.rss_before = rss_kb()
+
+    def discover(self, settle=False):
+        """
+        Run the discovery of the site, returns once the gateway asks Vertex for the light states.
+        With settle, returns once the light states of every Vertex are written as well.
+        """
+        done = threading.Event()
+        self.broker.on_publish = lambda topic, payload, at: topic.endswith("/get_state") and done.set()
+        # Sent by Main.on_connect
+        self.main.trigger_discovery()
+        if not done.wait(TIMEOUT):
+            raise TimeoutError("Discovery did not complete")
+        self.broker.on_publish = None
+        if not settle:
+            return
+
+        keys = []
+        for vertex in self.main.gateway.vertex:
+            for device in vertex.devices:
+                reference = self.main.gateway.getReference(vertex.id, device.id)
+                keys.append(f"{fake_bntest.DEVICE}.{reference.lower()}.present_value")
+        deadline = time.monotonic() + TIMEOUT
+        while not all(key in fake_bntest.values for key in keys):
+            if time.monotonic() > deadline:
+                raise TimeoutError("Initial light state not written")
+            time.sleep(0.05)
+        fake_bntest.calls.clear()
+
+    @staticmethod
+    def drain(samples, expected, quiet=1.0):
+        """
+        Wait until every expected sample arrived or none arrived for quiet seconds.
+        Samples of coalesced updates never arrive, a newer value replaced them in a queue.
+        """
+        count, last_change = len(samples), time.monotonic()
+        while len(samples) < expected and time.monotonic() - last_change < quiet:
+            time.sleep(0.01)
+            if len(samples) != count:
+                count, last_change = len(samples), time.monotonic()
+
+    def wait_writes(self, keys):
+        """
+        Event set once every key was written, the hook records the time of the last write of each key
+        """
+        pending = set(keys)
+        written = {}
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def on_write(key, value):
+            with lock:
+                if key in pending:
+                    pending.discard(key)
+                    written[key] = time.monotonic()
+                    if not pending:
+                        done.set()
+
+        fake_bntest.on_write = on_write
+        return done, written
+
+    def finish(self, result, elapsed, messages):
+        result.update({
+            "messages": messages,
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(messages / elapsed, 1) if elapsed else None,
+            "rpc": dict(fake_bntest.calls),
+            "rss_kb": rss_kb(),
+            "rss_growth_kb": rss_kb() - self.rss_before,
+            "dispatch_latency": self.main.dispatcher.latency_percentiles(),
+            "queues": {
+                "to_bacnet": self.main.payload_for_bacnet.stats(),
+                "from_bacnet": self.main.payload_from_bacnet.stats(),
+                "cov_from_bacnet": self.main.cov_from_bacnet.stats(),
+                "to_vertex": self.main.bacnet_helper.outbox.stats(),
+            },
+        })
+        if self.main.tracer.enabled:
+            result["trace"] = self.main.tracer.snapshot()["kinds"]
+        self.harness.stop()
+        self.broker.close()
+        fake_bntest.on_write = None
+        return result
+
+
+def light_keys(site, vertex):
+    return [f"{fake_bntest.DEVICE}.av300{vertex}{d:03}.present_value" for d in range(site.devices)]
+
+
+def discovery(options):
+    site = Site(options.vertex, options.devices, options.groups)
+    scenario = Scenario(options, site)
+    keys = [key for v in range(site.vertex) for key in light_keys(site, v)]
+    refreshed, _ = scenario.wait_writes(keys)
+
+    started = time.monotonic()
+    scenario.discover()
+    discovered = time.monotonic() - started
+    # Main.on_groups then requests the light states of every Vertex one after the other
+    if not refreshed.wait(TIMEOUT):
+        raise TimeoutError("Initial light state not written")
+    elapsed = time.monotonic() - started
+
+    messages = 3 + site.vertex
+    return scenario.finish({
+        "points": site.vertex * (site.devices + site.groups),
+        "discovery_s": round(discovered, 3),
+        "initial_state_s": round(elapsed - discovered, 3),
+    }, elapsed, messages)
+
+
+def rediscovery(options):
+    site = Site(options.vertex, options.devices, options.groups)
+    scenario = Scenario(options, site)
+    scenario.discover(settle=True)
+
+    # Discovery steps and light state requests start over, like after the edges/detect of a new cycle
+    scenario.main.brokers.connections[0].topic_to_send = 0
+    scenario.main.topic_to_send_for_light = 0
+    before = dict(fake_bntest.calls)
+    started = time.monotonic()
+    scenario.discover()
+    elapsed = time.monotonic() - started
+    requests = {name: fake_bntest.calls[name] - before.get(name, 0) for name in fake_bntest.calls}
+
+    return scenario.finish({
+        "points": site.vertex * (site.devices + site.groups),
+        "rediscovery_s": round(elapsed, 3),
+        "rediscovery_rpc": requests,
+    }, elapsed, 3)
+
+
+def all_light_refresh(options):
+    site = Site(options.vertex, options.devices, options.groups)
+    scenario = Scenario(options, site)
+    keys = [key for v in range(site.vertex) for key in light_keys(site, v)]
+    scenario.discover(settle=True)
+
+    # Every light changes, nothing is skipped by the write cache
+    done, written = scenario.wait_writes(keys)
+    sent = {}
+    started = time.monotonic()
+    for v in range(site.vertex):
+        sent[v] = scenario.broker.send(f"vertex3/light/{vertex_uid(v)}/state", json.dumps(site.light_state(v, 50)))
+    if not done.wait(TIMEOUT):
+        raise TimeoutError("Light state refresh not written")
+    elapsed = time.monotonic() - started
+
+    latency = [written[key] - sent[int(key.split('.')[1][5])] for key in keys]
+    return scenario.finish({
+        "lights": len(keys),
+        "lights_per_s": round(len(keys) / elapsed, 1),
+        "mqtt_to_bacnet": percentiles(latency),
+    }, elapsed, site.vertex)
+
+
+def sensor_storm(options):
+    # Dali-2 devices, motion on the device instance and illuminance on the next one
+    site = Site(options.vertex, options.sensors, 0, device_type=128)
+    scenario = Scenario(options, site)
+    scenario.discover(settle=True)
+
+    points = []
+    for v in range(site.vertex):
+        for d in range(site.devices):
+            device = scenario.main.gateway.getDevice(vertex_uid(v), device_uid(v, d))
+            points.append((f"vertex3/sensor/{vertex_uid(v)}/{device_uid(v, d)}/motion/state", "motion",
+                           f"{fake_bntest.DEVICE}.av320{v}{device.bacnet_instance:03}.present_value"))
+            points.append((f"vertex3/sensor/{vertex_uid(v)}/{device_uid(v, d)}/illuminance/state", "illuminance",
+                           f"{fake_bntest.DEVICE}.av320{v}{device.bacnet_instance + 1:03}.present_value"))
+    pending = {}
+    latency = []
+    delivered = []
+    lock = threading.Lock()
+
+    def on_write(key, value):
+        with lock:
+            sent_at = pending.pop((key, value), None)
+        if sent_at is not None:
+            delivered.append(time.monotonic())
+            latency.append(delivered[-1] - sent_at)
+
+    fake_bntest.on_write = on_write
+
+    # Paced in 10 ms ticks, each tick sends its messages in one socket write
+    tick = 0.01
+    per_tick = max(int(options.rate * tick), 1)
+    total = int(options.rate * options.duration)
+    sent = 0
+    started = time.monotonic()
+    while sent < total:
+        batch = []
+        keys = []
+        for _ in range(min(per_tick, total - sent)):
+            topic, sensor, key = points[sent % len(points)]
+            value = sent // len(points) + 1
+            batch.append((topic, json.dumps({sensor: value})))
+            keys.append((key, str(value)))
+            sent += 1
+        with lock:
+            for key in keys:
+                pending[key] = None
+        sent_at = scenario.broker.send_many(batch)
+        with lock:
+            for key in keys:
+                if key in pending:
+                    pending[key] = sent_at
+        delay = started + tick * (sent // per_tick) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    Scenario.drain(latency, sent)
+    elapsed = (delivered[-1] if delivered else time.monotonic()) - started
+
+    return scenario.finish({
+        "sensors": len(points),
+        "target_rate": options.rate,
+        "written": len(latency),
+        # Replaced by a newer value of the same sensor before reaching BACnet
+        "superseded": sent - len(latency),
+        "mqtt_to_bacnet": percentiles(latency),
+    }, elapsed, sent)
+
+
+def group_commands(options, cov=False):
+    site = Site(options.vertex, options.devices, options.groups)
+    scenario = Scenario(options, site, configuration_use_cov=cov)
+    scenario.discover(settle=True)
+    if cov:
+        # Subscriptions are spread over the renewal passes, all of them are made before the commands
+        helper = scenario.main.bacnet_helper
+        while not all(helper.cov_subscribed(obj) for obj in helper.command_objects()):
+            scenario.harness.call(scenario.main.subscribe_cov)
+
+    received = {}
+    latency = []
+    delivered = []
+    lock = threading.Lock()
+
+    def on_publish(topic, payload, at):
+        if not topic.endswith("/brightness/set"):
+            # Light state requests of the discovery
+            return
+        key = (topic, json.loads(payload)["value"])
+        with lock:
+            sent_at = received.pop(key, None)
+        if sent_at is not None:
+            delivered.append(at)
+            latency.append(at - sent_at)
+
+    scenario.broker.on_publish = on_publish
+
+    total = options.commands
+    interval = 1 / options.command_rate
+    started = time.monotonic()
+    for number in range(total):
+        v, g = number % site.vertex, (number // site.vertex) % site.groups
+        value = (number // (site.vertex * site.groups)) % 100 + 1
+        obj = f"AV311{v}{g:03}"
+        reference = f"//{fake_bntest.SITE}/{fake_bntest.DEVICE}.{obj}.Present_Value"
+        topic = f"vertex3/group/{group_uid(v, g)}/brightness/set"
+        fake_bntest.values[f"{fake_bntest.DEVICE}.{obj.lower()}.present_value"] = str(value)
+        fake_bntest.values[f"{fake_bntest.DEVICE}.{obj.lower()}.description"] = ""
+        with lock:
+            received[(topic, value)] = time.monotonic()
+        if cov:
+            scenario.main.cov_callback(fake_bntest.ccovnotification(reference, str(value)))
+        else:
+            scenario.main.alarm_callback(fake_bntest.calarmnotification(reference))
+        delay = started + interval * (number + 1) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    Scenario.drain(latency, total)
+    elapsed = (delivered[-1] if delivered else time.monotonic()) - started
+
+    return scenario.finish({
+        "groups": site.vertex * site.groups,
+        "published": len(latency),
+        "superseded": total - len(latency),
+        "bacnet_to_mqtt": percentiles(latency),
+    }, elapsed, total)
+
+
+SCENARIOS = {
+    "discovery": discovery,
+    "rediscovery": rediscovery,
+    "all_light_refresh": all_light_refresh,
+    "sensor_storm": sensor_storm,
+    "group_commands": group_commands,
+    "group_commands_cov": lambda options: group_commands(options, cov=True),
+}
+
+
+def commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=dirname(abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def flatten(result, prefix=""):
+    values = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f"{prefix}{key}"] = value
+    return values
+
+
+def compare(previous, current):
+    for name, result in current["scenarios"].items():
+        before = flatten(previous["scenarios"].get(name, {}))
+        for key, value in flatten(result).items():
+            if key in before and before[key]:
+                change = (value - before[key]) / before[key] * 100
+                print(f"{name}.{key}: {before[key]} -> {value} ({change:+.1f}%)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Gateway end-to-end benchmarks")
+    parser.add_argument("scenarios", nargs="*", choices=[[]] + list(SCENARIOS), default=[])
+    parser.add_argument("--vertex", type=int, default=10)
+    parser.add_argument("--devices", type=int, default=999, help="lights per Vertex")
+    parser.add_argument("--groups", type=int, default=16, help="groups per Vertex")
+    parser.add_argument("--sensors", type=int, default=90, help="Dali-2 sensor devices per Vertex")
+    parser.add_argument("--rate", type=int, default=5000, help="sensor messages per second")
+    parser.add_argument("--duration", type=float, default=5, help="sensor storm duration in seconds")
+    parser.add_argument("--commands", type=int, default=2000, help="group commands raised by BACnet")
+    parser.add_argument("--command-rate", type=int, default=500, help="group commands per second")
+    parser.add_argument("--rpc-delay-ms", type=float, default=0.5, help="simulated bnserver request time")
+    parser.add_argument("--trace", action="store_true", help="record the stage latencies of the gateway")
+    parser.add_argument("--output", help="results file, default results/<time>_<commit>.json")
+    parser.add_argument("--compare", help="results file of an earlier run")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    names = options.scenarios or list(SCENARIOS)
+
+    results = {
+        "commit": commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "options": {key: value for key, value in vars(options).items() if key not in ("output", "compare")},
+        "scenarios": {},
+    }
+    for name in names:
+        print(f"Running {name}...", flush=True)
+        try:
+            result = SCENARIOS[name](options)
+        except TimeoutError as error:
+            # Lost messages, the queue statistics of a run that completes tell where
+            result = {"error": str(error)}
+        results["scenarios"][name] = result
+        print(json.dumps(result, indent=2), flush=True)
+    results["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    output = options.output
+    if output is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        output = join(RESULTS_DIRECTORY, f"{time.strftime('%Y%m%d-%H%M%S')}_{results['commit']}.json")
+    with open(output, 'w', encoding='utf-8') as handle:
+        json.dump(results, handle, indent=2)
+    print(f"Results saved to {output}")
+
+    if options.compare:
+        with open(options.compare, encoding='utf-8') as handle:
+            compare(json.load(handle), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Export of a month of 1-minute trend log records through PDS.BACnet.Interface
+
+Compares read_tl_by_date_range, which returns the whole range as a list, with iter_tl_by_date_range
+with and without prefetch. Every record is written to a CSV file like an export would do.
+Reports the time, the bnserver requests and the peak of memory allocated while exporting.
+
+Usage (from Vertex/benchmarks): python trend_log.py [--days 30] [--rpc-delay-ms 50]
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+import tracemalloc
+
+import fake_bntest
+
+fake_bntest.install()
+
+from PDS.BACnet import Interface
+
+TL_REF = "TL1"
+
+
+def export(records, path):
+    count = 0
+    with open(path, 'w', encoding='utf-8') as handle:
+        for stamp, _type, value in records:
+            handle.write(f"{stamp.isoformat()},{value}\n")
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trend log export benchmark")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--rpc-delay-ms", type=float, default=50, help="Simulated bnserver time of a batch")
+    options = parser.parse_args()
+
+    first = datetime.datetime(2024, 3, 1)
+    total = options.days * 24 * 60
+    fake_bntest.reset()
+    fake_bntest.trend_logs[f"{fake_bntest.DEVICE}.{TL_REF.lower()}.log_buffer"] = (first, 60, total)
+    fake_bntest.rpc_delay = options.rpc_delay_ms / 1000
+    bacnet = Interface(user="Delta", password="", site=fake_bntest.SITE)
+    start_date = first - datetime.timedelta(seconds=1)
+    end_date = first + datetime.timedelta(days=options.days)
+
+    modes = {
+        "list": lambda: bacnet.read_tl_by_date_range(TL_REF, start_date, end_date),
+        "iterator": lambda: bacnet.iter_tl_by_date_range(TL_REF, start_date, end_date),
+        "iterator, prefetch": lambda: bacnet.iter_tl_by_date_range(TL_REF, start_date, end_date, prefetch=True),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "export.csv")
+        for name, records in modes.items():
+            fake_bntest.calls.clear()
+            tracemalloc.start()
+            started = time.perf_counter()
+            count = export(records(), path)
+            elapsed = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert count == total, (name, count, total)
+            print(f"{name}: {count} records in {elapsed:.2f} s, {fake_bntest.calls['executeobjectrequest']} requests, "
+                  f"peak {peak / 1024:.0f} KiB")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,17 @@ import re
 import datetime
 import random
 import os
+from collections import OrderedDict
 
 from Delta import Results
 
 server = None 
 
+# Filled in references kept per interface, the cache is dropped when it grows past this size
+REFERENCE_CACHE_SIZE = 4096
+# Parsed creference objects kept per interface, least recently used ones are evicted past this size
+PARSED_REFERENCE_CACHE_SIZE = 4096
+
 class BACnetInterface(object):
 
     def __init__(self, user="Admin", password="AdminBMS", site="Techniczny"):
@@ -27,27 +33,84 @@ class BACnetInterface(object):
         if self.site_name not in self.server.sitegetlist(self.user_key):
             raise RuntimeError("Site {name} does not exist".format(name=self.site_name))
 
+        self.open_site()
+
+    def open_site(self):
+        """Open the site if it is not open yet.
+        Site identity cached by this interface is dropped, as the site may have been reopened.
+        """
         if not self.server.siteisopen(self.user_key, self.site_name):
             self.server.siteopen(self.user_key, self.site_name)
+        self.invalidate_site_cache()
+
+    def invalidate_site_cache(self):
+        """Forget the memoized site device number, filled in references and parsed references."""
+        self.__local_device = None
+        self.__site_device = None
+        self.__references = {}
+        self.__parsed_references = OrderedDict()
+
+    def __parse_reference(self, reference, depth=None):
+        """Parsed creference of a reference string, optionally set to a depth.
+        The returned object is shared, callers must not modify it.
+        """
+        key = (reference, depth)
+        obj_ref = self.__parsed_references.get(key)
+        if obj_ref is not None:
+            self.__parsed_references.move_to_end(key)
+            return obj_ref
 
+        obj_ref = bntest.creference()
+        obj_ref.parsereference(reference, bntest.LANGUAGE_ID_ENGLISH, self.user_key)
+        if depth is not None:
+            obj_ref.setdepth(depth)
+
+        self.__parsed_references[key] = obj_ref
+        if len(self.__parsed_references) > PARSED_REFERENCE_CACHE_SIZE:
+            self.__parsed_references.popitem(last=False)
+        return obj_ref
+
+    def get_local_device(self):
+        """Site device number (CFG_SITE_DEVICENUMBER), read from bnserver once per session."""
+        if self.__local_device is None:
+            self.__local_device = str(
+                self.server.setupgetparameter(self.user_key, self.site_name, "CFG_SITE_DEVICENUMBER", 0))
+        return self.__local_device
+
+    def get_site_device(self):
+        """Device number of the site (sitegetdevicenumber), read from bnserver once per session."""
+        if self.__site_device is None:
+            self.__site_device = self.server.sitegetdevicenumber(self.user_key, self.site_name)
+        return self.__site_device
 
     def __fill_in_reference(self, reference):
         """Fill in any missing info in a property reference
         Add device if it is not specified
         Add object instance for DEV or DBI if it is not specified
         """
-        local_device = self.server.setupgetparameter(self.user_key, self.site_name, "CFG_SITE_DEVICENUMBER", 0)
+        full_reference = self.__references.get(reference)
+        if full_reference is not None:
+            return full_reference
+
+        local_device = self.get_local_device()
 
         # check for missing device
-        if not reference.split('.')[0].isdigit():
-            reference = str(local_device) + '.' + reference
+        dev, _, rest = reference.partition('.')
+        if not dev.isdigit():
+            dev, rest = local_device, reference
 
         # check for missing object instance
-        dev, obj, prop = reference.split(".", 2)
+        obj, separator, prop = rest.partition('.')
+        if not separator:
+            raise ValueError("Invalid property reference {ref}".format(ref=reference))
         if obj.lower() in ('dev', 'dbi'):
-            obj = obj + str(local_device)
+            obj = obj + local_device
 
-        return '.'.join([dev, obj, prop])
+        full_reference = dev + '.' + obj + '.' + prop
+        if len(self.__references) >= REFERENCE_CACHE_SIZE:
+            self.__references = {}
+        self.__references[reference] = full_reference
+        return full_reference
 
     def split_reference(self, reference):
         """
@@ -80,14 +143,9 @@ class BACnetInterface(object):
             refs = [self.__fill_in_reference(ref) for ref in property_references]
 
         prop_list = bntest.cpropertylist()
-        obj_ref = bntest.creference()
 
         for ref in refs:
-            obj_ref.parsereference(
-                    '//{site}/{obj_and_prop}'.format(site=self.site_name, obj_and_prop=ref),
-                    bntest.LANGUAGE_ID_ENGLISH,
-                    self.user_key)
-            prop_list.addreference(obj_ref)
+            prop_list.addreference(self.__parse_reference('//' + self.site_name + '/' + ref))
         
         self.server.executeobjectrequest(self.user_key, bntest.OBJECT_READ, prop_list)
         status = prop_list.getpropertyliststatus()
@@ -153,15 +211,14 @@ class BACnetInterface(object):
             else:
                 data = str(data_obj)
 
-            obj_ref = bntest.creference()
-            obj_ref.parsereference(reference, bntest.LANGUAGE_ID_ENGLISH, self.user_key)
-
-            top_ref = bntest.creference()
-            top_ref.parsereference(reference, bntest.LANGUAGE_ID_ENGLISH, self.user_key)
-            top_ref.setdepth(0)
-            temp_ref = bntest.creference()
+            obj_ref = self.__parse_reference(reference)
 
+            top_ref = self.__parse_reference(reference, 0)
             if top_ref.islistproperty():
+                # The array index of a list property is changed below, work on a private copy
+                top_ref = bntest.creference()
+                top_ref.parsereference(reference, bntest.LANGUAGE_ID_ENGLISH, self.user_key)
+                top_ref.setdepth(0)
                 list_index = top_ref.getarrayindex()
                 top_ref.setarrayindex(bntest.WILD_ARRAY_INDEX)
             try:
@@ -179,8 +236,7 @@ class BACnetInterface(object):
             depth = obj_ref.getdepth()
             # Advance the properties and sub-properties of the full reference
             for curr_depth in range(0, depth + 1):
-                temp_ref.parsereference(reference, bntest.LANGUAGE_ID_ENGLISH, self.user_key)
-                temp_ref.setdepth(curr_depth)
+                temp_ref = self.__parse_reference(reference, curr_depth)
                 if temp_ref.islistproperty():
                     break
                 # Is this (sub-)property an array or a list?
@@ -190,13 +246,6 @@ class BACnetInterface(object):
                     and not top_ref.isfixedarray()
                 ):
                     # Increment array count in the proplist
-                    array_ref = bntest.creference()
-                    array_ref.parsereference(
-                        str(temp_ref),
-                        bntest.LANGUAGE_ID_ENGLISH,
-                        self.user_key
-                    )
-
                     try:
                         prop_list.finditem(temp_ref)
                     except:
@@ -288,7 +337,7 @@ class BACnetInterface(object):
             objReference = bntest.creference()
 
             if device is None:
-                device = self.server.sitegetdevicenumber(self.user_key, self.site_name)
+                device = self.get_site_device()
 
             wildReference = bntest.cwildreference(self.site_name, int(device), bntest.WILD_OBJECT_INSTANCE, obj_type)
 
@@ -313,7 +362,7 @@ class BACnetInterface(object):
         If the object does not exist return None.
         """
         if device is None:
-            device = self.server.sitegetdevicenumber(self.user_key, self.site_name)
+            device = self.get_site_device()
         full_ref_text = f"//{self.site_name}/{int(device)}.{object_id}"
         object_ref = bntest.creference(full_ref_text, bntest.LANGUAGE_ID_ENGLISH, self.user_key)
         try:
@@ -1,4 +1,6 @@
 import datetime
+import time
+from collections import deque
 from Delta import DeltaEmbedded
 from Delta import LoadableModules
 from pathlib import Path
@@ -10,7 +12,7 @@ class Logger:
 
     MAX_LOG_ENTRIES = 20
 
-    def __init__(self, fil_instance=None):
+    def __init__(self, fil_instance=None, flush_interval=0):
         """
         Instantiate new Logger with messages loaded from FIL object's description
 
@@ -18,25 +20,51 @@ class Logger:
             fil_instance -- (optional) FIL object to map to. Not needed if used from a loadable
                 module script, in this case it is found using loadable script name in the
                 callstack.
+            flush_interval -- (optional) Minimum number of seconds between two writes of the FIL
+                description. Entries logged in between are kept in memory until flush() or the
+                next entry after the interval. 0 writes every entry immediately.
         """
         if fil_instance is None:
             module_name, fil_instance = LoadableModules.find_module_in_callstack()
 
         self.fil_description_ref = f"fil{fil_instance}.description"
-        self.messages = bacnet.read_value(self.fil_description_ref).splitlines()
-    
+        self.messages = deque(bacnet.read_value(self.fil_description_ref).splitlines(),
+                              maxlen=self.MAX_LOG_ENTRIES)
+        self.flush_interval = flush_interval
+        self.last_flush = 0
+        self.last_message = None
+        self.repeated = 0
+        self.pending = False
+
     def _write_messages(self):
         bacnet.write({self.fil_description_ref: "\n".join(self.messages)})
+        self.last_flush = time.monotonic()
+        self.pending = False
 
     def clear(self):
         """Remove all entries."""
-        self.messages = []
+        self.messages.clear()
+        self.last_message = None
+        self.repeated = 0
         self._write_messages()
 
-    def log_status(self, message):
-        """Add an entry."""
-        trim_size = self.MAX_LOG_ENTRIES - 1
+    def log_status(self, message, flush=False):
+        """Add an entry, identical consecutive entries are collapsed into one."""
         current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.messages = self.messages[-trim_size: ] + [f"[{current_time}] {message}"]
-        self._write_messages()
+        if message == self.last_message and len(self.messages):
+            self.repeated += 1
+            self.messages[-1] = f"[{current_time}] {message} (repeated ×{self.repeated})"
+        else:
+            self.last_message = message
+            self.repeated = 1
+            self.messages.append(f"[{current_time}] {message}")
+        self.pending = True
+
+        if flush or time.monotonic() - self.last_flush >= self.flush_interval:
+            self._write_messages()
+
+    def flush(self):
+        """Write buffered entries to the FIL object."""
+        if self.pending:
+            self._write_messages()
 
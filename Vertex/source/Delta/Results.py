@@ -9,6 +9,9 @@ class ReadResults(dict):
     2.  [] accessor will search for subproperties.
     """
 
+    # Keys of each property prefix with subproperties or array indexes, see __sub_property_keys
+    __prefix_index = None
+
     def __init__(self, *args, **kw):
         """Initialize ReadResults object.
 
@@ -16,6 +19,7 @@ class ReadResults(dict):
                      Can be either a cpropertylist or an existing dictionary.
 
         """
+        self.__prefix_index = None
         if isinstance(args[0], dict):
             # initialize using an existing dictionary
             self.update(args[0])
@@ -124,41 +128,101 @@ class ReadResults(dict):
                     dictionary will be searched and a ReadResults (dictionary) object of subproperties and values will be returned.
         """
         # return value if key is found in dictionary
-        for self_key, self_value in self.items():
-            if self_key == key.lower():
-                return self_value
-        else:
-            # create a dictionary of subproperties
-            sub_property_dict = {}
-            is_list_prop = False
-            for key_in_dict, value_in_dict in self.items():
-                if key_in_dict.startswith(key.lower() + '.'):
-                    sub_property_dict[key_in_dict[len(key) + 1: ]] = value_in_dict
-
-                elif key_in_dict.startswith(key.lower() + '['):
-                    # store subvalues with dict key as index so we can find the order
-                    is_list_prop = True
-                    left_bracket_idx = key_in_dict.find('[', len(key))
-                    right_bracket_idx = key_in_dict.find(']', left_bracket_idx)
-                    arrayidx = int(key_in_dict[left_bracket_idx + 1 : right_bracket_idx])
-
-                    if len(key_in_dict) - 1 == right_bracket_idx:
-                        # add single data entry to array
-                        sub_property_dict[arrayidx] = value_in_dict
-                    else:
-                        sub_prop_start = key_in_dict.find('.', right_bracket_idx) + 1
-                        if arrayidx in sub_property_dict.keys():
-                            sub_property_dict[arrayidx][key_in_dict[sub_prop_start : ]] = value_in_dict
-                        else:
-                            sub_property_dict[arrayidx] = {key_in_dict[sub_prop_start : ] : value_in_dict}
-
-            if is_list_prop:
-                # return array sorted by array index
-                return [sub_property_dict[sorted_key] for sorted_key in sorted(sub_property_dict.keys())]
-            if sub_property_dict:
-                return ReadResults(sub_property_dict)
+        lower_key = key.lower()
+        if dict.__contains__(self, lower_key):
+            return dict.__getitem__(self, lower_key)
+
+        # create a dictionary of subproperties
+        sub_property_dict = {}
+        is_list_prop = False
+        for key_in_dict in self.__sub_property_keys(lower_key):
+            value_in_dict = dict.__getitem__(self, key_in_dict)
+            if key_in_dict[len(lower_key)] == '.':
+                sub_property_dict[key_in_dict[len(key) + 1: ]] = value_in_dict
+
             else:
-                raise KeyError(key)
+                # store subvalues with dict key as index so we can find the order
+                is_list_prop = True
+                left_bracket_idx = key_in_dict.find('[', len(key))
+                right_bracket_idx = key_in_dict.find(']', left_bracket_idx)
+                arrayidx = int(key_in_dict[left_bracket_idx + 1 : right_bracket_idx])
+
+                if len(key_in_dict) - 1 == right_bracket_idx:
+                    # add single data entry to array
+                    sub_property_dict[arrayidx] = value_in_dict
+                else:
+                    sub_prop_start = key_in_dict.find('.', right_bracket_idx) + 1
+                    if arrayidx in sub_property_dict.keys():
+                        sub_property_dict[arrayidx][key_in_dict[sub_prop_start : ]] = value_in_dict
+                    else:
+                        sub_property_dict[arrayidx] = {key_in_dict[sub_prop_start : ] : value_in_dict}
+
+        if is_list_prop:
+            # return array sorted by array index
+            return [sub_property_dict[sorted_key] for sorted_key in sorted(sub_property_dict.keys())]
+        if sub_property_dict:
+            return ReadResults(sub_property_dict)
+        else:
+            raise KeyError(key)
+
+
+    def __sub_property_keys(self, prefix):
+        """Keys continuing the prefix with a subproperty ('.') or an array index ('['), in insertion order.
+        The prefix index is built on the first subproperty lookup and dropped when the dictionary changes.
+        """
+        if self.__prefix_index is None:
+            prefix_index = {}
+            for key_in_dict in self.keys():
+                if not isinstance(key_in_dict, str):
+                    continue
+                for position, char in enumerate(key_in_dict):
+                    if char == '.' or char == '[':
+                        prefix_index.setdefault(key_in_dict[:position], []).append(key_in_dict)
+            self.__prefix_index = prefix_index
+        return self.__prefix_index.get(prefix, ())
+
+
+    def __setitem__(self, key, value):
+        self.__prefix_index = None
+        super(ReadResults, self).__setitem__(self.__normalize(key), value)
+
+
+    def __delitem__(self, key):
+        self.__prefix_index = None
+        super(ReadResults, self).__delitem__(self.__normalize(key))
+
+
+    def update(self, *args, **kw):
+        self.__prefix_index = None
+        super(ReadResults, self).update({self.__normalize(key): value for key, value in dict(*args, **kw).items()})
+
+
+    def setdefault(self, key, default=None):
+        self.__prefix_index = None
+        return super(ReadResults, self).setdefault(self.__normalize(key), default)
+
+
+    def pop(self, key, *default):
+        self.__prefix_index = None
+        return super(ReadResults, self).pop(self.__normalize(key), *default)
+
+
+    def popitem(self):
+        self.__prefix_index = None
+        return super(ReadResults, self).popitem()
+
+
+    def clear(self):
+        self.__prefix_index = None
+        super(ReadResults, self).clear()
+
+
+    @staticmethod
+    def __normalize(key):
+        # Keys are stored lowercase, as properties are matched case-insensitively
+        if isinstance(key, str):
+            return key.lower()
+        return key
 
 
     def tryint(self, s):
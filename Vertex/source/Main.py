@@ -8,30 +8,38 @@ from os.path import dirname, abspath, join
 pathfile = dirname(dirname(abspath(__file__)))
 sys.path.append(join(pathfile, 'packages'))
 
-# Other lib
-import paho.mqtt.client as mqtt
-
 # Custom my lib
 from vertex.StaticData import VERTEX_USERNAME, VERTEX_PASSWORD
 from helper.ConfigFileHelper import ConfigFileHelper
 from helper.MqttParseHelper import MqttParseHelper
-from helper.BacnetHelper import BacnetHelper
+from helper.BacnetHelper import BacnetHelper, COV_RENEW_SECONDS
+from helper.BrokerPool import BrokerPool
+from helper.Dispatcher import Dispatcher
+from helper.TopicRouter import TopicRouter
+from helper.SwapBuffer import SwapBuffer
+from helper.Tracer import Tracer, TO_BACNET, TO_VERTEX, READ, WRITE, PUBLISH
+from helper.Tracer import LIGHT, GROUP_FEEDBACK, SENSOR, BUTTON, GROUP_COMMAND, LIGHT_COMMAND
 from vertex.Gateway import Gateway
+from vertex.StateStore import StateStore
 
 # DCI approve
-from pathlib import Path
 import bntest
-import pickle
 import json
 import time
 import os
 import argparse
+import threading
 import schedule
-from PDS.Log import Logger
+from PDS.Log import Logger, FLUSH_INTERVAL
 from PDS.BACnet import Interface
 
 INTERFACE_NAME = 'VertexGateway 2.0'
 SETTINGS_FILE_NAME = 'Vertex_Settings_Config_CSV'
+TRACE_FILE_NAME = 'Vertex_Trace_CSV'
+# Seconds after the startup the cached identity is checked, and between two tries if the check fails
+IDENTITY_CHECK_SECONDS = 5
+# Instance the trace object is created at when no object has its name
+TRACE_OBJECT = 'CSV3900001'
 VERTEX_MQTT_USERNAME = VERTEX_USERNAME
 VERTEX_MQTT_PASSWORD = VERTEX_PASSWORD
 
@@ -48,27 +56,8 @@ class Main:
             self.password = password
             self.site = site
             self.debug = debug
-            self.init_completed = False
-            self.vertex_ip_choose_during_reconnect = 0
-            self.topic_to_send = 0
-            self.topic_to_send_for_light = 0
-            self.reconnect = None
-            self.counter_for_run = 0
-            self.counter_for_bacnet = 500
-            self.counter_for_mqtt = 500
-            self.payload_for_bacnet = {}
-            self.payload_from_bacnet = []
-            self.payload_for_mqtt = []
-
-            """
-            MQTT Topics
-            """
-            self.mqtt_topics = [("discovery/edges", 0), ("discovery/devices", 0), ("discovery/groups", 0),
-                                ("vertex3/light/+/state", 0),
-                                ("vertex3/light/+/+/state", 0),
-                                ("vertex3/group/+/feedback/state", 0),
-                                ("vertex3/sensor/+/+/+/state", 0),
-                                ("vertex3/button/+/+/+/state", 0)]
+            started = time.monotonic()
+            self.setup_runtime()
 
             """
             Set up the logger (for writing to the FIL object)
@@ -85,10 +74,24 @@ class Main:
             self.logger.clear()
             self.logger.message(f"Initializing '{INTERFACE_NAME}' interface...")
             self.logger.message(f"✅ Logger initialized")
+            schedule.every(FLUSH_INTERVAL).seconds.do(self.logger.flush).tag('logger')
+
+            """
+            Load data (vertex, devices and groups with their BACnet instances), only disk access,
+            done while the BACnet steps below run
+            """
+            self.state_store = StateStore(join(pathfile, 'config/gateway'), self.logger)
+            self.gateway = Gateway("", [], self.logger)
+            loading = threading.Thread(target=self.load_gateway, name="load_gateway", daemon=True)
+            loading.start()
+            identity = self.state_store.loadIdentity()
+            if identity.get("device") != self.device or identity.get("site") != self.site:
+                identity = dict()
 
             """
             Set up the interface
             """
+            step = time.monotonic()
             self.bacnet = Interface(user=self.username, password=self.password, site=self.site, device=self.device)
             # If a device is provided via the command prompt (ex: running through PyCharm),
             # reconfirm the device to allow the local machine's quattro to fully load it and avoid
@@ -98,13 +101,23 @@ class Main:
                 self.bacnet.reconfirm_device(self.device)
             self.bacnet.register_alarm_callback(self.alarm_callback)
             self.logger.message(f"✅ Interface initialized")
+            step = self.startup_step("interface", step)
             # **********************************************************************************************************
             """
             Set up the config manager
             """
-            self.config_file_helper = ConfigFileHelper(SETTINGS_FILE_NAME, self.bacnet, self.logger, self.device)
-
-            if self.config_file_helper.addConfig():
+            settings_reference = identity.get("settings_reference")
+            self.config_file_helper = ConfigFileHelper(SETTINGS_FILE_NAME, self.bacnet, self.logger, self.device,
+                                                       settings_reference)
+            settings_added = self.config_file_helper.addConfig()
+            if not settings_added and settings_reference is not None:
+                # The cached settings object is gone, search it by name (or create it) like on a first start
+                self.logger.debug("Cached settings object %s is not valid", settings_reference)
+                identity = dict()
+                self.config_file_helper = ConfigFileHelper(SETTINGS_FILE_NAME, self.bacnet, self.logger,
+                                                           self.device)
+                settings_added = self.config_file_helper.addConfig()
+            if settings_added:
                 self.logger.message("✅ Settings file initialized")
             else:
                 self.logger.warn("Bad configuration of the settings file")
@@ -115,52 +128,206 @@ class Main:
 
             schedule.every(self.config_file_helper.configuration_setting_file_refresh).seconds.do(
                 self.config_file_helper.check_all_for_update).tag('settings', 'configuration')
+            step = self.startup_step("settings", step)
+
+            """
+            Set up dispatcher
+            """
+            self.setup_dispatcher()
 
             """
             Set up Vertex broker
             """
-            model_name = self.bacnet.read_value(f'DEV{self.device}.Model_Name')
-            serial_number = self.bacnet.read_value(f'DEV{self.device}.Serial_Number')
+            if identity.get("model_name") and identity.get("serial_number"):
+                model_name = identity["model_name"]
+                serial_number = identity["serial_number"]
+            else:
+                model_name, serial_number = self.read_identity()
+            step = self.startup_step("identity", step)
             self.client_name = f"{model_name}_{serial_number}"
-            self.client = mqtt.Client(self.client_name)  # create new instance
-            self.client.on_connect = self.on_connect
-            self.client.on_disconnect = self.on_disconnect
-            self.client.on_message = self.on_message
+            self.setup_brokers(self.client_name)
             self.logger.message(f"✅ Vertex communication interface initialized")
 
             """
             Set up Gateway
             """
-            # Load data (deserialize)
-            if Path(join(pathfile, 'config/gateway.pickle')).is_file():
-                with open(join(pathfile, 'config/gateway.pickle'), 'rb') as handle:
-                    self.gateway = pickle.load(handle)
-
-                self.logger.message(f"Load configuration from database")
-            else:
-                self.gateway = Gateway(self.config_file_helper.configuration_license,
-                                       self.config_file_helper.vertex_ip_vertex,
-                                       self.logger,
-                                       max_vertex=self.config_file_helper.vertex_max_vertex,
-                                       max_points=self.config_file_helper.vertex_max_bacnet_points,
-                                       use_tags=self.config_file_helper.configuration_use_tags,
-                                       serial_number=serial_number,
-                                       )
-                self.logger.message(f"Generate configuration")
-            """
-            Set up BACnet Helper
-            """
-            self.bacnet_helper = BacnetHelper(self.gateway, self.bacnet, self.logger, self.config_file_helper)
+            self.setup_gateway(serial_number)
+            # Connect and subscribe while the remaining BACnet steps run, messages wait for self.ready
+            if self.gateway.licenseIsValid():
+                self.connect_to_vertex()
+                self.connecting = True
+            loading.join()
+            step = self.startup_step("state", step)
             """
-            Set up MQTT Helper
+            Set up BACnet and MQTT Helpers
             """
-            self.mqtt_helper = MqttParseHelper(self.gateway, self.bacnet, self.logger, self.config_file_helper,
-                                               self.client)
+            self.setup_helpers()
+            step = self.startup_step("points", step)
+
+            if identity:
+                # Trusted for the startup, checked against the controller once the gateway runs
+                schedule.every(IDENTITY_CHECK_SECONDS).seconds.do(
+                    self.verify_identity, model_name, serial_number).tag('identity')
+            else:
+                self.save_identity(model_name, serial_number)
 
             self.init_completed = True
+            self.startup["total"] = time.monotonic() - started
+            self.logger.message("Startup in %.2f s (%s)", self.startup["total"],
+                                ", ".join(f"{name} {seconds:.2f} s" for name, seconds in self.startup.items()
+                                          if name != "total"))
         except Exception as error:
             self.logger.error(f"Main| {error}")
             return
+        finally:
+            self.ready.set()
+
+    def setup_runtime(self):
+        """
+        State shared with the paho and bntest threads, set before anything can call back
+        """
+        self.init_completed = False
+        self.topic_to_send_for_light = 0
+        # Set once the handlers of MQTT messages can run, the brokers are connected before that
+        self.ready = threading.Event()
+        self.connecting = False
+        # Set by a discovery that changed the registry, points, saved registry and subscriptions follow in the
+        # main loop, so bntest and the BacnetHelper state are only used from it
+        self.points_changed = False
+        # Seconds of each startup step
+        self.startup = dict()
+        # Filled by the paho and bntest threads, taken by the main loop
+        self.payload_for_bacnet = SwapBuffer()
+        self.payload_from_bacnet = SwapBuffer()
+        self.cov_from_bacnet = SwapBuffer()
+        # Stage latencies, enabled from the settings file
+        self.tracer = Tracer()
+        # Trace CSV object found by its name (ex: CSV3900001)
+        self.trace_reference = None
+        self.register_topics()
+
+    def setup_dispatcher(self):
+        """
+        Main loop wake-up and queue sizes, from the settings
+        """
+        self.dispatcher = Dispatcher(self.logger, self.config_file_helper.configuration_batch_window_ms)
+        self.payload_for_bacnet.capacity = self.config_file_helper.configuration_queue_capacity
+        self.payload_from_bacnet.capacity = self.config_file_helper.configuration_queue_capacity
+        self.cov_from_bacnet.capacity = self.config_file_helper.configuration_queue_capacity
+        schedule.every(60).seconds.do(self.report).tag('dispatcher')
+        self.tracer.enabled = self.config_file_helper.configuration_trace
+        schedule.every(self.config_file_helper.configuration_trace_interval).seconds.do(
+            self.dump_trace).tag('trace')
+
+    def setup_brokers(self, client_name):
+        """
+        One client, or one client per Vertex broker in multi-broker mode
+        """
+        self.brokers = BrokerPool(client_name, self.logger, self.config_file_helper,
+                                  VERTEX_MQTT_USERNAME, VERTEX_MQTT_PASSWORD,
+                                  multi_broker=self.config_file_helper.configuration_multi_broker)
+        self.brokers.message_callback = self.on_message
+        self.brokers.connect_callback = self.on_connect
+        self.brokers.disconnect_callback = self.on_disconnect
+
+    def setup_gateway(self, serial_number):
+        self.gateway.setConfiguration(self.config_file_helper.configuration_license,
+                                      self.config_file_helper.vertex_ip_vertex,
+                                      max_vertex=self.config_file_helper.vertex_max_vertex,
+                                      max_points=self.config_file_helper.vertex_max_bacnet_points,
+                                      use_tags=self.config_file_helper.configuration_use_tags,
+                                      serial_number=serial_number,
+                                      )
+
+    def setup_helpers(self):
+        """
+        BACnet and MQTT helpers, once the registry is loaded
+        """
+        self.bacnet_helper = BacnetHelper(self.gateway, self.bacnet, self.logger, self.config_file_helper,
+                                          self.tracer)
+        if self.config_file_helper.configuration_use_auto_create:
+            self.bacnet_helper.seed_known_objects()
+        if self.config_file_helper.configuration_use_cov:
+            self.bacnet.register_cov_callback(self.cov_callback)
+            self.subscribe_cov()
+            schedule.every(COV_RENEW_SECONDS).seconds.do(self.subscribe_cov).tag('cov', 'bacnet')
+        self.mqtt_helper = MqttParseHelper(self.gateway, self.bacnet, self.logger, self.config_file_helper,
+                                           self.brokers, self.bacnet_helper)
+
+    def startup_step(self, name, started):
+        now = time.monotonic()
+        self.startup[name] = now - started
+        return now
+
+    def load_gateway(self):
+        try:
+            if self.state_store.load(self.gateway):
+                self.logger.message(f"Load configuration from database")
+            else:
+                self.logger.message(f"Generate configuration")
+        except Exception as error:
+            self.logger.error(f"Loading configuration failed: {error}")
+
+    def read_identity(self):
+        """
+        Model name and serial number of the controller, in one request
+        """
+        response = self.bacnet.read([f'DEV{self.device}.Model_Name', f'DEV{self.device}.Serial_Number'])
+        identity = dict()
+        for key in response:
+            identity[key.split('.')[-1].lower()] = response[key]
+        return identity.get("model_name"), identity.get("serial_number")
+
+    def verify_identity(self, model_name, serial_number):
+        """
+        Scheduled once: read the identity from the controller and compare it with the cached one the startup used.
+        A changed serial number is checked against the license again.
+        """
+        try:
+            read_model_name, read_serial_number = self.read_identity()
+        except Exception as error:
+            self.logger.debug("Reading identity failed, tried again: %s", error)
+            return None
+        if (read_model_name, read_serial_number) != (model_name, serial_number):
+            self.logger.warn(f"Controller identity changed to {read_model_name} {read_serial_number}, "
+                             f"the MQTT client name follows with the next start")
+            self.gateway.serial_number = read_serial_number
+            if not self.gateway.licenseIsValid():
+                self.logger.error("License is not valid for this controller, disconnecting from Vertex")
+                self.brokers.disconnect()
+        self.save_identity(read_model_name, read_serial_number)
+        return schedule.CancelJob
+
+    def save_identity(self, model_name, serial_number):
+        """
+        Cache what the next start would read again, the settings object reference spares its search by name
+        """
+        try:
+            self.state_store.saveIdentity({
+                "device": self.device,
+                "site": self.site,
+                "model_name": model_name,
+                "serial_number": serial_number,
+                "settings_reference": self.config_file_helper.getSettingsReference(),
+            })
+        except Exception as error:
+            self.logger.debug("Saving identity cache failed: %s", error)
+
+    def register_topics(self):
+        """
+        Bind the subscribed MQTT topics to their handlers
+        """
+        self.router = TopicRouter()
+        # Discovery answers are decoded only if they differ from the previous ones
+        self.router.register("discovery/edges", self.on_edges, raw=True)
+        self.router.register("discovery/devices", self.on_devices, raw=True)
+        self.router.register("discovery/groups", self.on_groups, raw=True)
+        self.router.register("vertex3/light/+/state", self.on_all_light, kind=LIGHT)
+        self.router.register("vertex3/light/+/+/state", self.on_individual_light, kind=LIGHT)
+        self.router.register("vertex3/group/+/feedback/state", self.on_group_feedback, kind=GROUP_FEEDBACK)
+        self.router.register("vertex3/sensor/+/+/+/state", self.on_sensor, kind=SENSOR)
+        self.router.register("vertex3/button/+/+/+/state", self.on_button, kind=BUTTON)
+        self.mqtt_topics = self.router.subscriptions()
 
     def init_completed(self):
         return self.init_completed
@@ -177,20 +344,61 @@ class Main:
                 ref = str(cref_input).split('.')[-2]
                 ref_back = ref[:4] + "0" + ref[5:]
 
+                # The command comes with the COV notification of a subscribed object
+                if self.bacnet_helper.cov_subscribed(ref):
+                    return
+
                 if self.gateway.getIdFromInstance(ref_back) is None:
                     return
-                self.payload_from_bacnet.append(f"{ref}.Present_Value")
-                self.payload_from_bacnet.append(f"{ref}.Description")
-                self.counter_for_bacnet = 0
+                self.payload_from_bacnet.put(f"{ref}.Present_Value")
+                self.payload_from_bacnet.put(f"{ref}.Description")
+                if self.tracer.enabled:
+                    self.tracer.queued(GROUP_COMMAND if ref[3] == '1' else LIGHT_COMMAND, time.monotonic())
+                self.dispatcher.notify()
 
         except Exception as error:
             self.logger.error(f"Error processing alarm: {error}")
 
-    def dump_gateway(self):
-        with open(join(pathfile, 'config/gateway.pickle'), 'wb') as handle:
-            pickle.dump(self.gateway, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    def cov_callback(self, cov_notification):
+        """
+        COV callback, the notification carries the new Present_Value of a command object
+        """
+        try:
+            ref = str(cov_notification.getreference()).split('.')[-2].lower()
+            if not (ref[4] == '1'):
+                return
+            ref_back = ref[:4] + "0" + ref[5:]
+
+            if self.gateway.getIdFromInstance(ref_back) is None:
+                return
+            self.cov_from_bacnet.put(ref, cov_notification.getvalue())
+            if self.tracer.enabled:
+                self.tracer.queued(GROUP_COMMAND if ref[3] == '1' else LIGHT_COMMAND, time.monotonic())
+            self.dispatcher.notify()
 
-        self.logger.message(f"Saving configuration to database")
+        except Exception as error:
+            self.logger.error(f"Error processing COV notification: {error}")
+
+    def subscribe_cov(self):
+        """
+        (Re)subscribe to the command objects, alarms stay the source of commands of the objects not subscribed
+        """
+        failed = self.bacnet_helper.subscribe_commands(self.config_file_helper.configuration_cov_lifetime)
+        if failed:
+            self.logger.warn(f"COV subscription of {failed} command objects failed, commands are received with alarms")
+
+    def update_points(self):
+        """
+        Points, saved registry and subscriptions of a registry changed by discovery
+        """
+        self.bacnet_helper.create_bacnet_points()
+        self.dump_gateway()
+        if self.config_file_helper.configuration_use_cov:
+            self.subscribe_cov()
+
+    def dump_gateway(self):
+        if self.state_store.save(self.gateway):
+            self.logger.message(f"Saving configuration to database")
 
     def run(self):
         pass
@@ -201,78 +409,142 @@ class Main:
 
         # schedule.every(1).seconds.do(self.receive_alarm_and_sending_to_vertex)
 
-        self.connect_to_vertex()
+        if not self.connecting:
+            self.connect_to_vertex()
         """
         Loop Forever
         """
         while True:
+            self.process()
 
-            try:
-                # Run any pending tasks, if there are any.  Try/Catch so that we do not break
-                # the scheduler if there are any exceptions in any running task
-                if self.counter_for_run > 8:
-                    schedule.run_pending()
-                    self.counter_for_run = 0
-
-            except Exception as error:
-                self.logger.error(f"ERR: Error running scheduled events - {error}")
-
-            if self.counter_for_bacnet > 9999:
-                self.counter_for_bacnet = 1000
-            if self.counter_for_mqtt > 9999:
-                self.counter_for_mqtt = 1000
-
-            if self.counter_for_bacnet == self.config_file_helper.configuration_sending_time_ms:
-
-                if len(self.payload_for_bacnet):
-                    self.bacnet_helper.write(self.payload_for_bacnet)
-                    self.payload_for_bacnet = {}
-
-                if len(self.payload_from_bacnet):
-                    list = self.bacnet_helper.read(self.payload_from_bacnet)
-
-                    if len(list[0]):
-                        self.payload_for_mqtt.append(list[0])
-                        self.counter_for_mqtt = 0
+    def process(self):
+        """
+        One pass of the main loop
+        """
+        # Sleep until a producer queues work or a scheduled task is due
+        started = self.dispatcher.wait()
 
-                    if not list[1] is None:
-                        if len(list[1]):
-                            for i in list[1]:
-                                self.payload_for_bacnet[i] = list[1][i]
-                                self.counter_for_bacnet = 0
+        try:
+            # Run any pending tasks, if there are any.  Try/Catch so that we do not break
+            # the scheduler if there are any exceptions in any running task
+            schedule.run_pending()
+        except Exception as error:
+            self.logger.error(f"ERR: Error running scheduled events - {error}")
 
-                    self.payload_from_bacnet = []
+        self.flush()
+        self.dispatcher.done(started)
 
-            if self.counter_for_mqtt == self.config_file_helper.configuration_sending_time_ms:
-                self.mqtt_helper.write(self.payload_for_mqtt)
-                self.payload_for_mqtt = []
+    def flush(self):
+        """
+        Send queued work to BACnet and Vertex
+        """
+        self.tracer.begin()
+        if self.points_changed:
+            self.points_changed = False
+            self.update_points()
+        self.bacnet_helper.flush_creates()
+
+        payload_for_bacnet = self.payload_for_bacnet.take()
+        if len(payload_for_bacnet) or len(self.bacnet_helper.retry):
+            with self.tracer.stage(TO_BACNET, WRITE):
+                self.bacnet_helper.write(payload_for_bacnet)
+
+        payload_from_bacnet = self.payload_from_bacnet.take()
+        # COV notifications carry the value, no read needed for them
+        cov_from_bacnet = self.cov_from_bacnet.take()
+        if len(payload_from_bacnet) or len(cov_from_bacnet):
+            with self.tracer.stage(TO_VERTEX, READ):
+                resets = self.bacnet_helper.read(list(payload_from_bacnet), cov_from_bacnet)
+
+            if resets is not None and len(resets):
+                for i in resets:
+                    self.payload_for_bacnet[i] = resets[i]
+                # Reset writes go out with the next pass
+                self.dispatcher.notify()
+
+        if len(self.bacnet_helper.outbox) and self.brokers.is_connected():
+            with self.tracer.stage(TO_VERTEX, PUBLISH):
+                self.mqtt_helper.write(self.bacnet_helper.outbox)
+        self.tracer.end()
+
+    def report(self):
+        """
+        Log dispatch latency and queue statistics
+        """
+        self.dispatcher.report()
+        self.logger.debug("Queue to BACnet: %s", self.payload_for_bacnet.stats())
+        self.logger.debug("Queue from BACnet: %s", self.payload_from_bacnet.stats())
+        self.logger.debug("Queue COV from BACnet: %s", self.cov_from_bacnet.stats())
+        self.logger.debug("Commands to Vertex: %s", self.bacnet_helper.outbox.stats())
+        self.logger.debug("Published to Vertex: %s", self.brokers.stats())
+
+    def dump_trace(self):
+        """
+        Save the stage latencies to config/trace.json and to the trace CSV object.
+        Tracing follows the settings file, so it can be turned on and off without a restart.
+        """
+        self.tracer.enabled = bool(self.config_file_helper.configuration_trace)
+        if not self.tracer.enabled:
+            return
+        try:
+            self.tracer.dump(join(pathfile, 'config/trace.json'))
+        except Exception as error:
+            self.logger.debug("Saving trace file failed: %s", error)
 
-            self.counter_for_mqtt += 1
-            self.counter_for_bacnet += 1
-            self.counter_for_run += 1
+        report = json.dumps(self.tracer.snapshot()["kinds"])
+        try:
+            if self.trace_reference is None:
+                self.trace_reference = self.bacnet.find_object_by_name(TRACE_FILE_NAME, obj_type="CSV",
+                                                                       device=self.device)
+            if self.trace_reference is None:
+                self.create_trace_object(report)
+                return
+            results = self.bacnet.write({f'{self.trace_reference}.Relinquish_Default': report})
+            if list(results.values()) != ['OK']:
+                # Deleted or renamed, searched by name again with the next dump
+                self.trace_reference = None
+                self.logger.debug("Saving trace object failed: %s", results)
+        except Exception as error:
+            self.trace_reference = None
+            self.logger.debug("Saving trace object failed: %s", error)
 
-            # Sleep for some time to not eat up CPU cycles
-            time.sleep(0.1)
+    def create_trace_object(self, report):
+        """
+        First dump, no object has the trace name yet. An object already at TRACE_OBJECT makes the creation fail,
+        it is never written.
+        """
+        results = self.bacnet.write({f'{TRACE_OBJECT}.Name': TRACE_FILE_NAME,
+                                     f'{TRACE_OBJECT}.Relinquish_Default': report},
+                                    request_type=bntest.OBJECT_CREATE)
+        if all(value == 'OK' for value in results.values()):
+            self.trace_reference = TRACE_OBJECT
+        else:
+            self.logger.debug("Creating trace object failed: %s", results)
 
-    def trigger_discovery(self):
-        topic_number = self.topic_to_send
+    def trigger_discovery(self, connection=None):
+        """
+        Request the next discovery step from a broker, by default the one whose answer is being handled
+        """
+        if connection is None:
+            connection = self.brokers.current or self.brokers.connections[0]
+        topic_number = connection.topic_to_send
 
         if topic_number == 0:
             topic = "discovery/edges/detect"
-            self.topic_to_send += 1
+            connection.topic_to_send += 1
         elif topic_number == 1:
             topic = "discovery/devices/detect"
-            self.topic_to_send += 1
+            connection.topic_to_send += 1
         elif topic_number == 2:
             topic = "discovery/groups/detect"
-            self.topic_to_send += 1
+            connection.topic_to_send += 1
         else:
             topic = "discovery/edges/detect"
-            self.topic_to_send = 0
+            connection.topic_to_send = 0
 
         self.logger.debug(f"Sending init message: {topic_number} | {topic}")
         msg = '{"detect": true}'
-        self.client.publish(topic, msg)
+        connection.publish(topic, msg)
 
     def trigger_light(self):
         if self.topic_to_send_for_light == len(self.gateway.vertex):
@@ -283,133 +555,86 @@ class Main:
         self.logger.debug(f"Sending init message: {uid} | {topic}")
         msg = '{"detect": true}'
         if self.topic_to_send_for_light < len(self.gateway.vertex):
-            self.client.publish(topic, msg)
+            self.brokers.connection_for(uid).publish(topic, msg)
             self.topic_to_send_for_light += 1
         else:
             self.topic_to_send_for_light = 0
 
     def on_message(self, client, userdata, message):
-        # Parsing, splitting JSON
+        # Brokers connected during the startup wait for the registry and the helpers
+        self.ready.wait()
+        # Routing, topics without a handler are dropped before JSON decoding
         try:
-            raw_value = message.payload.decode("utf-8")
-            if not (len(raw_value)):
-                return
-            self.logger.debug(f"Receiving messages from topic: {message.topic}")
-            josn_value = json.loads(raw_value)
-            split_topic = message.topic.split("/")
-
-            # Checking if topic is discovery/edges, if is, do function and finish
-            if len(split_topic) == 2 and message.topic == "discovery/edges":
-                self.mqtt_helper.edges(josn_value, self.config_file_helper.vertex_uid_vertex,
-                                       self.config_file_helper.vertex_max_vertex)
-                self.trigger_discovery()
-                return
-
-            # Checking if topic is discovery/devices, if is, do function and finish
-            if len(split_topic) == 2 and message.topic == "discovery/devices":
-                self.mqtt_helper.devices(josn_value)
-                self.trigger_discovery()
-                return
-
-            # Checking if topic is discovery/groups, if is, do function and finish
-            if len(split_topic) == 2 and message.topic == "discovery/groups":
-                self.mqtt_helper.groups(josn_value)
-                self.topic_to_send += 1
-                self.bacnet_helper.create_bacnet_points()
-                self.dump_gateway()
-                self.trigger_light()
-                return
-
-            # Checking if topic is vertex3/light/+/state, if is, do function and finish
-            if (len(split_topic) == 4 and split_topic[0] == "vertex3" and split_topic[1] == "light"
-                    and split_topic[3] == "state"):
-                self.mqtt_helper.all_light(josn_value, self.payload_for_bacnet)
-                self.counter_for_bacnet = 0
-                self.trigger_light()
-                return
-
-            # Checking if topic is vertex3/light/+/+/state, if is, do function and finish
-            if (len(split_topic) == 5 and split_topic[0] == "vertex3" and split_topic[1] == "light"
-                    and split_topic[4] == "state"):
-                self.mqtt_helper.individual_light(split_topic[2], split_topic[3], josn_value,
-                                                  self.payload_for_bacnet)
-                self.counter_for_bacnet = 0
-                return
-
-            # Checking if topic is vertex3/group/+/feedback/state, if is, do function and finish
-            if (len(split_topic) == 5 and split_topic[0] == "vertex3" and split_topic[1] == "group"
-                    and split_topic[3] == "feedback" and split_topic[4] == "state"):
-                self.mqtt_helper.groups_feedback(split_topic[2], josn_value, self.payload_for_bacnet)
-                return
-
-            # Checking if topic is "vertex3/sensor/+/+/+/state", if is, do function and finish
-            if (len(split_topic) == 6 and split_topic[0] == "vertex3" and split_topic[1] == "sensor"
-                    and split_topic[5] == "state"):
-                self.mqtt_helper.individual_sensor(split_topic[2], split_topic[3], split_topic[4], josn_value,
-                                                   self.payload_for_bacnet)
-                self.counter_for_bacnet = 0
-                return
-
-            # Checking if topic is "vertex3/button/+/+/+/state", if is, do function and finish
-            if (len(split_topic) == 6 and split_topic[0] == "vertex3" and split_topic[1] == "button"
-                    and split_topic[5] == "state"):
-                self.mqtt_helper.individual_button(split_topic[2], split_topic[3], split_topic[4], josn_value,
-                                                   self.payload_for_bacnet)
-                self.counter_for_bacnet = 0
-                return
-
+            if self.tracer.enabled:
+                routed = self.router.dispatch(message.topic, message.payload, self.tracer, message.timestamp)
+            else:
+                routed = self.router.dispatch(message.topic, message.payload)
+            if routed:
+                self.logger.debug("Receiving messages from topic: %s", message.topic)
         except Exception as error:
             self.logger.error(f"On receiving message | Response parse error - {error}")
 
+    def on_edges(self, payload):
+        self.mqtt_helper.discovery("edges", payload, self.config_file_helper.vertex_uid_vertex,
+                                   self.config_file_helper.vertex_max_vertex)
+        self.trigger_discovery()
+
+    def on_devices(self, payload):
+        self.mqtt_helper.discovery("devices", payload)
+        self.trigger_discovery()
+
+    def on_groups(self, payload):
+        self.mqtt_helper.discovery("groups", payload)
+        if self.brokers.current is not None:
+            self.brokers.current.topic_to_send += 1
+        # Points, saved registry and subscriptions only follow a discovery that changed the registry
+        if self.mqtt_helper.take_changed():
+            self.points_changed = True
+            self.dispatcher.notify()
+        self.trigger_light()
+
+    def on_all_light(self, vertex_id, payload):
+        self.mqtt_helper.all_light(payload, self.payload_for_bacnet)
+        self.dispatcher.notify()
+        self.trigger_light()
+
+    def on_individual_light(self, vertex_id, dev_id, payload):
+        self.mqtt_helper.individual_light(vertex_id, dev_id, payload, self.payload_for_bacnet)
+        self.dispatcher.notify()
+
+    def on_group_feedback(self, group_id, payload):
+        self.mqtt_helper.groups_feedback(group_id, payload, self.payload_for_bacnet)
+        self.dispatcher.notify()
+
+    def on_sensor(self, vertex_id, dev_id, sensor_type, payload):
+        self.mqtt_helper.individual_sensor(vertex_id, dev_id, sensor_type, payload, self.payload_for_bacnet)
+        self.dispatcher.notify()
+
+    def on_button(self, vertex_id, dev_id, button, payload):
+        self.mqtt_helper.individual_button(vertex_id, dev_id, button, payload, self.payload_for_bacnet)
+        self.dispatcher.notify()
+
     def on_connect(self, client, userdata, flages, rc):
         self.quantity_of_connection_try = 0
         filesource = join(pathfile, 'config\MqttErrorCode.json')
         with open(filesource, encoding='utf-8') as f:
             data = json.loads(f.read())
             self.logger.debug(f"Connected with result: {data[f'{rc}']}")
-            self.trigger_discovery()
+            if rc == 0:
+                self.trigger_discovery(userdata)
 
     def on_disconnect(self, client, userdata, rc):
+        # The broker connection reconnects on its own
         filesource = join(pathfile, 'config\MqttErrorCode.json')
         with open(filesource, encoding='utf-8') as f:
             data = json.loads(f.read())
-            self.logger.message(f"Disconnected: {data[f'{rc}']}")
-            self.reconnect = schedule.every(10).seconds.do(self.reconnect_to_vertex)
+            self.logger.message(f"Disconnected {userdata.name}: {data[f'{rc}']}")
 
     def connect_to_vertex(self):
         """
-        Connect to Vertex broker
+        Start connecting to the Vertex brokers, the paho threads connect, subscribe and reconnect in the background
         """
-        quantity_vertex_ip = len(self.config_file_helper.vertex_ip_vertex)
-
-        if not (quantity_vertex_ip > self.vertex_ip_choose_during_reconnect):
-            self.vertex_ip_choose_during_reconnect = 0
-
-        ip_choose = self.vertex_ip_choose_during_reconnect
-        ip_vertex = self.config_file_helper.vertex_ip_vertex[ip_choose]
-
-        try:
-            self.logger.debug(f"Connecting to Vertex on IP: {ip_vertex} in progres")
-            self.client.username_pw_set(VERTEX_MQTT_USERNAME, VERTEX_MQTT_PASSWORD)
-            self.client.connect(ip_vertex, 1883, self.config_file_helper.vertex_timeout)
-            self.client.loop_start()  # start the loop
-            self.client.subscribe(self.mqtt_topics)
-            self.logger.message(f"✅ Connected to the Vertex device")
-            return True
-        except:
-            self.vertex_ip_choose_during_reconnect += 1
-            self.logger.error(f"Connection failed on ip: {ip_vertex}")
-            self.logger.debug(f"connect_to_vertex: {schedule.get_jobs('reconnect')}")
-            if not len(schedule.get_jobs('reconnect')):
-                self.reconnect = schedule.every(10).seconds.do(self.reconnect_to_vertex).tag('reconnect', 'vertex')
-            return False
-
-    def reconnect_to_vertex(self):
-        self.logger.debug("Another try to connect")
-        if self.connect_to_vertex():
-            schedule.cancel_job(self.reconnect)
-            self.logger.debug(f"reconnect_to_vertex: {schedule.get_jobs('reconnect')}")
-            self.logger.debug("Reconnect scheduler task ended")
+        self.brokers.connect(self.mqtt_topics)
 
 
 def parse_command_line_args():
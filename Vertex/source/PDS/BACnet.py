@@ -1,10 +1,16 @@
 import bntest
 import time
 import datetime
+import queue
+import threading
 from Delta.DeltaEmbedded import BACnetInterface
 
 DT_FORMAT = "%Y/%m/%d/%w %H:%M:%S"
+# TL records of the first batch, later batches are sized so one takes about READ_TL_BATCH_SECONDS
 READ_TL_BATCH_SIZE = 100
+READ_TL_MIN_BATCH_SIZE = 25
+READ_TL_MAX_BATCH_SIZE = 1000
+READ_TL_BATCH_SECONDS = 0.5
 
 MANUAL_OVERRIDE_WRITE_PRIORITY = 10
 
@@ -20,6 +26,7 @@ class Interface:
         """
         self.__bacnet = BACnetInterface(user=user, password=password, site=site)
         self.__device = device
+        self.__cov_callbacks = []
 
     ##
     # Custom functions
@@ -28,7 +35,13 @@ class Interface:
         """
         Get (this) BACnet Server's Address
         """
-        return self.__bacnet.server.sitegetdevicenumber(self.__bacnet.user_key, self.__bacnet.site_name)
+        return self.__bacnet.get_site_device()
+
+    def reopen_site(self):
+        """
+        Reopen the site, resolved site identity is loaded again on the next request
+        """
+        self.__bacnet.open_site()
 
     def __get_device_reference(self):
         """
@@ -40,9 +53,7 @@ class Interface:
         if self.__device:
             return "{deviceref}.DEV{devicenum}".format(deviceref=self.__device, devicenum=self.__device)
         else:
-            return "DEV{devicenum}".format(
-                devicenum=self.__bacnet.sitegetdevicenumber(self.__bacnet.user_key, self.__bacnet.site_name)
-            )
+            return "DEV{devicenum}".format(devicenum=self.__bacnet.get_site_device())
 
     def register_alarm_callback(self, callback_function):
         """
@@ -53,10 +64,30 @@ class Interface:
 
     def register_cov_callback(self, callback_function):
         """
-        Register for a COV callback
+        Register for a COV callback, every registered callback receives every notification
+        """
+        if not len(self.__cov_callbacks):
+            # Registered with bnserver once, a failed registration is tried again by the next caller
+            self.__bacnet.server.setcovnotificationcallback(self.__on_cov)
+            self.__bacnet.server.registerforcovnotification(self.__bacnet.user_key, self.__bacnet.site_name)
+        self.__cov_callbacks.append(callback_function)
+
+    def __on_cov(self, cov_notification):
+        for callback_function in self.__cov_callbacks:
+            callback_function(cov_notification)
+
+    def subscribe_cov(self, object_reference, lifetime):
+        """
+        Subscribe to the COV notifications of an object (ex: AV3011001), lifetime in seconds
         """
-        self.__bacnet.server.setcovnotificationcallback(callback_function)
-        self.__bacnet.server.registerforcovnotification(self.__bacnet.user_key, self.__bacnet.site_name)
+        c_ref = bntest.creference()
+        c_ref.parsereference(
+            "//{site}/{ref_prop}".format(site=self.__bacnet.site_name,
+                                         ref_prop=self.__fill_in_reference(object_reference + ".Present_Value")),
+            bntest.LANGUAGE_ID_ENGLISH,
+            self.__bacnet.user_key
+        )
+        self.__bacnet.server.subscribecov(self.__bacnet.user_key, c_ref, lifetime)
 
     def reconfirm_device(self, device):
         """
@@ -78,19 +109,7 @@ class Interface:
         """
         Send a UTC Time Sync based on the provided date_time
         """
-        time_date_dict = {
-            "Year": int(date_time.strftime("%Y")),
-            "Month": int(date_time.strftime("%m")),
-            "Day": int(date_time.strftime("%d")),
-            "Hour": int(date_time.strftime("%H")),
-            "Minute": int(date_time.strftime("%M")),
-            "Seconds": int(date_time.strftime("%S")),
-            "Hundredths": 0,
-            "Weekday": int(date_time.strftime("%w"))
-        }
-
-        b_datetime = bntest.ctimedate()
-        b_datetime.build(time_date_dict)
+        b_datetime = self.__ctimedate(date_time)
 
         return self.__bacnet.server.sendutctimesync(
             self.__bacnet.user_key, self.__bacnet.site_name, device, b_datetime, True
@@ -104,76 +123,145 @@ class Interface:
 
         self.__bacnet.server.reinitializedevice(self.__bacnet.user_key, devref, bntest.REINITDEV_COLDSTART)
 
+    @staticmethod
+    def __ctimedate(date_time):
+        """
+        BACnet date and time of a datetime, the weekday counts from Sunday = 0 like strftime %w
+        """
+        b_datetime = bntest.ctimedate()
+        b_datetime.build({
+            "Year": date_time.year,
+            "Month": date_time.month,
+            "Day": date_time.day,
+            "Hour": date_time.hour,
+            "Minute": date_time.minute,
+            "Seconds": date_time.second,
+            "Hundredths": 0,
+            "Weekday": (date_time.weekday() + 1) % 7
+        })
+        return b_datetime
+
     def read_tl_by_date_range(self, tl_ref, start_date, end_date, type=None):
         """
         Read TL data from a tl_ref between the start and end date and return the data
         """
+        return list(self.iter_tl_by_date_range(tl_ref, start_date, end_date, type, prefetch=False))
+
+    def iter_tl_by_date_range(self, tl_ref, start_date, end_date, type=None, prefetch=False):
+        """
+        Yield the TL records (datetime, type, value) of a tl_ref between the start and end date as they are read,
+        so a long range never has to fit in memory.  With prefetch the next batch is read in a thread while
+        the current one is consumed, only for callers that make no other bntest request meanwhile since bntest
+        is not known to be thread safe.
+        """
 
         if isinstance(type, str):
             type = [type]
 
-        tl_data = list()
-        exceeded_end = False
+        batches = self.__tl_batches(tl_ref, start_date, end_date)
+        if prefetch:
+            batches = self.__prefetch(batches)
+
+        try:
+            for data in batches:
+                for item in data:
+                    # Check if we're past our end date
+                    if item[0] > end_date:
+                        return
+
+                    # Skip if it's not in our type filter
+                    if type and item[1] not in type:
+                        continue
+
+                    yield item
+        finally:
+            batches.close()
+
+    def __tl_batches(self, tl_ref, start_date, end_date):
+        """
+        Read the batches of TL records from start_date until the end date or the end of the data
+        """
+        tl_ref_buffer = self.__fill_in_reference(tl_ref + ".Log_Buffer")
+        batch_size = READ_TL_BATCH_SIZE
 
         while True:
             c_ref = bntest.creference()
-            tl_ref_buffer = self.__fill_in_reference(tl_ref + ".Log_Buffer")
-
             c_ref.parsereference(
                 "//{site}/{ref_prop}".format(site=self.__bacnet.site_name, ref_prop=tl_ref_buffer),
                 bntest.LANGUAGE_ID_ENGLISH,
                 self.__bacnet.user_key
             )
 
-            data = self.__get_tl_batch(c_ref, start_date)
+            started = time.monotonic()
+            data = self.__get_tl_batch(c_ref, start_date, batch_size)
+            elapsed = time.monotonic() - started
 
             if len(data) == 0:
                 # No data
-                break
-
-            # Iterate over the data, checking types as needed
-            for item in data:
-                # Update our start date
-                start_date = item[0]
-
-                # Skip if it's not in our type filter
-                if type and item[1] not in type:
+                return
+            yield data
+
+            if data[-1][0] > end_date or len(data) != batch_size:
+                # Past our "end date", or read less than the batch size so we must be at the "end" of the data
+                return
+            if data[-1][0] <= start_date:
+                # The next batch would start at the same record again
+                raise Exception("More than {count} records at {dt} in {ref}".format(
+                    count=batch_size, dt=start_date, ref=tl_ref))
+
+            # Next batch starts at the last record read
+            start_date = data[-1][0]
+            if elapsed < READ_TL_BATCH_SECONDS / 2:
+                batch_size = min(batch_size * 2, READ_TL_MAX_BATCH_SIZE)
+            elif elapsed > READ_TL_BATCH_SECONDS:
+                batch_size = max(batch_size // 2, READ_TL_MIN_BATCH_SIZE)
+
+    @staticmethod
+    def __prefetch(batches):
+        """
+        Read batches in a thread, at most one batch ahead of the consumer
+        """
+        ready = queue.Queue(maxsize=1)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
                     continue
+            return False
 
-                # Check if we're past our end date
-                if item[0] > end_date:
-                    exceeded_end = True
-                    break
-
-                # If it's a valid type and within our range, add it to our tl_data
-                tl_data.append(item)
-
-            if exceeded_end:
-                # We've gone past our requested "end date"
-                break
-
-            if len(data) != READ_TL_BATCH_SIZE:
-                # Read less than the batch size, so we must be at the "end" of the data
-                break
-
-        return tl_data
+        def produce():
+            try:
+                for data in batches:
+                    if not put((data, None)):
+                        return
+                put((None, None))
+            except Exception as error:
+                put((None, error))
+
+        thread = threading.Thread(target=produce, name="tl_prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                data, error = ready.get()
+                if error is not None:
+                    raise error
+                if data is None:
+                    return
+                yield data
+        finally:
+            stop.set()
+            thread.join()
 
     def __get_tl_batch(self, c_ref, start_dt, batch_size=READ_TL_BATCH_SIZE):
         """
         Get a batch of TL records
         """
 
-        start_ctimedate = bntest.ctimedate()
-        start_ctimedate.build({
-            "Year": int(start_dt.strftime("%Y")),
-            "Month": int(start_dt.strftime("%m")),
-            "Day": int(start_dt.strftime("%d")),
-            "Hour": int(start_dt.strftime("%H")),
-            "Minute": int(start_dt.strftime("%M")),
-            "Seconds": int(start_dt.strftime("%S")),
-            "Hundredths": 0,
-            "Weekday": int(start_dt.strftime("%w"))
-        })
+        start_ctimedate = self.__ctimedate(start_dt)
 
         prop_list = bntest.cpropertylist()
         prop_list.addrangebytime(c_ref, start_ctimedate, batch_size)
@@ -1,14 +1,19 @@
 import json
+import time
 import PDS
 from .Log import *
 
+# Lifetime of the COV subscription of a configuration object, in seconds
+COV_LIFETIME = 300
+
 
 class _CSVConfigObject:
     """
     A Configuration Object, referencing a BACnet CSV object.
     """
 
-    def __init__(self, object_name, bacnet_interface, logger, defaults_path=None, change_callback=None, device=None):
+    def __init__(self, object_name, bacnet_interface, logger, defaults_path=None, change_callback=None, device=None,
+                 obj_ref=None):
         """
         Create the configuration object.
 
@@ -18,6 +23,7 @@ class _CSVConfigObject:
         :param defaults_path: Location of a JSON file that contains the default value for this object
         :param change_callback: Can be provided a callable function to execute when this configuration item has changed.
         :param device: Device parameter (if not local).
+        :param obj_ref: Reference found by an earlier run (ex: CSV3900000), used if the object still has this name.
 
         :return: None
         """
@@ -39,18 +45,11 @@ class _CSVConfigObject:
         self.__object_name = object_name
         self.__logger.debug(f"Initializing Configuration Object {self.__object_name}")
 
-        if self.__device is None:
-            self.__obj_ref = self.__bacnet_interface.find_object_by_name(
-                obj_name=self.__object_name,
-                obj_type="CSV"
-            )
-        else:
-            self.__obj_ref = self.__bacnet_interface.find_object_by_name(
-                obj_name=self.__object_name,
-                obj_type="CSV",
-                device=self.__device
-            )
-
+        self.__obj_ref = None
+        if obj_ref is not None and self.__has_name(obj_ref):
+            self.__obj_ref = obj_ref
+        if self.__obj_ref is None:
+            self.__obj_ref = self.__resolve()
         if self.__obj_ref is None:
             raise Exception("Configuration object {obj} could not be found".format(
                 obj=self.__object_name))
@@ -62,24 +61,88 @@ class _CSVConfigObject:
 
         self.__data = json.loads(self.__obj_value)
 
-    def check_for_update(self, skip_callbacks=False):
+        # COV subscription, while it is active the object is only read after a notification
+        self.__cov_subscribed = None
+        self.__changed = True
+        self.__subscribe()
+
+    def __resolve(self):
         """
-        Read the object from BACnet to determine if it has changed.
+        Find the object reference (ex: CSV3900000) by name with a descriptor search.
 
-        :return: None
+        :return: String the reference or None if not found
         """
         if self.__device is None:
-            obj_ref = self.__bacnet_interface.find_object_by_name(
+            return self.__bacnet_interface.find_object_by_name(
                 obj_name=self.__object_name,
                 obj_type="CSV"
             )
-        else:
-            obj_ref = self.__bacnet_interface.find_object_by_name(
-                obj_name=self.__object_name,
-                obj_type="CSV",
-                device=self.__device
-            )
+        return self.__bacnet_interface.find_object_by_name(
+            obj_name=self.__object_name,
+            obj_type="CSV",
+            device=self.__device
+        )
+
+    def __has_name(self, obj_ref):
+        """
+        Check with a property read that an object is still the one with our name, no descriptor search.
+
+        :return: bool
+        """
+        try:
+            return self.__bacnet_interface.read_value(obj_ref + ".object_name") == self.__object_name
+        except Exception as error:
+            self.__logger.debug(f"Reading {obj_ref} failed: {error}")
+            return False
+
+    def reference(self):
+        """
+        Resolved object reference (ex: CSV3900000)
+        """
+        return self.__obj_ref
 
+    def __subscribe(self):
+        """
+        Subscribe to the COV of the object, the object is polled if COV is not available.
+        """
+        # A remote device reference would need the device in the subscription, poll those
+        if self.__device is not None:
+            return
+        try:
+            if self.__cov_subscribed is None:
+                self.__bacnet_interface.register_cov_callback(self.__on_cov)
+            self.__bacnet_interface.subscribe_cov(self.__obj_ref, COV_LIFETIME)
+            self.__cov_subscribed = time.monotonic()
+        except Exception as error:
+            self.__cov_subscribed = 0
+            self.__logger.debug(f"COV not available for {self.__object_name}, polling it: {error}")
+
+    def __on_cov(self, cov_notification):
+        """
+        COV callback (bntest thread), mark the object to be read with the next check.
+        """
+        try:
+            obj = str(cov_notification.getreference()).split('.')[-2]
+            if obj.lower() == self.__obj_ref.lower():
+                self.__changed = True
+        except Exception as error:
+            self.__logger.debug(f"COV notification of {self.__object_name}: {error}")
+
+    def __read(self):
+        """
+        Read the present value with the known reference, the object is searched by name again only if the read fails.
+
+        :return: String the present value
+        """
+        try:
+            obj_value = self.__bacnet_interface.read_value(self.__obj_ref + ".present_value")
+            # A failed property read returns its error status (ex: QERR_CLASS_OBJECT::QERR_CODE_UNKNOWN_OBJECT)
+            if obj_value is not None and not str(obj_value).startswith('QERR'):
+                return obj_value
+        except Exception as error:
+            self.__logger.debug(f"Reading {self.__object_name} failed: {error}")
+
+        obj_ref = self.__resolve()
         if obj_ref is None:
             raise Exception("Configuration object {obj} could not be found".format(obj=self.__object_name))
 
@@ -87,9 +150,34 @@ class _CSVConfigObject:
         if obj_ref != self.__obj_ref:
             self.__logger.message("Config object changed: {} <> {}".format(obj_ref, self.__obj_ref))
             self.__obj_ref = obj_ref
+            if self.__cov_subscribed:
+                self.__subscribe()
+        return self.__bacnet_interface.read_value(self.__obj_ref + ".present_value")
+
+    def check_for_update(self, skip_callbacks=False):
+        """
+        Read the object from BACnet to determine if it has changed.
+        With COV the object is read only after a notification and when the subscription is renewed.
+
+        :return: None
+        """
+        if self.__cov_subscribed:
+            if time.monotonic() - self.__cov_subscribed > COV_LIFETIME / 2:
+                # Renew, read as well in case a notification was missed
+                self.__subscribe()
+                self.__changed = True
+            if not self.__changed:
+                return
+
+        # Cleared before the read, a notification received meanwhile is read with the next check
+        self.__changed = False
+        try:
+            obj_value = self.__read()
+        except Exception:
+            self.__changed = True
+            raise
 
         # Check if the configuration value has changed
-        obj_value = self.__bacnet_interface.read_value(self.__obj_ref + ".present_value")
         if obj_value != self.__obj_value:
             self.__obj_value = obj_value
             self.__data = json.loads(obj_value)
@@ -155,7 +243,7 @@ class CSVConfigManager:
 
         self.__logger = logger
 
-    def add(self, object_name, change_callback=None):
+    def add(self, object_name, change_callback=None, obj_ref=None):
         """
         Add a configuration item to the list (by object name)
 
@@ -163,6 +251,7 @@ class CSVConfigManager:
         :param change_callback: Can be provided a callable function to execute when this configuration item has
             changed.  The intent is to catch writes from outside of the integration, as the config manager assumes
             that internal writes will properly call CSVConfigManager.set for a configuration item.
+        :param obj_ref: Object reference cached from an earlier run, skips the search by name if it is still valid.
 
         :return: None
         """
@@ -175,9 +264,23 @@ class CSVConfigManager:
             logger=self.__logger,
             bacnet_interface=self.__bacnet_interface,
             change_callback=change_callback,
-            device=self.__device
+            device=self.__device,
+            obj_ref=obj_ref
         )
 
+    def reference(self, object_name):
+        """
+        Return the resolved object reference for a specified object_name.
+
+        :param object_name: The CSV object name.
+
+        :return: String the reference (ex: CSV3900000)
+        """
+        if object_name not in self.__items:
+            raise KeyError("Configuration object {obj} does not exist".format(obj=object_name))
+
+        return self.__items[object_name].reference()
+
     def get(self, object_name):
         """
         Return mapping data dictionary for a specified object_name.
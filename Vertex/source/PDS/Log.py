@@ -6,19 +6,22 @@ LEVEL_ERROR = 2
 LEVEL_MESSAGE = 3
 LEVEL_DEBUG = 4
 
+# Minimum number of seconds between two writes of the FIL description, errors are written at once
+FLUSH_INTERVAL = 5
+
 
 class Logger:
     """
     Wrapper for the LoadableModules Logger
     """
 
-    def __init__(self, fil_instance=None, level=LEVEL_ERROR):
+    def __init__(self, fil_instance=None, level=LEVEL_ERROR, flush_interval=FLUSH_INTERVAL):
         """
         Configure the logger
         """
         self.__level = level
         self.__fil_instance = fil_instance
-        self.__logger = LoadableModules.Logger(fil_instance=fil_instance)
+        self.__logger = LoadableModules.Logger(fil_instance=fil_instance, flush_interval=flush_interval)
 
     def set_level(self, level=LEVEL_ERROR):
         """
@@ -26,6 +29,12 @@ class Logger:
         """
         self.__level = level
 
+    def is_enabled(self, level):
+        """
+        Check if messages of a level are written with the current logging level
+        """
+        return level <= self.__level
+
     def write(self, message, level=LEVEL_MESSAGE):
         """
         Add an item to the log if applicable
@@ -35,51 +44,73 @@ class Logger:
             if self.__fil_instance is not None:
                 print(message)
 
-            # Add the message to the FIL log
-            self.__logger.log_status(message)
+            # Add the message to the FIL log, errors are written to BACnet immediately
+            self.__logger.log_status(message, flush=level == LEVEL_ERROR)
 
-    def debug(self, message):
+    def debug(self, message, *args):
         """
         Write a debug message
 
-        :param message:
+        :param message: Message, or %-format string formatted with args only if debug is enabled
         :return:
         """
+        if LEVEL_DEBUG > self.__level:
+            return
+        if args:
+            message = message % args
         if (self.__fil_instance is None):
             self.write(f"DBG: {message}", level=LEVEL_DEBUG)
         else:
             self.write(f"\033[33mDBG: {message}\033[0m", level=LEVEL_DEBUG)
 
-    def message(self, message):
+    def message(self, message, *args):
         """
         Write a regular message
 
-        :param message:
+        :param message: Message, or %-format string formatted with args only if messages are enabled
         :return:
         """
+        if LEVEL_MESSAGE > self.__level:
+            return
+        if args:
+            message = message % args
         self.write(f"MSG: {message}", level=LEVEL_MESSAGE)
 
-    def warn(self, message):
+    def warn(self, message, *args):
         """
         Write a Warning message
 
-        :param message:
+        :param message: Message, or %-format string formatted with args only if warnings are enabled
         :return:
         """
+        if LEVEL_WARN > self.__level:
+            return
+        if args:
+            message = message % args
         self.write(f"WRN: {message}", level=LEVEL_WARN)
 
-    def error(self, message):
+    def error(self, message, *args):
         """
         Write an error message
 
-        :param message:
+        :param message: Message, or %-format string formatted with args only if errors are enabled
         :return:
         """
+        if LEVEL_ERROR > self.__level:
+            return
+        if args:
+            message = message % args
         if (self.__fil_instance is None):
             self.write(f"ERR: {message}", level=LEVEL_ERROR)
         else:
             self.write(f"\033[31mERR: {message}\033[0m", level=LEVEL_ERROR)
 
+    def flush(self):
+        """
+        Write buffered log entries to the FIL object
+        """
+        self.__logger.flush()
+
     def clear(self):
         """
         Clear the log / remove all entries
@@ -1,62 +1,346 @@
 """
 
 """
+import time
+
 import bntest
+from helper.SwapBuffer import SwapBuffer
+from helper.CommandOutbox import CommandOutbox, GROUP, DEVICE
+from helper.Tracer import Tracer, TO_BACNET, TO_VERTEX, REQUEST
+
+# Properties holding a state, a write of the value they already hold can be skipped. Others are actions
+# (ex: Reset) sent every time.
+CACHED_PROPERTIES = ("present_value", "description", "units", "decimal_places", "name", "relinquish_default")
+# Seconds a written value is trusted, a value changed by an operator outside the gateway is written again after it
+WRITTEN_MAX_AGE = 300
+# Number of consecutive failed writes of a property before it is no longer retried automatically
+WRITE_RETRIES = 3
+# Number of objects read in one request when checking which points already exist
+SEED_CHUNK_SIZE = 200
+# Number of objects created in one OBJECT_CREATE request at most
+CREATE_CHUNK_SIZE = 100
+# Seconds between two COV renewal passes
+COV_RENEW_SECONDS = 5
+# Subscriptions made in one renewal pass at least, more when needed to renew every object within a quarter lifetime
+# (ex: 667 per pass for 10k command objects with a 300 s lifetime)
+COV_RENEW_BATCH = 200
+# Dali-2 devices (buttons, sensors) use a stride of 10 BACnet instances
+DALI2_TYPES = (2, 3)
+DALI2_STRIDE = 10
 
 
 class BacnetHelper:
 
-    def __init__(self, gateway, bacnet, logger, config):
+    def __init__(self, gateway, bacnet, logger, config, tracer=None):
         self.gateway = gateway
         self.bacnet = bacnet
         self.logger = logger
         self.config = config
-        self.group_set = dict()
-        self.device_set = []
+        self.tracer = tracer if tracer is not None else Tracer()
+        # Commands for Vertex waiting to be published, latest command per group or device
+        self.outbox = CommandOutbox(config.configuration_queue_capacity)
+        # Shadow of the last successfully written state per property, {reference.lower(): (value, monotonic time)}
+        self.written = dict()
+        # Failed writes waiting for the next flush, {reference: [value, attempts]}
+        self.retry = dict()
+        # Objects known to exist on the device, lowercase object ids (ex: av3000055)
+        self.known_objects = set()
+        # Objects whose creation failed, not requested again until forgotten
+        self.failed_objects = set()
+        # Creation requests waiting for the next flush, {object id: name}, filled from the paho thread
+        self.pending_create = SwapBuffer()
+        # Objects per OBJECT_CREATE request, halved when the device fails a request as a whole,
+        # doubled back after each successful one
+        self.create_chunk_size = CREATE_CHUNK_SIZE
+        # Last known group priority (Description) of command objects, {object (ex: av3110001): priority}
+        self.priority = dict()
+        # COV subscriptions of command objects, {object (ex: av3110001): monotonic time it expires}.
+        # Commands of the objects without a live subscription are received with alarms.
+        self.cov_expiry = dict()
 
     def create_bacnet_points(self):
+        """
+        Create the points of discovered devices and groups that are not known to exist yet
+        """
         if not self.config.configuration_use_auto_create:
             self.logger.message("Automatic point creation disabled")
             return
         self.logger.message("Automatic point creation enabled")
 
-        bacnet_queue = dict()
+        pending = dict()
+        for vertex in self.gateway.vertex:
+            for dev in vertex.devices:
+                obj = f'AV3{dev.dev_type}0{vertex.bacnet_instance}{dev.bacnet_instance:03}'
+                if obj.lower() not in self.known_objects and obj.lower() not in self.failed_objects:
+                    pending[obj] = f'VertexGateway_{vertex.id}_{dev.id}'
+            for group in vertex.groups:
+                obj = f'AV3{group.dev_type}0{vertex.bacnet_instance}{group.bacnet_instance:03}'
+                if obj.lower() not in self.known_objects and obj.lower() not in self.failed_objects:
+                    pending[obj] = f'VertexGateway_{vertex.id}_{group.id}'
+
+        if not len(pending):
+            self.logger.debug("All points exist")
+            return
+        self.create(pending)
 
+    def seed_known_objects(self):
+        """
+        Check in bulk which gateway points already exist, so messages never need an existence RPC
+        """
+        candidates = []
         for vertex in self.gateway.vertex:
             for dev in vertex.devices:
-                obj = f'AV3{dev.dev_type}0{vertex.bacnet_instance}{dev.bacnet_instance:03}.Name'
-                value = f'VertexGateway_{vertex.id}_{dev.id}'
-                bacnet_queue[obj] = value
+                offsets = range(DALI2_STRIDE) if dev.dev_type in DALI2_TYPES else range(1)
+                for offset in offsets:
+                    candidates.append(f'AV3{dev.dev_type}0{vertex.bacnet_instance}{dev.bacnet_instance + offset:03}')
             for group in vertex.groups:
-                obj = f'AV3{group.dev_type}0{vertex.bacnet_instance}{group.bacnet_instance:03}.Name'
-                value = f'VertexGateway_{vertex.id}_{group.id}'
-                bacnet_queue[obj] = value
+                candidates.append(f'AV3{group.dev_type}0{vertex.bacnet_instance}{group.bacnet_instance:03}')
+
+        for start in range(0, len(candidates), SEED_CHUNK_SIZE):
+            try:
+                response = self.bacnet.read([f'{obj}.Name' for obj in candidates[start:start + SEED_CHUNK_SIZE]])
+            except Exception as error:
+                self.logger.debug("Checking existing points failed: %s", error)
+                continue
+            for key in response:
+                value = response[key]
+                if value is not None and not str(value).startswith('QERR'):
+                    self.known_objects.add(self.__strip_device(key).split('.')[0])
+
+        self.logger.debug("%s of %s points exist", len(self.known_objects), len(candidates))
+
+    def object_exists(self, obj):
+        return obj.lower() in self.known_objects
+
+    def queue_create(self, obj, name):
+        """
+        Request creation of an object (ex: AV3200055) with the next flush
+        """
+        if obj.lower() in self.failed_objects:
+            self.logger.debug("Create point [%s] refused before, not requested again", obj)
+            return
+        self.pending_create[obj] = name
+
+    def flush_creates(self):
+        """
+        Create all queued objects
+        """
+        if not len(self.pending_create):
+            return
+        self.create(self.pending_create.take())
 
+    def create(self, pending):
+        """
+        Create objects {object id: name} in chunks, objects refused in a chunk are tried again one by one.
+        Only objects the device refuses are marked failed. When requests fail as a whole even for a single object
+        (ex: bnserver not available), the objects left are queued again for the next flush.
+        """
+        objects = list(pending)
+        created = 0
+        refused = []
+        deferred = []
+        chunk_size = self.create_chunk_size
+        position = 0
+        while position < len(objects):
+            chunk = objects[position:position + self.create_chunk_size]
+            status = self.__create_chunk(chunk, pending)
+            if status is None:
+                if len(chunk) > 1:
+                    # Request failed as a whole, ex: too large for the device, try smaller ones
+                    self.create_chunk_size = len(chunk) // 2
+                    self.logger.debug("Creating %s points at once failed, trying %s", len(chunk),
+                                      self.create_chunk_size)
+                    continue
+                # Even one object fails, the device is not answering rather than refusing the size
+                self.create_chunk_size = chunk_size
+                deferred = objects[position:]
+                break
+            self.create_chunk_size = min(self.create_chunk_size * 2, CREATE_CHUNK_SIZE)
+            position += len(chunk)
+            for obj in chunk:
+                if status.get(obj.lower()) == 'OK':
+                    self.__created(obj)
+                    created += 1
+                else:
+                    refused.append((obj, len(chunk) > 1))
+
+        for index, (obj, retry) in enumerate(refused):
+            if deferred:
+                deferred += [obj for obj, _ in refused[index:]]
+                break
+            status = self.__create_chunk([obj], pending) if retry else dict()
+            if status is None:
+                deferred.append(obj)
+                continue
+            if status.get(obj.lower()) == 'OK':
+                self.__created(obj)
+                created += 1
+                continue
+            found = self.__find_object(obj)
+            if found is None:
+                deferred.append(obj)
+            elif found:
+                # Created before, not by this gateway session, maybe for a removed point whose instance was reused
+                self.known_objects.add(obj.lower())
+                self.__rename(obj, pending[obj])
+            else:
+                self.failed_objects.add(obj.lower())
+                self.logger.debug("Create point [%s] failed", obj)
+
+        for obj in deferred:
+            self.pending_create[obj] = pending[obj]
+        if len(deferred):
+            self.logger.warn(f"Create of {len(deferred)} points postponed, the BACnet server did not answer")
+        self.logger.message(f"Create {created} of {len(objects)} points complete")
+
+    def __create_chunk(self, chunk, pending):
+        """
+        One OBJECT_CREATE request, returns {object id: status} or None if the request failed
+        """
+        bacnet_queue = dict()
+        for obj in chunk:
+            bacnet_queue[f'{obj}.Name'] = pending[obj]
         try:
-            self.bacnet.write(bacnet_queue, request_type=bntest.OBJECT_CREATE)
-            self.logger.message("Automatic point creation complete without error")
+            results = self.bacnet.write(bacnet_queue, request_type=bntest.OBJECT_CREATE)
         except Exception as error:
             self.logger.debug(error)
+            return None
+        status = dict()
+        for key in results:
+            status[self.__strip_device(key).split('.')[0]] = results[key]
+        return status
+
+    def __rename(self, obj, name):
+        try:
+            self.bacnet.write({f'{obj}.Name': name})
+        except Exception as error:
+            self.logger.debug("Rename of [%s] failed: %s", obj, error)
+
+    def __created(self, obj):
+        # New object, anything cached for this reference is stale
+        self.invalidate(obj)
+        self.known_objects.add(obj.lower())
+        self.logger.debug("Create point [%s] complete without error", obj)
+
+    def forget_objects(self, objects):
+        """
+        Drop removed points from the known and failed sets
+        """
+        for obj in objects:
+            self.known_objects.discard(obj.lower())
+            self.failed_objects.discard(obj.lower())
+            self.invalidate(obj)
 
     def write(self, payload_for_bacnet):
-        if len(payload_for_bacnet) == 0:
+        pending = dict()
+        for obj, (value, attempts) in self.retry.items():
+            pending[obj] = value
+        now = time.monotonic()
+        for obj in payload_for_bacnet:
+            # Drop properties whose value equals the last successfully written one
+            value = payload_for_bacnet[obj]
+            written = self.written.get(obj.lower())
+            if written is not None and written[0] == value and now - written[1] < WRITTEN_MAX_AGE:
+                pending.pop(obj, None)
+                continue
+            pending[obj] = value
+
+        if len(pending) == 0:
             return
         try:
-            self.bacnet.write(payload_for_bacnet)
+            with self.tracer.stage(TO_BACNET, REQUEST):
+                results = self.bacnet.write(pending)
+            self.update_written(pending, results)
             self.logger.debug("Save to BACnet point complete without error")
+        except Exception as error:
+            self.update_written(pending, None)
+            self.logger.debug(error)
+
+    def update_written(self, pending, results):
+        """
+        Update the shadow cache from per-property WriteResults statuses, queue failed properties for retry
+        """
+        status = dict()
+        if results is not None:
+            for key in results:
+                status[self.__strip_device(key)] = results[key]
+
+        now = time.monotonic()
+        for obj in pending:
+            key = obj.lower()
+            if status.get(key) == 'OK':
+                if key.rpartition('.')[2] in CACHED_PROPERTIES:
+                    self.written[key] = (pending[obj], now)
+                self.retry.pop(obj, None)
+                continue
+
+            self.written.pop(key, None)
+            attempts = 1
+            if obj in self.retry:
+                attempts = self.retry[obj][1] + 1
+            if attempts > WRITE_RETRIES:
+                self.retry.pop(obj, None)
+                self.logger.debug("Write of %s failed %s times: %s", obj, WRITE_RETRIES, status.get(key))
+            else:
+                self.retry[obj] = [pending[obj], attempts]
+
+    def invalidate(self, obj=None):
+        """
+        Forget cached values of an object (ex: AV3000055) or of all objects, call when points are recreated
+        or written outside the gateway
+        """
+        if obj is None:
+            self.written = dict()
+            return
+        for prop in CACHED_PROPERTIES:
+            self.written.pop(f"{obj.lower()}.{prop}", None)
+
+    def __find_object(self, obj):
+        """
+        True if the object exists, None if the request failed
+        """
+        try:
+            return self.bacnet.find_object_by_id(obj) is not None
         except Exception as error:
             self.logger.debug(error)
+            return None
 
-    def read(self, payload_from_bacnet):
+    @staticmethod
+    def __strip_device(reference):
+        # WriteResults keys are lowercase and prefixed with the device number
+        if reference[:1].isdigit():
+            return reference.partition('.')[2]
+        return reference
 
-        value_return = []
+    def read(self, payload_from_bacnet, cov_values=None):
+        """
+        Queue the commands of the command objects raised by alarms (read from BACnet)
+        and of the values received with COV notifications, {object (ex: av3011001): present value}.
+        Returns the Reset writes of the handled command objects.
+        """
         value_bacnet_return = {}
 
-        if len(payload_from_bacnet) == 0:
+        if len(payload_from_bacnet) == 0 and not cov_values:
             return
 
+        # COV only carries the Present_Value, group priorities are read in one request for all of them
+        groups = [ref for ref in cov_values or () if ref[3] == '1']
+        if len(groups):
+            with self.tracer.stage(TO_VERTEX, REQUEST):
+                self.__read_priorities(groups)
+
+        for ref in cov_values or ():
+            try:
+                self.command(ref, cov_values[ref], self.priority.get(ref, ""), value_bacnet_return)
+            except Exception as error:
+                self.logger.debug(error)
+
+        if len(payload_from_bacnet) == 0:
+            return value_bacnet_return
+
         try:
-            response = self.bacnet.read(payload_from_bacnet)
+            with self.tracer.stage(TO_VERTEX, REQUEST):
+                response = self.bacnet.read(payload_from_bacnet)
 
             for i in response:
                 dev, ref, prop = i.split('.')
@@ -64,79 +348,126 @@ class BacnetHelper:
                 if not (int(ref[4]) == 1):
                     break
 
-                if int(ref[3]) == 1:
-                    # Group
-                    if prop == "present_value":
-                        if not (int(response[i]) == 255):
-                            #MQTT
-                            priority = dev + "." + ref + ".description"
-                            if response[priority] == "":
-                                value = {
-                                    "value": int(response[i])
-                                }
-                            else:
-                                value = {
-                                    "value": int(response[i]),
-                                    "priority": int(response[priority])
-                                }
-
-                            if (ref[:2]) == "av":
-                                topic = f'vertex3/group/{self.gateway.getIdFromInstance(ref)[1]}/brightness/set'
-                                self.group_set[topic] = value
-
-                                # BACnet
-                                obj1 = f'{ref.upper()}.Reset'
-                                value1 = '1'
-                                value_bacnet_return[obj1] = value1
-                            else:
-                                if not (int(response[i]) == 17):
-                                    topic = f'vertex3/group/{self.gateway.getIdFromInstance(ref)[1]}/scene/set'
-                                    self.group_set[topic] = value
-                                    print(topic, value)
-                                    # BACnet
-                                    obj1 = f'{ref.upper()}.Reset'
-                                    value1 = '1'
-                                    value_bacnet_return[obj1] = value1
-
-                elif int(ref[3]) == 0:
-
-                    # Device
-                    if (ref[:2]) == "av":
-                        if prop == "present_value":
-                            if not (int(response[i]) == 255):
-                                tmp_list = []
-                                uid = self.gateway.getIdFromInstance(ref)[0]
-                                _id = self.gateway.getIdFromInstance(ref)[1]
-                                val = int(response[i])
-
-                                tmp_list.append(uid)
-                                tmp_list.append(_id)
-                                tmp_list.append(val)
-
-                                self.device_set.append(tmp_list)
-
-                                obj1 = f'{ref.upper()}.Reset'
-                                value1 = '1'
-                                value_bacnet_return[obj1] = value1
-
-            if len(self.group_set):
-                value1 = {
-                    'typ': 'group',
-                    'data': self.group_set
-                }
-                value_return.append(value1)
-            if len(self.device_set):
-                value2 = {
-                    'typ': 'devices',
-                    'data': self.device_set
-                }
-                value_return.append(value2)
+                if prop == "present_value":
+                    priority = ""
+                    if int(ref[3]) == 1:
+                        priority = response[dev + "." + ref + ".description"]
+                        self.priority[ref] = priority
+                    self.command(ref, response[i], priority, value_bacnet_return)
 
             self.logger.debug("Read from BACnet point complete without error")
         except Exception as error:
             self.logger.debug(error)
 
-        return_list = []
-        return_list.append(value_return)
-        return_list.append(value_bacnet_return)
-        return return_list
+        return value_bacnet_return
+
+    def command(self, ref, present_value, priority, value_bacnet_return):
+        """
+        Turn the present value of a command object (AV3x1...) into an MQTT command and a Reset write
+        """
+        # Written by an operator, what the gateway wrote to the object before is not its value anymore
+        self.invalidate(ref)
+        if int(present_value) == 255:
+            return
+
+        if int(ref[3]) == 1:
+            # Group
+            #MQTT
+            if priority == "":
+                value = {
+                    "value": int(present_value)
+                }
+            else:
+                value = {
+                    "value": int(present_value),
+                    "priority": int(priority)
+                }
+
+            if (ref[:2]) == "av":
+                topic = f'vertex3/group/{self.gateway.getIdFromInstance(ref)[1]}/brightness/set'
+                self.outbox.put(GROUP, topic, value)
+
+                # BACnet
+                obj1 = f'{ref.upper()}.Reset'
+                value1 = '1'
+                value_bacnet_return[obj1] = value1
+            else:
+                if not (int(present_value) == 17):
+                    topic = f'vertex3/group/{self.gateway.getIdFromInstance(ref)[1]}/scene/set'
+                    self.outbox.put(GROUP, topic, value)
+                    # BACnet
+                    obj1 = f'{ref.upper()}.Reset'
+                    value1 = '1'
+                    value_bacnet_return[obj1] = value1
+
+        elif int(ref[3]) == 0:
+
+            # Device
+            if (ref[:2]) == "av":
+                uid, _id = self.gateway.getIdFromInstance(ref)
+                self.outbox.put(DEVICE, (uid, _id), int(present_value))
+
+                obj1 = f'{ref.upper()}.Reset'
+                value1 = '1'
+                value_bacnet_return[obj1] = value1
+
+    def command_objects(self):
+        """
+        Command objects (AV3x1...) of the gateway lights and groups
+        """
+        objects = []
+        for vertex in self.gateway.vertex:
+            for dev in vertex.devices:
+                if dev.dev_type == 0:
+                    objects.append(f'AV3{dev.dev_type}1{vertex.bacnet_instance}{dev.bacnet_instance:03}')
+            for group in vertex.groups:
+                objects.append(f'AV3{group.dev_type}1{vertex.bacnet_instance}{group.bacnet_instance:03}')
+        return objects
+
+    def cov_subscribed(self, obj):
+        expiry = self.cov_expiry.get(obj.lower())
+        return expiry is not None and expiry > time.monotonic()
+
+    def subscribe_commands(self, lifetime):
+        """
+        Subscribe to Present_Value COV of the command objects not subscribed or past half their lifetime.
+        Only a slice is renewed per call, so renewals are spread over the passes instead of all blocking one.
+        Called from the main loop only, like every user of cov_expiry but cov_subscribed().
+        Returns the number of failed subscriptions.
+        """
+        now = time.monotonic()
+        objects = self.command_objects()
+        current = {obj.lower() for obj in objects}
+        for obj in [obj for obj in self.cov_expiry if obj not in current]:
+            del self.cov_expiry[obj]
+
+        due = [obj for obj in objects if self.cov_expiry.get(obj.lower(), 0) - now < lifetime / 2]
+        due.sort(key=lambda obj: self.cov_expiry.get(obj.lower(), 0))
+        batch = max(COV_RENEW_BATCH, -(-len(objects) * COV_RENEW_SECONDS * 4 // lifetime))
+        failed = 0
+        for obj in due[:batch]:
+            try:
+                self.bacnet.subscribe_cov(obj, lifetime)
+                self.cov_expiry[obj.lower()] = now + lifetime
+            except Exception as error:
+                # Tried again with the next pass, after the objects never subscribed
+                self.cov_expiry[obj.lower()] = now
+                failed += 1
+                self.logger.debug("COV subscription of %s failed: %s", obj, error)
+
+        if len(due):
+            subscribed = sum(1 for expiry in self.cov_expiry.values() if expiry > now)
+            self.logger.debug("Subscribed to COV of %s of %s command objects, %s renewed", subscribed,
+                              len(objects), min(len(due), batch) - failed)
+        return failed
+
+    def __read_priorities(self, objects):
+        for start in range(0, len(objects), SEED_CHUNK_SIZE):
+            try:
+                response = self.bacnet.read([f'{obj}.Description' for obj in objects[start:start + SEED_CHUNK_SIZE]])
+                for key in response:
+                    ref = self.__strip_device(key).split('.')[0]
+                    if not str(response[key]).startswith('QERR'):
+                        self.priority[ref] = response[key]
+            except Exception as error:
+                self.logger.debug("Reading group priorities failed: %s", error)
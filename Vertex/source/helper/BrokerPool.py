@@ -0,0 +1,226 @@
+"""
+Connections to the Vertex MQTT brokers
+"""
+import random
+import threading
+
+import paho.mqtt.client as mqtt
+
+from helper.MqttPublisher import MqttPublisher
+
+MQTT_PORT = 1883
+# Wait before the next try, doubled after each failed one up to the maximum, with jitter
+RECONNECT_MIN_SECONDS = 1
+RECONNECT_MAX_SECONDS = 60
+
+
+class BrokerConnection:
+    """
+    One paho client with its own reconnect state, its addresses are tried in turn.
+    Without addresses the Vertex IPs of the settings file are used, as they are at the time of each try.
+
+    Connecting, waiting and reconnecting all happen in the paho network thread, so a broker that is down
+    never blocks the main loop. Only that thread changes the reconnect state, from the paho callbacks.
+    """
+
+    def __init__(self, name, addresses, pool):
+        self.name = name
+        self.addresses = addresses
+        self.address_choose = 0
+        self.pool = pool
+        self.logger = pool.logger
+        self.client = mqtt.Client(name, userdata=self)
+        self.client.username_pw_set(pool.username, pool.password)
+        self.client.on_connect = pool.on_connect
+        self.client.on_connect_fail = pool.on_connect_fail
+        self.client.on_disconnect = pool.on_disconnect
+        self.client.on_message = pool.on_message
+        self.client.reconnect_delay_set(RECONNECT_MIN_SECONDS, RECONNECT_MIN_SECONDS)
+        self.publisher = MqttPublisher(self.client, pool.logger, pool.config.configuration_publish_qos,
+                                       pool.config.configuration_max_inflight)
+        # Failed tries since the last connection
+        self.attempts = 0
+        self.started = False
+        # UIDs of the Vertex served by this broker
+        self.vertex = set()
+        # Discovery step (edges, devices, groups) of this broker
+        self.topic_to_send = 0
+
+    def address(self):
+        addresses = self.addresses
+        if addresses is None:
+            addresses = self.pool.config.vertex_ip_vertex
+        if not (len(addresses) > self.address_choose):
+            self.address_choose = 0
+        host, _, port = addresses[self.address_choose].partition(':')
+        return host, int(port) if port else MQTT_PORT
+
+    def connect(self):
+        """
+        Start the paho thread, it connects in the background and keeps reconnecting until disconnect()
+        """
+        if self.started:
+            return
+        host, port = self.address()
+        self.logger.debug(f"Connecting to Vertex on IP: {host} in progres")
+        self.client.connect_async(host, port, self.pool.config.vertex_timeout)
+        self.client.loop_start()
+        self.started = True
+
+    def connected(self):
+        """
+        Connection accepted by the broker, the subscriptions of a clean session are made again
+        """
+        host, port = self.address()
+        self.logger.message(f"✅ Connected to the Vertex device on IP: {host}")
+        self.attempts = 0
+        self.client.reconnect_delay_set(RECONNECT_MIN_SECONDS, RECONNECT_MIN_SECONDS)
+        self.client.subscribe(self.pool.topics)
+
+    def failed(self):
+        """
+        Prepare the next try after a failed or lost connection, on the next address once the wait is over
+        """
+        host, port = self.address()
+        self.attempts += 1
+        self.address_choose += 1
+        delay = min(RECONNECT_MIN_SECONDS * 2 ** min(self.attempts - 1, 16), RECONNECT_MAX_SECONDS)
+        # Jitter keeps gateways restarted together from trying again all at the same time
+        delay = random.uniform(delay / 2, delay)
+        self.client.reconnect_delay_set(delay, delay)
+        next_host, next_port = self.address()
+        self.client.connect_async(next_host, next_port, self.pool.config.vertex_timeout)
+        self.logger.error(f"Connection failed on ip: {host}, next try on {next_host} in {delay:.1f} s")
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    def publish(self, topic, payload):
+        self.client.publish(topic, payload)
+
+    def disconnect(self):
+        self.client.disconnect()
+        if self.started:
+            self.client.loop_stop()
+            self.started = False
+
+
+class BrokerPool:
+    """
+    Clients of the Vertex brokers sharing one dispatch core.
+    A single client tries the configured addresses in turn, in multi-broker mode every address gets its own
+    client connected at the same time and commands go to the broker serving the target Vertex.
+    """
+
+    def __init__(self, name, logger, config, username=None, password=None, multi_broker=False):
+        self.logger = logger
+        self.config = config
+        self.username = username
+        self.password = password
+        self.topics = []
+        # Gateway callbacks, paho signatures with the BrokerConnection as userdata
+        self.message_callback = None
+        self.connect_callback = None
+        self.disconnect_callback = None
+        # Messages of all clients are handled one at a time, like with a single client
+        self.lock = threading.RLock()
+        # Connection whose message is being handled
+        self.current = None
+        # {Vertex UID: BrokerConnection}
+        self.owner = dict()
+
+        addresses = config.vertex_ip_vertex
+        if multi_broker and len(addresses) > 1:
+            self.connections = [BrokerConnection(f"{name}_{number}", [address], self)
+                                for number, address in enumerate(addresses)]
+        else:
+            self.connections = [BrokerConnection(name, None, self)]
+
+    def connect(self, topics):
+        """
+        Start connecting every client, returns at once
+        """
+        self.topics = topics
+        for connection in self.connections:
+            connection.connect()
+
+    def disconnect(self):
+        for connection in self.connections:
+            connection.disconnect()
+
+    def is_connected(self):
+        for connection in self.connections:
+            if connection.is_connected():
+                return True
+        return False
+
+    def on_connect(self, client, connection, flags, rc):
+        # A refused connection is followed by on_disconnect, which schedules the next try
+        if rc == mqtt.CONNACK_ACCEPTED:
+            connection.connected()
+        if self.connect_callback is not None:
+            self.connect_callback(client, connection, flags, rc)
+
+    def on_connect_fail(self, client, connection):
+        connection.failed()
+
+    def on_disconnect(self, client, connection, rc):
+        # rc 0 is a disconnect() of the gateway itself
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            connection.failed()
+        if self.disconnect_callback is not None:
+            self.disconnect_callback(client, connection, rc)
+
+    def on_message(self, client, connection, message):
+        with self.lock:
+            self.current = connection
+            try:
+                self.message_callback(client, connection, message)
+            finally:
+                self.current = None
+
+    def claim(self, connection, uids):
+        """
+        Route the Vertex listed in a discovery answer to the broker that sent it
+        """
+        if len(self.connections) < 2:
+            return
+        for uid in uids:
+            previous = self.owner.get(uid)
+            if previous is not connection:
+                if previous is not None:
+                    previous.vertex.discard(uid)
+                self.owner[uid] = connection
+                connection.vertex.add(uid)
+                self.logger.debug(f"Vertex {uid} served by {connection.name}")
+
+    def connection_for(self, uid):
+        """
+        Connection of the broker serving a Vertex, any connected one if the Vertex was not discovered yet
+        """
+        if len(self.connections) == 1:
+            return self.connections[0]
+        connection = self.owner.get(uid)
+        if connection is not None:
+            return connection
+        for connection in self.connections:
+            if connection.is_connected():
+                return connection
+        return self.connections[0]
+
+    def stats(self):
+        published = 0
+        refused = 0
+        connected = 0
+        for connection in self.connections:
+            stats = connection.publisher.stats()
+            published += stats["published"]
+            refused += stats["refused"]
+            if connection.is_connected():
+                connected += 1
+        return {
+            "brokers": len(self.connections),
+            "connected": connected,
+            "published": published,
+            "refused": refused,
+        }
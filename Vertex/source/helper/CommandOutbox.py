@@ -0,0 +1,61 @@
+"""
+Outbound commands from BACnet to Vertex waiting to be published
+"""
+from collections import OrderedDict
+
+# Kinds of commands, a group command is keyed by its topic, a device command by (vertex uid, device id)
+GROUP = "group"
+DEVICE = "device"
+
+
+class CommandOutbox:
+    """
+    One pending command per target, a newer command for the same target replaces the older one.
+    Commands are removed when they are taken for publishing, the number of targets is bounded.
+    Filled and drained from the main loop only.
+    """
+
+    def __init__(self, capacity=20000):
+        self.capacity = capacity
+        self.commands = OrderedDict()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, kind, target, value):
+        """
+        Queue a command, returns False if the outbox is full and the command was dropped
+        """
+        key = (kind, target)
+        if key in self.commands:
+            self.coalesced += 1
+        elif len(self.commands) >= self.capacity:
+            self.dropped += 1
+            return False
+        self.commands[key] = value
+        return True
+
+    def restore(self, kind, target, value):
+        """
+        Put back a command that could not be published, unless a newer one was queued meanwhile
+        """
+        key = (kind, target)
+        if key not in self.commands and len(self.commands) < self.capacity:
+            self.commands[key] = value
+            self.commands.move_to_end(key, last=False)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def drain(self):
+        """
+        Take every pending command in queueing order, returns a list of (kind, target, value)
+        """
+        taken, self.commands = self.commands, OrderedDict()
+        return [(kind, target, value) for (kind, target), value in taken.items()]
+
+    def stats(self):
+        return {
+            "pending": len(self.commands),
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
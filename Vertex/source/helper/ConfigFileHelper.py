@@ -8,13 +8,15 @@ from PDS.Config import CSVConfigManager
 
 class ConfigFileHelper:
 
-    def __init__(self, settings_file_name, bacnet, logger, device):
+    def __init__(self, settings_file_name, bacnet, logger, device, settings_reference=None):
 
         self.dev_mode = False
         self.settings_file_name = settings_file_name
         self.bacnet = bacnet
         self.logger = logger
         self.device = device
+        # Settings object found by an earlier run (ex: CSV3900000), spares the searches by name
+        self.settings_reference = settings_reference
         self.config = CSVConfigManager(self.bacnet, self.logger, self.device)
         self.cfg = None
 
@@ -23,7 +25,15 @@ class ConfigFileHelper:
         self.configuration_use_auto_create = None
         self.configuration_rename_with_port_and_short_address = None
         self.configuration_setting_file_refresh = None
-        self.configuration_sending_time_ms = None
+        self.configuration_batch_window_ms = None
+        self.configuration_queue_capacity = None
+        self.configuration_use_cov = None
+        self.configuration_cov_lifetime = None
+        self.configuration_publish_qos = None
+        self.configuration_max_inflight = None
+        self.configuration_trace = None
+        self.configuration_trace_interval = None
+        self.configuration_multi_broker = None
         self.vertex_ip_vertex = []
         self.vertex_uid_vertex = []
         self.vertex_max_vertex = None
@@ -46,6 +56,8 @@ class ConfigFileHelper:
             "configuration": configuration_dict,
             "vertex": vertex_dict
         }
+        if self.settings_reference is not None:
+            return
         try:
             settings_file_instance = self.bacnet.find_object_by_name(f'{self.settings_file_name}', obj_type="CSV",
                                                                      device=self.device)
@@ -60,7 +72,7 @@ class ConfigFileHelper:
 
     def addConfig(self):
         try:
-            self.config.add(self.settings_file_name, self.configReader)
+            self.config.add(self.settings_file_name, self.configReader, obj_ref=self.settings_reference)
         except Exception as error:
             if error == f"Configuration object {self.settings_file_name} could not be found":
                 self.logger.error(error)
@@ -105,6 +117,41 @@ class ConfigFileHelper:
                     self.cfg['configuration']['rename_with_port_and_short_address'])
             except:
                 self.configuration_rename_with_port_and_short_address = False
+            try:
+                self.configuration_multi_broker = bool(self.cfg['configuration']['multi_broker'])
+            except:
+                self.configuration_multi_broker = False
+            try:
+                self.configuration_trace = bool(self.cfg['configuration']['trace'])
+            except:
+                self.configuration_trace = False
+            try:
+                self.configuration_trace_interval = self.cfg['configuration']['trace_interval']
+            except:
+                self.configuration_trace_interval = 60
+            try:
+                self.configuration_batch_window_ms = self.cfg['configuration']['batch_window_ms']
+            except:
+                self.configuration_batch_window_ms = 10
+                if 'sending_time_ms' in self.cfg.get('configuration', {}):
+                    # Ticks of the 100 ms polling loop it tuned, not milliseconds
+                    self.logger.warn("sending_time_ms is no longer used, set batch_window_ms instead")
+            try:
+                self.configuration_use_cov = bool(self.cfg['configuration']['use_cov'])
+            except:
+                self.configuration_use_cov = False
+            try:
+                self.configuration_cov_lifetime = self.cfg['configuration']['cov_lifetime']
+            except:
+                self.configuration_cov_lifetime = 300
+            try:
+                self.configuration_publish_qos = self.cfg['configuration']['publish_qos']
+            except:
+                self.configuration_publish_qos = 0
+            try:
+                self.configuration_max_inflight = self.cfg['configuration']['max_inflight']
+            except:
+                self.configuration_max_inflight = 20
 
             # For developer purposes
             if self.dev_mode:
@@ -117,9 +164,9 @@ class ConfigFileHelper:
                 except:
                     self.configuration_setting_file_refresh = 20
                 try:
-                    self.configuration_sending_time_ms = self.cfg['configuration']['sending_time_ms']
+                    self.configuration_queue_capacity = self.cfg['configuration']['queue_capacity']
                 except:
-                    self.configuration_sending_time_ms = 3
+                    self.configuration_queue_capacity = 40000
                 try:
                     self.vertex_max_vertex = self.cfg['vertex']['max_vertex']
                 except:
@@ -138,13 +185,16 @@ class ConfigFileHelper:
                 self.vertex_max_vertex = 10
                 self.vertex_max_bacnet_points = 999
                 self.vertex_timeout = 60
-                self.configuration_sending_time_ms = 3
+                self.configuration_queue_capacity = 40000
 
         except Exception as error:
             self.logger.error(error)
             return False
         return True
 
+    def getSettingsReference(self):
+        return self.config.reference(self.settings_file_name)
+
     def configReader(self):
         self.getConfig()
 
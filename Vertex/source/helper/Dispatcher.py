@@ -0,0 +1,73 @@
+"""
+Event-driven core of the gateway main loop
+"""
+import threading
+import time
+from collections import deque
+
+import schedule
+
+# Upper bound of a single idle wait, so jobs scheduled from other threads are picked up in time
+MAX_IDLE_SECONDS = 1.0
+LATENCY_SAMPLES = 1024
+
+
+class Dispatcher:
+
+    def __init__(self, logger, batch_window_ms=10):
+        self.logger = logger
+        self.batch_window = max(batch_window_ms, 0) / 1000
+        self.wake_event = threading.Event()
+        self.first_notify = None
+        self.latency = deque(maxlen=LATENCY_SAMPLES)
+
+    def notify(self):
+        """
+        Wake the main loop, called by producers (MQTT and BACnet callbacks) after queueing work
+        """
+        if self.first_notify is None:
+            self.first_notify = time.monotonic()
+        self.wake_event.set()
+
+    def wait(self):
+        """
+        Block until work is queued or the next scheduled job is due.
+        Returns monotonic time of the first notification of this batch or None on timeout.
+        """
+        timeout = schedule.idle_seconds()
+        if timeout is None or timeout > MAX_IDLE_SECONDS:
+            timeout = MAX_IDLE_SECONDS
+
+        if timeout > 0 and self.wake_event.wait(timeout) and self.batch_window:
+            # Micro-batching window, let bursts of messages land in the same flush
+            time.sleep(self.batch_window)
+
+        self.wake_event.clear()
+        started, self.first_notify = self.first_notify, None
+        return started
+
+    def done(self, started):
+        """
+        Record notify-to-flush latency of a processed batch
+        """
+        if started is not None:
+            self.latency.append(time.monotonic() - started)
+
+    def latency_percentiles(self):
+        if not len(self.latency):
+            return None
+        samples = sorted(self.latency)
+        last = len(samples) - 1
+        return {
+            "p50": samples[int(last * 0.50)] * 1000,
+            "p90": samples[int(last * 0.90)] * 1000,
+            "p99": samples[int(last * 0.99)] * 1000,
+            "max": samples[last] * 1000,
+        }
+
+    def report(self):
+        percentiles = self.latency_percentiles()
+        if percentiles is None:
+            return
+        self.logger.debug("Dispatch latency ms: " +
+                          ", ".join(f"{key}={value:.1f}" for key, value in percentiles.items()))
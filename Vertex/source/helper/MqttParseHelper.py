@@ -4,21 +4,66 @@
 from Vertex.source.vertex.Vertex import Vertex
 from Vertex.source.vertex.Device import Device
 from Vertex.source.vertex.Group import Group
-import bntest
+import hashlib
 import json
 
+from helper.CommandOutbox import GROUP, DEVICE
+
 
 class MqttParseHelper:
 
-    def __init__(self, gateway, bacnet, logger, config, client):
+    def __init__(self, gateway, bacnet, logger, config, brokers, bacnet_helper):
         self.gateway = gateway
         self.bacnet = bacnet
+        self.bacnet_helper = bacnet_helper
         self.logger = logger
         self.config = config
-        self.client = client
+        self.brokers = brokers
         self.status_edges = False
         self.status_devices = False
         self.status_groups = False
+        # Digest of the last discovery answer applied, {(broker name, step): digest}
+        self.digests = dict()
+        # UIDs of the vertex3 edges of the last discovery answer, {(broker name, step): [uid]}
+        self.claims = dict()
+        # Registry changed by discovery since the last take_changed(), the first cycle always counts as a change
+        self.changed = True
+
+    def discovery(self, step, payload, *args):
+        """
+        Apply a raw discovery answer with edges(), devices() or groups(). An answer equal to the previous one of
+        its broker is not decoded again, returns False for it. Once edges() adds a Vertex, the next devices and
+        groups answers are applied whatever they are.
+        """
+        connection = self.brokers.current
+        key = (None if connection is None else connection.name, step)
+        # The settings passed with the answer (static Vertex UIDs, max Vertex) change how it is applied
+        digest = hashlib.blake2b(payload + repr(args).encode('utf-8'), digest_size=16).digest()
+        if self.digests.get(key) == digest:
+            self.logger.debug("Discovery %s unchanged", step)
+            self.__claim(connection, key)
+            return False
+        decoded = json.loads(payload)
+        # Vertex served by the broker, every answer claims them again as another broker may have answered since
+        self.claims[key] = [uid for uid, edge in decoded.items() if edge.get("edge_type") == "vertex3"]
+        self.__claim(connection, key)
+        vertex_count = self.gateway.quantityVertex()
+        getattr(self, step)(decoded, *args)
+        self.digests[key] = digest
+        if self.gateway.quantityVertex() != vertex_count:
+            # Devices and groups answers also apply to the new Vertex, unchanged ones included
+            for other in [other for other in self.digests if other[1] != "edges"]:
+                del self.digests[other]
+        return True
+
+    def __claim(self, connection, key):
+        if connection is not None:
+            self.brokers.claim(connection, self.claims[key])
+
+    def take_changed(self):
+        changed = self.changed
+        self.changed = False
+        return changed
 
     def edges(self, payload, uid_vertex, max_vertex):
         if len(uid_vertex) > max_vertex:
@@ -39,90 +84,116 @@ class MqttParseHelper:
                 ver.setStatus(True)
                 if self.gateway.quantityVertex() <= max_vertex:
                     self.gateway.addVertex(ver)
+                    self.changed = True
 
         self.status_edges = True
         self.logger.message('Downloading information about Vertex completed')
 
     def devices(self, payload):
-
+        """
+        Reconcile the devices of every Vertex with the answer: only added and removed devices are processed
+        """
         for vertex in payload:
             edge_type = payload[vertex]["edge_type"]
 
             if edge_type == "vertex3":
                 ver = self.gateway.getVertex(vertex)
+                if ver is None:
+                    continue
+
+                devices = payload[vertex]["devices"]
+                existing = {dev.id for dev in ver.devices}
+                added = devices.keys() - existing
+                removed = existing - devices.keys()
 
-                if not (ver is None):
-                    for device in payload[vertex]["devices"]:
-                        dev = self.gateway.getDevice(vertex, device)
-                        if not (dev is None):
-                            dev.setStatus(True)
-                        else:
-                            dev_type = payload[vertex]["devices"][device]['device_type']
-                            if dev_type == 4:  # 4 LED luminaries
-                                new_dev = Device(device,
-                                                 bacnet_instance=self.gateway.getFreeDeviceInstance(vertex, dev_type),
-                                                 dev_type=0)
-                                ver.addDevice(new_dev)
-                            elif dev_type == 128:  # 128 Dali 2 device
-                                new_dev = Device(device,
-                                                 bacnet_instance=self.gateway.getFreeDeviceInstance(vertex, dev_type),
-                                                 dev_type=2)
-                                ver.addDevice(new_dev)
-                            elif dev_type == 3:  # 3 Emergency luminaries
-                                new_dev = Device(device,
-                                                 bacnet_instance=self.gateway.getFreeDeviceInstance(vertex, dev_type),
-                                                 dev_type=4)
-                                ver.addDevice(new_dev)
-                            else:
-                                self.logger.debug(f'The gateway does not support this type of device UID:{device}')
-                """else:
-                    ver = Vertex(vertex, edge_type)
-                    ver.setStatus(True)
-                    for device in payload[vertex]["devices"]:
-                        dev_type = payload[vertex]["devices"][device]['device_type']
-                        if dev_type == 4 or dev_type == 128:  # 4 LED luminaries | 128 Dali 2 device
-                            ver.addDevice(Device(device))
-                        else:
-                            self.logger.debug(f'The gateway does not support this type of device UID:{device}')
-                    self.gateway.addVertex(ver)"""
+                # Removed first, their instances are held for them and only go to added ones once no other is free
+                if self.removable(removed, existing):
+                    self.forget(self.gateway.removeDevices(ver, removed))
+
+                if len(added):
+                    # In the order of the answer, so instances are given out like in a full pass
+                    for device in [device for device in devices if device in added]:
+                        self.add_device(ver, device, devices[device]['device_type'])
 
         self.status_devices = True
         self.logger.message('Downloading information about Devices completed')
 
     def groups(self, payload):
+        """
+        Reconcile the groups of every Vertex with the answer: only added and removed groups are processed
+        """
         for vertex in payload:
             edge_type = payload[vertex]["edge_type"]
 
             if edge_type == "vertex3":
                 ver = self.gateway.getVertex(vertex)
-
-                if not (ver is None):
-                    for group in payload[vertex]["groups"]:
-                        gro = self.gateway.getGroup(group)
-                        if not (gro is None):
-                            gro.setStatus(True)
-                        else:
-                            gro = Group(group, bacnet_instance=self.gateway.getFreeGroupInstance(vertex), dev_type=1)
+                if ver is None:
+                    continue
+
+                groups = payload[vertex]["groups"]
+                existing = {gro.id for gro in ver.groups}
+                added = groups.keys() - existing
+                removed = existing - groups.keys()
+
+                if self.removable(removed, existing):
+                    self.forget(self.gateway.removeGroups(ver, removed))
+
+                if len(added):
+                    for group in [group for group in groups if group in added]:
+                        # Group ids are unique across Vertex, a group known under another Vertex stays there
+                        if self.gateway.getGroup(group) is None:
+                            gro = Group(group, bacnet_instance=self.gateway.getFreeGroupInstance(vertex, group),
+                                        dev_type=1)
                             gro.setStatus(True)
-                            ver.addGroup(gro)
+                            self.gateway.addGroup(ver, gro)
+                            self.changed = True
 
         self.status_groups = True
         self.logger.message('Downloading information about Groups completed')
 
+    def add_device(self, ver, device, dev_type):
+        # 4 LED luminaries, 128 Dali 2 device, 3 Emergency luminaries
+        if not (dev_type == 4 or dev_type == 128 or dev_type == 3):
+            self.logger.debug(f'The gateway does not support this type of device UID:{device}')
+            return
+        slot = self.gateway.getFreeDeviceSlot(ver.id, dev_type, device)
+        if slot is None:
+            self.logger.warn(f'No free BACnet instance left for device UID:{device}')
+            return
+        point_type, bacnet_instance = slot
+        new_dev = Device(device, bacnet_instance=bacnet_instance, dev_type=point_type)
+        new_dev.setStatus(True)
+        self.gateway.addDevice(ver, new_dev)
+        self.changed = True
+
+    @staticmethod
+    def removable(removed, existing):
+        # Like Gateway.reconfigureStatus, a Vertex answering without any of its points keeps them
+        return len(removed) and len(removed) < len(existing)
+
+    def forget(self, references):
+        """
+        Points of removed devices and groups, their BACnet objects are kept but no longer known to the gateway
+        """
+        self.bacnet_helper.forget_objects(references)
+        self.changed = True
+        self.logger.message(f"Removed {len(references)} points no longer discovered")
+
     def all_light(self, payload, payload_for_bacnet):
         for light in payload:
             vertex_uid = payload[light]["vertex_uid"]
-            vertex_bi = self.gateway.getVertex(vertex_uid).bacnet_instance
-            light_bi = self.gateway.getDevice(payload[light]["vertex_uid"], payload[light]["uid"]).bacnet_instance
-            light_type = self.gateway.getDevice(payload[light]["vertex_uid"], payload[light]["uid"]).dev_type
+            obj = self.gateway.getReference(vertex_uid, payload[light]["uid"])
+            if obj is None:
+                self.logger.debug("There is no dev defined %s", payload[light]['uid'])
+                continue
 
-            obj1 = f'AV3{light_type}0{vertex_bi}{light_bi:03}.Present_Value'
+            obj1 = obj + '.Present_Value'
             value1 = payload[light]['brightness']
-            obj2 = f'AV3{light_type}0{vertex_bi}{light_bi:03}.Description'
+            obj2 = obj + '.Description'
             value2 = str(payload[light])
 
             if self.config.configuration_rename_with_port_and_short_address:
-                obj3 = f'AV3{light_type}0{vertex_bi}{light_bi:03}.Name'
+                obj3 = obj + '.Name'
                 value3 = f'VertexGateway_{vertex_uid}_{payload[light]["dali_port"]}_{payload[light]["short_address"]:02}'
                 payload_for_bacnet[obj3] = value3
 
@@ -132,8 +203,9 @@ class MqttParseHelper:
     def individual_button(self, vertex_id, dev_id, button, payload, payload_for_bacnet):
 
         vertex_bi = self.gateway.getVertex(vertex_id).bacnet_instance
-        button_bi = self.gateway.getDevice(vertex_id, dev_id).bacnet_instance
-        button_type = self.gateway.getDevice(vertex_id, dev_id).dev_type
+        device = self.gateway.getDevice(vertex_id, dev_id)
+        button_bi = device.bacnet_instance
+        button_type = device.dev_type
         button_bi_edit = button_bi + int(button)
 
         if int(button) > 9:
@@ -143,17 +215,9 @@ class MqttParseHelper:
         # BACnet point
         obj_bi = f'AV3{button_type}0{vertex_bi}{button_bi_edit:03}'
 
-        if self.bacnet.find_object_by_id(obj_bi) is None and self.config.configuration_use_auto_create:
-            # Create
-            obj = obj_bi + '.Name'
-            value = f'VertexGateway_{vertex_id}_{dev_id}_{button}'
-            bacnet_queue = dict()
-            bacnet_queue[obj] = value
-            try:
-                self.bacnet.write(bacnet_queue, request_type=bntest.OBJECT_CREATE)
-                self.logger.message(f"Create button point [{obj_bi}] complete without error")
-            except Exception as error:
-                self.logger.debug(error)
+        if self.config.configuration_use_auto_create and not self.bacnet_helper.object_exists(obj_bi):
+            # Create with the next flush
+            self.bacnet_helper.queue_create(obj_bi, f'VertexGateway_{vertex_id}_{dev_id}_{button}')
 
         obj1 = obj_bi + '.Present_Value'
         val1 = int(payload["state"])
@@ -171,8 +235,9 @@ class MqttParseHelper:
     def individual_sensor(self, vertex_id, dev_id, sensor_type, payload, payload_for_bacnet):
 
         vertex_bi = self.gateway.getVertex(vertex_id).bacnet_instance
-        sensor_bi = self.gateway.getDevice(vertex_id, dev_id).bacnet_instance
-        sensor_inst_type = self.gateway.getDevice(vertex_id, dev_id).dev_type
+        device = self.gateway.getDevice(vertex_id, dev_id)
+        sensor_bi = device.bacnet_instance
+        sensor_inst_type = device.dev_type
         name = 'motion'
         units = ""
 
@@ -184,17 +249,9 @@ class MqttParseHelper:
         # BACnet point
         obj_bi = f'AV3{sensor_inst_type}0{vertex_bi}{sensor_bi:03}'
 
-        if self.bacnet.find_object_by_id(obj_bi) is None and self.config.configuration_use_auto_create:
-            # Create
-            obj = obj_bi + '.Name'
-            value = f'VertexGateway_{vertex_id}_{dev_id}_{name}'
-            bacnet_queue = dict()
-            bacnet_queue[obj] = value
-            try:
-                self.bacnet.write(bacnet_queue, request_type=bntest.OBJECT_CREATE)
-                self.logger.message(f"Create button point [{obj_bi}] complete without error")
-            except Exception as error:
-                self.logger.debug(error)
+        if self.config.configuration_use_auto_create and not self.bacnet_helper.object_exists(obj_bi):
+            # Create with the next flush
+            self.bacnet_helper.queue_create(obj_bi, f'VertexGateway_{vertex_id}_{dev_id}_{name}')
 
         obj1 = obj_bi + '.Present_Value'
         val1 = int(payload[sensor_type])
@@ -211,28 +268,25 @@ class MqttParseHelper:
 
     def individual_light(self, vertex_id, dev_id, payload, payload_for_bacnet):
 
-        try:
-            vertex_bi = self.gateway.getVertex(vertex_id).bacnet_instance
-            light_bi = self.gateway.getDevice(vertex_id, dev_id).bacnet_instance
-            light_type = self.gateway.getDevice(vertex_id, dev_id).dev_type
-        except Exception as error:
-            self.logger.debug(f"There is no dev defined {error}")
+        obj = self.gateway.getReference(vertex_id, dev_id)
+        if obj is None:
+            self.logger.debug("There is no dev defined %s", dev_id)
             return
 
-        obj1 = f'AV3{light_type}0{vertex_bi}{light_bi:03}.Present_Value'
+        obj1 = obj + '.Present_Value'
         value1 = payload['brightness']
-        obj2 = f'AV3{light_type}0{vertex_bi}{light_bi:03}.Description'
+        obj2 = obj + '.Description'
         value2 = str(payload)
         payload_for_bacnet[obj1] = value1
         payload_for_bacnet[obj2] = value2
 
     def groups_feedback(self, group_id, payload, payload_for_bacnet):
-        try:
-            group = self.gateway.getGroup(group_id)
-            vertex = self.gateway.getVertexFromGroup(group_id)
-            obj = f'AV310{vertex.bacnet_instance}{group.bacnet_instance:03}'
-        except Exception as error:
-            self.logger.debug(f"There is no group defined {error}")
+        vertex = self.gateway.getVertexFromGroup(group_id)
+        obj = None
+        if vertex is not None:
+            obj = self.gateway.getReference(vertex.id, group_id)
+        if obj is None:
+            self.logger.debug("There is no group defined %s", group_id)
             return
 
         if payload['value_type'] == 'direct':
@@ -251,27 +305,41 @@ class MqttParseHelper:
         payload_for_bacnet[obj1] = int(value)
         payload_for_bacnet[obj2] = value2
 
-    def write(self, payload_for_mqtt):
+    def write(self, outbox):
+        """
+        Publish the pending commands of the outbox in one batch per broker, a command that could not be handed
+        to paho stays queued
+        """
         self.logger.debug('Sending data to Vertex devices')
-        for i in payload_for_mqtt:
-            for j in i:
-                if j['typ'] == 'group':
-                    for topic in j['data']:
-                        msg = json.dumps(j['data'][topic])
-                        self.client.publish(topic, msg)
-
-                if j['typ'] == 'devices':
-
-                    value = {}
-                    for elem in j['data']:
-                        if elem[0] not in value:
-                            value[elem[0]] = []
-                        value[elem[0]].append(elem[1:])
-
-                    for key in value:
-                        topic = f'vertex3/light/{key}/brightness/set'
-                        tmp_dict = {}
-                        for i in value[key]:
-                            tmp_dict[i[0]] = i[1]
-                        msg = json.dumps(tmp_dict)
-                        self.client.publish(topic, msg)
+        commands = outbox.drain()
+        # {BrokerConnection: {topic: payload}}, commands go to the broker serving the Vertex
+        messages = {}
+        for kind, target, value in commands:
+            if kind == GROUP:
+                connection = self.brokers.connection_for(self.__group_vertex(target))
+                messages.setdefault(connection, {})[target] = value
+            elif kind == DEVICE:
+                uid, _id = target
+                topic = f'vertex3/light/{uid}/brightness/set'
+                batch = messages.setdefault(self.brokers.connection_for(uid), {})
+                if topic not in batch:
+                    batch[topic] = {}
+                batch[topic][_id] = value
+
+        refused = []
+        for connection, batch in messages.items():
+            refused += connection.publisher.publish_batch(batch)
+        if len(refused):
+            refused = set(refused)
+            # Put back from the last one, the outbox keeps the original order
+            for kind, target, value in reversed(commands):
+                topic = target if kind == GROUP else f'vertex3/light/{target[0]}/brightness/set'
+                if topic in refused:
+                    outbox.restore(kind, target, value)
+
+    def __group_vertex(self, topic):
+        # vertex3/group/{group uid}/brightness/set
+        vertex = self.gateway.getVertexFromGroup(topic.split('/')[2])
+        if vertex is None:
+            return None
+        return vertex.id
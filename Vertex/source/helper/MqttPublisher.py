@@ -0,0 +1,52 @@
+"""
+Publish stage of the commands sent to Vertex
+"""
+import json
+
+import paho.mqtt.client as mqtt
+
+# paho default of QoS 1 messages on the way at once
+MAX_INFLIGHT = 20
+
+
+class MqttPublisher:
+    """
+    Takes every message of a dispatch pass at once, one payload per topic serialized once,
+    and hands them to paho back to back so its network thread sends them in as few writes as possible.
+    """
+
+    def __init__(self, client, logger, qos=0, max_inflight=MAX_INFLIGHT):
+        self.client = client
+        self.logger = logger
+        self.qos = qos
+        if qos > 0:
+            # Acknowledged delivery is pipelined, up to max_inflight messages wait for their PUBACK
+            self.client.max_inflight_messages_set(max_inflight)
+        self.published = 0
+        self.refused = 0
+
+    def publish_batch(self, messages):
+        """
+        Publish {topic: payload object}, returns the topics paho did not accept
+        """
+        batch = [(topic, json.dumps(payload)) for topic, payload in messages.items()]
+
+        refused = []
+        for topic, payload in batch:
+            rc = self.client.publish(topic, payload, qos=self.qos).rc
+            # QoS 1 messages stay in the paho queue while disconnected and are sent after reconnecting
+            if rc == mqtt.MQTT_ERR_SUCCESS or (rc == mqtt.MQTT_ERR_NO_CONN and self.qos > 0):
+                self.published += 1
+            else:
+                refused.append(topic)
+
+        if len(refused):
+            self.refused += len(refused)
+            self.logger.debug("%s of %s messages not accepted by the MQTT client", len(refused), len(batch))
+        return refused
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "refused": self.refused,
+        }
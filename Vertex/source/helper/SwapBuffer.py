@@ -0,0 +1,53 @@
+"""
+Double-buffered handoff between producer threads (paho network loop, bntest callbacks) and the main loop
+"""
+import threading
+
+
+class SwapBuffer:
+    """
+    Producers put keyed items into the active buffer, latest value wins for a key.
+    The consumer takes the whole buffer in one operation and producers continue on a fresh one.
+    The lock only guards a dictionary assignment or a swap, it is never held across I/O.
+    """
+
+    def __init__(self, capacity=40000):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.buffer = dict()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, key, value=None):
+        """
+        Add or replace an item, returns False if the buffer is full and the item was dropped
+        """
+        with self.lock:
+            if key in self.buffer:
+                self.coalesced += 1
+            elif len(self.buffer) >= self.capacity:
+                self.dropped += 1
+                return False
+            self.buffer[key] = value
+        return True
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def take(self):
+        """
+        Take every queued item, returns a plain dict owned by the caller
+        """
+        with self.lock:
+            taken, self.buffer = self.buffer, dict()
+        return taken
+
+    def stats(self):
+        return {
+            "pending": len(self.buffer),
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,93 @@
+"""
+Routing table binding subscribed MQTT topic filters to handlers
+"""
+import json
+import time
+
+# Trie key of the handler stored in a node, cannot clash with a topic segment
+HANDLER = None
+
+
+class TopicRouter:
+
+    def __init__(self):
+        self.root = dict()
+        self.routes = []
+        # Message kind of the handlers for latency tracing, {handler: kind}
+        self.kinds = dict()
+        # Handlers taking the payload undecoded
+        self.raw = set()
+
+    def register(self, topic_filter, handler, qos=0, kind=None, raw=False):
+        """
+        Bind a topic filter (with + and # wildcards) to handler(*captures, payload).
+        Captures are the topic segments matched by the wildcards, in order.
+        With raw, the handler gets the payload bytes and decodes them itself.
+        """
+        node = self.root
+        for segment in topic_filter.split('/'):
+            node = node.setdefault(segment, dict())
+        node[HANDLER] = handler
+        self.routes.append((topic_filter, qos))
+        if kind is not None:
+            self.kinds[handler] = kind
+        if raw:
+            self.raw.add(handler)
+
+    def subscriptions(self):
+        """
+        List of (topic filter, qos) to pass to client.subscribe
+        """
+        return list(self.routes)
+
+    def match(self, topic):
+        """
+        Find the handler of a topic, returns (handler, captures) or None if no filter matches
+        """
+        return self.__match(self.root, topic.split('/'), 0, [])
+
+    def __match(self, node, segments, position, captures):
+        if position == len(segments):
+            handler = node.get(HANDLER)
+            if handler is None:
+                return None
+            return handler, captures
+
+        segment = segments[position]
+        child = node.get(segment)
+        if child is not None:
+            found = self.__match(child, segments, position + 1, captures)
+            if found is not None:
+                return found
+
+        child = node.get('+')
+        if child is not None:
+            found = self.__match(child, segments, position + 1, captures + [segment])
+            if found is not None:
+                return found
+
+        child = node.get('#')
+        if child is not None and HANDLER in child:
+            return child[HANDLER], captures + ['/'.join(segments[position:])]
+        return None
+
+    def dispatch(self, topic, payload, tracer=None, received=None):
+        """
+        Decode the JSON payload (unless the handler is raw) and call the handler bound to the topic.
+        Returns False without decoding if no handler wants the topic or the payload is empty.
+        With a tracer, the stages are recorded from the monotonic time the message was received.
+        """
+        found = self.match(topic)
+        if found is None or not len(payload):
+            return False
+        handler, captures = found
+        if tracer is None:
+            handler(*captures, payload if handler in self.raw else json.loads(payload))
+            return True
+
+        routed = time.monotonic()
+        decoded_payload = payload if handler in self.raw else json.loads(payload)
+        decoded = time.monotonic()
+        handler(*captures, decoded_payload)
+        tracer.message(self.kinds.get(handler), received, routed, decoded, time.monotonic())
+        return True
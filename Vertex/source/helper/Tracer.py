@@ -0,0 +1,211 @@
+"""
+Per-stage latency histograms of the MQTT to BACnet and BACnet to MQTT pipelines
+"""
+import bisect
+import json
+import threading
+import time
+from contextlib import nullcontext
+
+# Message kinds
+LIGHT = "light"
+GROUP_FEEDBACK = "group_feedback"
+SENSOR = "sensor"
+BUTTON = "button"
+GROUP_COMMAND = "group_command"
+LIGHT_COMMAND = "light_command"
+TO_BACNET = (LIGHT, GROUP_FEEDBACK, SENSOR, BUTTON)
+TO_VERTEX = (GROUP_COMMAND, LIGHT_COMMAND)
+
+# Stages, in pipeline order
+RECEIVE = "receive"  # packet read by paho to the topic routed in on_message
+DECODE = "decode"  # JSON decoding of the payload
+HANDLE = "handle"  # handler, registry lookup and queueing
+QUEUE = "queue"  # queued to the start of the main loop flush
+READ = "read"  # BacnetHelper.read of the command objects, request included
+WRITE = "write"  # BacnetHelper.write, request included
+REQUEST = "request"  # bntest executeobjectrequest of the read or write
+PUBLISH = "publish"  # MqttParseHelper.write of the commands
+TOTAL = "total"  # received (or alarm raised) to the end of the flush
+STAGES = (RECEIVE, DECODE, HANDLE, QUEUE, READ, WRITE, REQUEST, PUBLISH, TOTAL)
+
+# Upper bounds of the histogram buckets in ms, the last bucket holds everything above
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket holding the percentile, in ms
+        """
+        rank = fraction * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if position == len(BUCKETS_MS):
+                    return round(self.max, 3)
+                return round(min(BUCKETS_MS[position], self.max), 3)
+        return round(self.max, 3)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else 0,
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99),
+            "max": round(self.max, 3),
+        }
+
+
+class Stage:
+    """
+    Times a block of the main loop for the kinds of the batch being flushed
+    """
+
+    def __init__(self, tracer, kinds, stage):
+        self.tracer = tracer
+        self.kinds = kinds
+        self.stage = stage
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.monotonic() - self.started
+        for kind in self.kinds:
+            self.tracer.record(kind, self.stage, elapsed)
+        return False
+
+
+class Tracer:
+    """
+    Stage timings kept in fixed-size histograms per message kind and stage.
+    While disabled the producers only test the enabled flag and the main loop gets shared no-op stages.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # {(kind, stage): Histogram}, at most len(TO_BACNET + TO_VERTEX) * len(STAGES)
+        self.histograms = dict()
+        # Kinds queued since the last flush, {kind: [first received, first queued]}
+        self.pending = dict()
+        # Kinds of the batch being flushed by the main loop
+        self.batch = None
+        self.started = time.monotonic()
+
+    def record(self, kind, stage, seconds):
+        with self.lock:
+            self.__add(kind, stage, seconds)
+
+    def __add(self, kind, stage, seconds):
+        histogram = self.histograms.get((kind, stage))
+        if histogram is None:
+            histogram = self.histograms[(kind, stage)] = Histogram()
+        histogram.add(seconds * 1000)
+
+    def message(self, kind, received, routed, decoded, handled):
+        """
+        Record the receiving stages of a routed MQTT message, monotonic timestamps
+        """
+        if kind is None:
+            return
+        with self.lock:
+            self.__add(kind, RECEIVE, routed - received)
+            self.__add(kind, DECODE, decoded - routed)
+            self.__add(kind, HANDLE, handled - decoded)
+            if kind not in self.pending:
+                self.pending[kind] = [received, handled]
+
+    def queued(self, kind, received, queued=None):
+        """
+        Mark a kind as waiting for the next flush
+        """
+        with self.lock:
+            if kind not in self.pending:
+                self.pending[kind] = [received, received if queued is None else queued]
+
+    def begin(self):
+        """
+        Start a flush, the queued kinds become the batch timed by stage() and end()
+        """
+        if not self.enabled:
+            self.batch = None
+            if len(self.pending):
+                # Queued just before tracing was turned off
+                with self.lock:
+                    self.pending = dict()
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.batch, self.pending = self.pending, dict()
+            for kind, (received, queued) in self.batch.items():
+                self.__add(kind, QUEUE, now - queued)
+
+    def stage(self, direction, stage):
+        """
+        Context manager timing a stage of the batch for the kinds of a direction (TO_BACNET or TO_VERTEX)
+        """
+        if not self.batch:
+            return nullcontext()
+        kinds = [kind for kind in direction if kind in self.batch]
+        if not len(kinds):
+            return nullcontext()
+        return Stage(self, kinds, stage)
+
+    def end(self):
+        if not self.batch:
+            return
+        now = time.monotonic()
+        with self.lock:
+            for kind, (received, queued) in self.batch.items():
+                self.__add(kind, TOTAL, now - received)
+        self.batch = None
+
+    def reset(self):
+        with self.lock:
+            self.histograms = dict()
+            self.started = time.monotonic()
+
+    def snapshot(self, buckets=False):
+        """
+        Summaries in ms, {kind: {stage: {count, mean, p50, p90, p99, max}}}, with the bucket counts if asked
+        """
+        with self.lock:
+            histograms = list(self.histograms.items())
+        kinds = dict()
+        for (kind, stage), histogram in sorted(histograms, key=lambda item: (item[0][0], STAGES.index(item[0][1]))):
+            summary = histogram.summary()
+            if buckets:
+                summary["buckets"] = list(histogram.counts)
+            kinds.setdefault(kind, dict())[stage] = summary
+        return {
+            "seconds": round(time.monotonic() - self.started),
+            "buckets_ms": list(BUCKETS_MS) if buckets else None,
+            "kinds": kinds,
+        }
+
+    def dump(self, path):
+        """
+        Write the histograms with their buckets to a JSON file
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(buckets=True), f, indent=2)
@@ -2,6 +2,19 @@
 Main storage of setting and data to vertex gateway
 """
 from .LicenseManagerDecrypt import LicenseManagerDecrypt
+from .InstanceAllocator import InstanceAllocator
+
+INDEX_ATTRIBUTES = ("vertex_by_id", "device_by_id", "group_by_id", "point_by_instance", "reference_by_id",
+                    "allocators", "retired", "retired_by_slot")
+# BACnet instances of the vertex (one digit) and of the points of a type in a vertex (three digits)
+VERTEX_INSTANCES = 10
+POINT_INSTANCES = 1000
+GROUP_TYPE = 1
+# Point types of a Vertex device type, in the order they are filled: 4 LED luminaries, 3 emergency luminaries,
+# 128 Dali-2 devices (continued in type 3 once type 2 is full)
+POINT_TYPES = {4: (0,), 3: (4,), 128: (2, 3)}
+# Dali-2 devices keep 10 instances for their buttons and sensors
+POINT_STRIDE = {2: 10, 3: 10}
 
 
 class Gateway:
@@ -17,6 +30,128 @@ class Gateway:
         self.serial_number = serial_number
         self.vertex = []
         self.logger = logger
+        self.rebuildIndex()
+
+    def __getstate__(self):
+        # Indexes are derived data, they are rebuilt after unpickling. The logger is attached by the owner.
+        state = self.__dict__.copy()
+        for name in INDEX_ATTRIBUTES:
+            state.pop(name, None)
+        state["logger"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rebuildIndex()
+
+    def rebuildIndex(self):
+        # Kept across rebuilds, the StateStore saves them for a restart
+        retired = self.__dict__.get("retired", {})
+        self.vertex_by_id = {}
+        self.device_by_id = {}
+        self.group_by_id = {}
+        self.point_by_instance = {}
+        self.reference_by_id = {}
+        # Free instances, {None: vertex instances, (vertex instance, point type): point instances}
+        self.allocators = {}
+        # Removed points whose instance is held for them, {(vertex id, point id): (vertex instance, point type,
+        # instance)}, and the other way round. A point discovered again gets its instance back.
+        self.retired = {}
+        self.retired_by_slot = {}
+        for i in self.vertex:
+            self.indexVertex(i)
+        for key, slot in retired.items():
+            self.retire(key, slot)
+
+    def allocator(self, vertex_instance=None, point_type=None):
+        """
+        Allocator of the vertex instances or of the point instances of a type in a vertex
+        """
+        key = None if vertex_instance is None else (vertex_instance, point_type)
+        allocator = self.allocators.get(key)
+        if allocator is None:
+            if key is None:
+                allocator = InstanceAllocator(VERTEX_INSTANCES)
+            else:
+                allocator = InstanceAllocator(POINT_INSTANCES, POINT_STRIDE.get(point_type, 1))
+            self.allocators[key] = allocator
+        return allocator
+
+    def indexVertex(self, vertex):
+        self.vertex_by_id.setdefault(vertex.id, vertex)
+        if vertex.bacnet_instance is not None:
+            self.allocator().reserve(vertex.bacnet_instance)
+        duplicates = [(self.indexDevice, i) for i in vertex.devices if not self.indexDevice(vertex, i)]
+        duplicates += [(self.indexGroup, i) for i in vertex.groups if not self.indexGroup(vertex, i)]
+        # Moved once every saved instance is taken, so they do not take the instance of a point indexed later
+        for index, point in duplicates:
+            if self.movePoint(vertex, point):
+                index(vertex, point)
+
+    def indexDevice(self, vertex, device):
+        """
+        Returns False if the device has the instance of another point, see movePoint
+        """
+        reserved = True
+        self.device_by_id.setdefault((vertex.id, device.id), device)
+        if vertex.bacnet_instance is not None and device.bacnet_instance is not None:
+            reserved = self.reservePoint(vertex, device)
+        # First match wins, same as the previous linear scan
+        self.point_by_instance.setdefault((False, vertex.bacnet_instance, device.bacnet_instance),
+                                          [vertex.id, device.id])
+        if device.bacnet_instance is not None:
+            self.reference_by_id[(vertex.id, device.id)] = \
+                f'AV3{device.dev_type}0{vertex.bacnet_instance}{device.bacnet_instance:03}'
+        return reserved
+
+    def indexGroup(self, vertex, group):
+        reserved = True
+        self.group_by_id.setdefault(group.id, (vertex, group))
+        if vertex.bacnet_instance is not None and group.bacnet_instance is not None:
+            reserved = self.reservePoint(vertex, group)
+        self.point_by_instance.setdefault((True, vertex.bacnet_instance, group.bacnet_instance),
+                                          [vertex.id, group.id])
+        if group.bacnet_instance is not None:
+            self.reference_by_id[(vertex.id, group.id)] = \
+                f'AV3{group.dev_type}0{vertex.bacnet_instance}{group.bacnet_instance:03}'
+        return reserved
+
+    def reservePoint(self, vertex, point):
+        """
+        Take the instance of a device or group, False if another point has it
+        """
+        if not self.allocator(vertex.bacnet_instance, point.dev_type).reserve(point.bacnet_instance):
+            return False
+        self.unretire((vertex.bacnet_instance, point.dev_type, point.bacnet_instance))
+        return True
+
+    def movePoint(self, vertex, point):
+        """
+        Give a free instance to a point loaded with the instance of another one (ex: from a state saved by an older
+        version), two points must not share a BACnet object. The point is indexed again by the caller.
+        Returns False if no instance is free.
+        """
+        instance = self.allocator(vertex.bacnet_instance, point.dev_type).peek()
+        if instance is None:
+            self.logger.error(f"Point {point.id} of Vertex {vertex.id} shares the BACnet instance "
+                              f"{point.bacnet_instance} of another point, no free instance left")
+            return False
+        self.logger.error(f"Point {point.id} of Vertex {vertex.id} had the BACnet instance "
+                          f"{point.bacnet_instance} of another point, moved to {instance}")
+        point.bacnet_instance = instance
+        return True
+
+    def setConfiguration(self, _license, vertex_ip, max_vertex=10, max_points=1000, use_tags=False,
+                         serial_number=""):
+        """
+        Settings of a gateway created before the settings file was read, ex: to load the registry meanwhile
+        """
+        self.license = _license
+        self.vertex_ip = vertex_ip
+        self.max_vertex = max_vertex
+        self.max_points = max_points
+        self.use_tags = use_tags
+        self.serial_number = serial_number
 
     def licenseIsValid(self):
         license_feedback = LicenseManagerDecrypt(self.license, self.logger)
@@ -45,106 +180,160 @@ class Gateway:
 
     def addVertex(self, vertex):
         self.vertex.append(vertex)
+        self.indexVertex(vertex)
+
+    def addDevice(self, vertex, device):
+        vertex.addDevice(device)
+        if not self.indexDevice(vertex, device) and self.movePoint(vertex, device):
+            self.indexDevice(vertex, device)
+
+    def addGroup(self, vertex, group):
+        vertex.addGroup(group)
+        if not self.indexGroup(vertex, group) and self.movePoint(vertex, group):
+            self.indexGroup(vertex, group)
+
+    def removeDevices(self, vertex, ids):
+        """
+        Remove the devices of a vertex whose UID is in ids, in one pass. Returns the BACnet references
+        of their points, buttons and sensors of Dali-2 devices included.
+        """
+        references = []
+        kept = []
+        for device in vertex.devices:
+            if device.id in ids:
+                references.extend(self.unindexDevice(vertex, device))
+            else:
+                kept.append(device)
+        vertex.devices = kept
+        return references
+
+    def removeGroups(self, vertex, ids):
+        """
+        Remove the groups of a vertex whose UID is in ids, in one pass. Returns the BACnet references of their points.
+        """
+        references = []
+        kept = []
+        for group in vertex.groups:
+            if group.id in ids:
+                references.extend(self.unindexGroup(vertex, group))
+            else:
+                kept.append(group)
+        vertex.groups = kept
+        return references
+
+    def unindexDevice(self, vertex, device):
+        if self.device_by_id.get((vertex.id, device.id)) is device:
+            del self.device_by_id[(vertex.id, device.id)]
+        key = (False, vertex.bacnet_instance, device.bacnet_instance)
+        if self.point_by_instance.get(key) == [vertex.id, device.id]:
+            del self.point_by_instance[key]
+        if self.reference_by_id.pop((vertex.id, device.id), None) is None:
+            return []
+        self.allocator(vertex.bacnet_instance, device.dev_type).release(device.bacnet_instance, hold=True)
+        self.retire((vertex.id, device.id), (vertex.bacnet_instance, device.dev_type, device.bacnet_instance))
+        return [f'AV3{device.dev_type}0{vertex.bacnet_instance}{device.bacnet_instance + offset:03}'
+                for offset in range(POINT_STRIDE.get(device.dev_type, 1))]
+
+    def unindexGroup(self, vertex, group):
+        entry = self.group_by_id.get(group.id)
+        if entry is not None and entry[1] is group:
+            del self.group_by_id[group.id]
+        key = (True, vertex.bacnet_instance, group.bacnet_instance)
+        if self.point_by_instance.get(key) == [vertex.id, group.id]:
+            del self.point_by_instance[key]
+        reference = self.reference_by_id.pop((vertex.id, group.id), None)
+        if reference is None:
+            return []
+        self.allocator(vertex.bacnet_instance, group.dev_type).release(group.bacnet_instance, hold=True)
+        self.retire((vertex.id, group.id), (vertex.bacnet_instance, group.dev_type, group.bacnet_instance))
+        return [reference]
+
+    def retire(self, key, slot):
+        """
+        Hold the instance of a removed point (vertex id, point id) at slot (vertex instance, point type, instance)
+        """
+        vertex_instance, point_type, instance = slot
+        if not self.allocator(vertex_instance, point_type).hold(instance):
+            return
+        self.unretire(slot)
+        self.retired[key] = slot
+        self.retired_by_slot[slot] = key
+
+    def unretire(self, slot):
+        # The instance is taken, by the removed point again or by a new one once no other was free
+        key = self.retired_by_slot.pop(slot, None)
+        if key is not None:
+            del self.retired[key]
+
+    def retiredSlot(self, id_vertex, id_point, point_types):
+        """
+        Point type and instance held for a removed point of one of point_types, None if there is none
+        """
+        slot = self.retired.get((id_vertex, id_point))
+        if slot is None or slot[1] not in point_types:
+            return None
+        return slot[1], slot[2]
 
     def getVertex(self, _id):
-        for i in self.vertex:
-            if _id == i.id:
-                return i
-        return None
+        return self.vertex_by_id.get(_id)
 
     def getFreeVertexInstance(self):
-        # 0-9
-        select = 0
-        for i in self.vertex:
-            if select == i.bacnet_instance:
-                select += 1
-                continue
-        if select > 9:
-            select = None
-        return select
+        # 0-9, lowest free one, None if all are used
+        return self.allocator().peek()
+
+    def getFreeDeviceSlot(self, id_vertex, dev_type, id_device=None):
+        """
+        Point type and lowest free instance for a new device of a Vertex device type (4, 3 or 128),
+        the instance is taken when the device is added. None if the vertex has no free instance left.
+        A device removed before gets its instance back.
+        """
+        vertex = self.getVertex(id_vertex)
+        if vertex is None or vertex.bacnet_instance is None:
+            return None
+        slot = self.retiredSlot(id_vertex, id_device, POINT_TYPES.get(dev_type, ()))
+        if slot is not None:
+            return slot
+        for point_type in POINT_TYPES.get(dev_type, ()):
+            instance = self.allocator(vertex.bacnet_instance, point_type).peek()
+            if instance is not None:
+                return point_type, instance
+        return None
 
     def getFreeDeviceInstance(self, id_vertex, dev_type):
-        vertex_pos = None
-        if dev_type == 4:  # Light
-            for i in self.vertex:
-                if id_vertex == i.id:
-                    vertex_pos = self.vertex.index(i)
-                    break
-            select = 0
-            for i in self.vertex[vertex_pos].devices:
-                if select == i.bacnet_instance and not (i.dev_type == 2 or i.dev_type == 3 or i.dev_type == 4):
-                    select += 1
-            if select > 999:
-                select = None
-        if dev_type == 3:  # Emergency light
-            for i in self.vertex:
-                if id_vertex == i.id:
-                    vertex_pos = self.vertex.index(i)
-                    break
-            select = 0
-            for i in self.vertex[vertex_pos].devices:
-                if select == i.bacnet_instance and not (i.dev_type == 2 or i.dev_type == 3 or i.dev_type == 0):
-                    select += 1
-            if select > 999:
-                select = None
-        if dev_type == 128:  # Dali2 devices
-            for i in self.vertex:
-                if id_vertex == i.id:
-                    vertex_pos = self.vertex.index(i)
-                    break
-            select = 0
-            dev = None
-            for i in self.vertex[vertex_pos].devices:
-                if select == i.bacnet_instance and not (i.dev_type == 0 or i.dev_type == 4):
-                    select += 10
-                    dev = i
-            if select > 999:
-                if dev.dev_type >= 2 and dev.dev_type <= 3:
-                    dev.dev_type += 1
-                    select -= 1000
-                else:
-                    select = None
-        return select
-
-    def getFreeGroupInstance(self, id_vertex):
-        vertex_pos = None
-        for i in self.vertex:
-            if id_vertex == i.id:
-                vertex_pos = self.vertex.index(i)
-                break
-        select = 0
-        for i in self.vertex[vertex_pos].groups:
-            if select == i.bacnet_instance:
-                select += 1
-                continue
-        if select > 999:
-            select = None
-        return select
+        slot = self.getFreeDeviceSlot(id_vertex, dev_type)
+        if slot is None:
+            return None
+        return slot[1]
+
+    def getFreeGroupInstance(self, id_vertex, id_group=None):
+        vertex = self.getVertex(id_vertex)
+        if vertex is None or vertex.bacnet_instance is None:
+            return None
+        slot = self.retiredSlot(id_vertex, id_group, (GROUP_TYPE,))
+        if slot is not None:
+            return slot[1]
+        return self.allocator(vertex.bacnet_instance, GROUP_TYPE).peek()
 
     def getDevice(self, id_vertex, id_device):
-        vertex_pos = None
-        for i in self.vertex:
-            if id_vertex == i.id:
-                vertex_pos = self.vertex.index(i)
-                break
-        for i in self.vertex[vertex_pos].devices:
-            if id_device == i.id:
-                return i
-        return None
+        return self.device_by_id.get((id_vertex, id_device))
 
     def getGroup(self, id_group):
-        for i in self.vertex:
-            for j in i.groups:
-                if id_group == j.id:
-                    return j
-        return None
+        entry = self.group_by_id.get(id_group)
+        if entry is None:
+            return None
+        return entry[1]
 
     def getVertexFromGroup(self, id_group):
-        for i in self.vertex:
-            for j in i.groups:
-                if id_group == j.id:
-                    return i
-        return None
+        entry = self.group_by_id.get(id_group)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def getReference(self, id_vertex, id_point):
+        """
+        Precomputed BACnet object reference (AV3...) of a device or group
+        """
+        return self.reference_by_id.get((id_vertex, id_point))
 
     def bacnetPointsExistChecker(self, bacnet):
         for i in self.vertex:
@@ -154,46 +343,19 @@ class Gateway:
                     j.bacnet_point_exist = True
 
     def getIdFromInstanceDev(self, vertex_instance, point_instance):
-        _id = []
-        for i in self.vertex:
-            if i.bacnet_instance == int(vertex_instance):
-                for j in i.devices:
-                    if j.bacnet_instance == int(point_instance):
-                        _id.append(i.id)
-                        _id.append(j.id)
-                        return _id
-        return None
+        return self.getIdFromKey((False, int(vertex_instance), int(point_instance)))
 
     def getIdFromInstanceGroup(self, vertex_instance, point_instance):
-        _id = []
-        for i in self.vertex:
-            if i.bacnet_instance == int(vertex_instance):
-                for j in i.groups:
-                    if j.bacnet_instance == int(point_instance):
-                        _id.append(i.id)
-                        _id.append(j.id)
-                        return _id
-        return None
+        return self.getIdFromKey((True, int(vertex_instance), int(point_instance)))
 
     def getIdFromInstance(self, instance):
-        _id = []
-        if int(instance[3]) == 1:
-            for i in self.vertex:
-                if i.bacnet_instance == int(instance[5]):
-                    for j in i.groups:
-                        if j.bacnet_instance == int(instance[6:]):
-                            _id.append(i.id)
-                            _id.append(j.id)
-                            return _id
-        else:
-            for i in self.vertex:
-                if i.bacnet_instance == int(instance[5]):
-                    for j in i.devices:
-                        if j.bacnet_instance == int(instance[6:]):
-                            _id.append(i.id)
-                            _id.append(j.id)
-                            return _id
-        return None
+        return self.getIdFromKey((int(instance[3]) == 1, int(instance[5]), int(instance[6:])))
+
+    def getIdFromKey(self, key):
+        _id = self.point_by_instance.get(key)
+        if _id is None:
+            return None
+        return list(_id)
 
     def clearStatus(self):
         for i in self.vertex:
@@ -204,32 +366,26 @@ class Gateway:
                 j.setStatus(False)
 
     def reconfigureStatus(self):
-        vertex_to_delete = []
-        for i in self.vertex:
-            if not i.getStatus():
-                vertex_to_delete.append(i)
-
-        vertex = [x for x in self.vertex if x not in vertex_to_delete]
-        self.vertex = vertex
-
-        devices_to_delete = []
-        groups_to_delete = []
+        """
+        Remove the vertex, devices and groups whose status is not set, in one pass over the registry.
+        The devices (groups) of a vertex are all kept if none of them has the status set.
+        """
+        self.vertex = [i for i in self.vertex if i.getStatus()]
+        removed = []
         for i in self.vertex:
-            for j in i.devices:
-                if not j.getStatus():
-                    devices_to_delete.append(j)
-            if (not (len(i.devices) == len(devices_to_delete))) and (i.getStatus()):
-                devices = [x for x in i.devices if x not in devices_to_delete]
+            devices = [j for j in i.devices if j.getStatus()]
+            if len(devices):
+                removed.extend((i, j) for j in i.devices if not j.getStatus())
                 i.devices = devices
-            devices_to_delete = []
-
-            for j in i.groups:
-                if not j.getStatus():
-                    groups_to_delete.append(j)
-            if (not (len(i.groups) == len(groups_to_delete))) and (i.getStatus()):
-                groups = [x for x in i.groups if x not in groups_to_delete]
+            groups = [j for j in i.groups if j.getStatus()]
+            if len(groups):
+                removed.extend((i, j) for j in i.groups if not j.getStatus())
                 i.groups = groups
-            groups_to_delete = []
+
+        self.rebuildIndex()
+        for i, j in removed:
+            if i.bacnet_instance is not None and j.bacnet_instance is not None:
+                self.retire((i.id, j.id), (i.bacnet_instance, j.dev_type, j.bacnet_instance))
 
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
 """
 
 """
+from .Slotted import Slotted
 
 
-class Group:
+class Group(Slotted):
+    __slots__ = ("id", "bacnet_instance", "status", "bacnet_point_exist", "dev_type")
+    DEFAULTS = {"status": False, "bacnet_point_exist": False}
 
     def __init__(self, _id, bacnet_instance, dev_type=None):
         self.id = _id
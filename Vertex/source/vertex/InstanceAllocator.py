@@ -0,0 +1,91 @@
+"""
+Free BACnet instances of one range (vertex, or point type of a vertex), lowest free instance first
+"""
+import heapq
+
+
+class InstanceAllocator:
+
+    def __init__(self, size, stride=1):
+        """
+        :param size: Number of instances of the range, instances are 0 to size - 1
+        :param stride: Distance between two allocated instances, ex: 10 for Dali-2 devices with buttons
+        """
+        self.size = size
+        self.stride = stride
+        # Min-heap of free instances, entries of reserved instances are dropped when they reach the top
+        self.free = list(range(0, size, stride))
+        self.queued = set(self.free)
+        self.used = set()
+        # Instances of removed points, {instance: None} oldest first. Given out only once no other instance is
+        # free, so the BACnet object of a removed point is not taken over by a new point while there is room.
+        self.held = dict()
+
+    def __len__(self):
+        """
+        Number of free instances, held ones included
+        """
+        return len(self.free) - len(self.queued & (self.used | self.held.keys())) + len(self.held)
+
+    def __contains__(self, instance):
+        return instance in self.used
+
+    def peek(self):
+        """
+        Lowest free instance without taking it, the oldest held one if no other is free, None if the range is full
+        """
+        while len(self.free) and (self.free[0] in self.used or self.free[0] in self.held):
+            self.queued.discard(heapq.heappop(self.free))
+        if len(self.free):
+            return self.free[0]
+        for instance in self.held:
+            return instance
+        return None
+
+    def allocate(self):
+        """
+        Take the lowest free instance, the oldest held one if no other is free, None if the range is full
+        """
+        instance = self.peek()
+        if instance is None:
+            return None
+        if instance in self.held:
+            del self.held[instance]
+        else:
+            self.queued.discard(heapq.heappop(self.free))
+        self.used.add(instance)
+        return instance
+
+    def reserve(self, instance):
+        """
+        Mark an instance as taken, ex: when loading saved devices. Returns False if it was already taken.
+        """
+        if instance in self.used:
+            return False
+        self.held.pop(instance, None)
+        self.used.add(instance)
+        return True
+
+    def hold(self, instance):
+        """
+        Keep a free instance for the point that had it, see held. Returns False if the instance is taken.
+        """
+        if instance in self.used:
+            return False
+        self.held[instance] = None
+        return True
+
+    def release(self, instance, hold=False):
+        """
+        Give an instance back, it is the first one reused if it is the lowest free one.
+        With hold it is only reused once no other instance is free.
+        """
+        if instance not in self.used:
+            return
+        self.used.discard(instance)
+        if hold:
+            self.hold(instance)
+            return
+        if instance not in self.queued:
+            heapq.heappush(self.free, instance)
+            self.queued.add(instance)
@@ -0,0 +1,25 @@
+"""
+Base of the registry objects kept by the thousands (vertex, devices, groups)
+
+Attributes are stored in __slots__ instead of a per-instance dict.
+"""
+import copy
+
+
+class Slotted:
+    __slots__ = ()
+    # Value of the attributes missing from an older pickle
+    DEFAULTS = {}
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        # Pickles written before __slots__ hold the instance __dict__, attributes dropped since are ignored
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+        for name in self.__slots__:
+            if name in state:
+                setattr(self, name, state[name])
+            else:
+                setattr(self, name, copy.copy(self.DEFAULTS.get(name)))
@@ -0,0 +1,337 @@
+"""
+Versioned on-disk storage of the gateway registry (vertex, devices, groups and their BACnet instances,
+instances held for removed points included)
+
+A snapshot file holds the compacted state, an append-only journal holds the changes saved since.
+The identity file caches what does not change between restarts of a controller (model, serial, settings object).
+"""
+import json
+import os
+import pickle
+from pathlib import Path
+
+from .Vertex import Vertex
+from .Device import Device
+from .Group import Group
+
+STATE_VERSION = 1
+# Journal entries written before the state is compacted into a new snapshot
+JOURNAL_COMPACT_SIZE = 500
+
+
+class _Discarded:
+    """
+    Stands in for objects of an old pickle that are not imported (ex: the logger)
+    """
+
+    def __setstate__(self, state):
+        pass
+
+
+class _PickleImporter(pickle.Unpickler):
+    """
+    Loads gateway.pickle files written by earlier versions, whatever package path the classes were pickled from
+    """
+
+    def find_class(self, module, name):
+        if module.endswith("vertex.Gateway") and name == "Gateway":
+            from .Gateway import Gateway
+            return Gateway
+        if module.endswith("vertex.Vertex") and name == "Vertex":
+            return Vertex
+        if module.endswith("vertex.Device") and name == "Device":
+            return Device
+        if module.endswith("vertex.Group") and name == "Group":
+            return Group
+        if name == "Logger":
+            return _Discarded
+        return super().find_class(module, name)
+
+
+class StateStore:
+
+    def __init__(self, path, logger):
+        """
+        :param path: Path of the store without extension, ex: config/gateway
+        :param logger: PDS.Log.Logger
+        """
+        self.state_path = Path(f"{path}.state")
+        self.journal_path = Path(f"{path}.journal")
+        self.pickle_path = Path(f"{path}.pickle")
+        self.identity_path = Path(f"{path}.identity")
+        self.logger = logger
+        self.saved = None
+        self.journal_entries = 0
+
+    def load(self, gateway):
+        """
+        Fill the gateway registry from the store, importing an old gateway.pickle once if there is no store yet.
+        Returns False if there was nothing to load.
+        """
+        if not self.state_path.is_file() and self.pickle_path.is_file():
+            self.importPickle(gateway)
+            return True
+
+        state = self.__read_snapshot()
+        if state is None and not self.journal_path.is_file():
+            return False
+        if state is None:
+            state = {"version": STATE_VERSION, "vertex": {}}
+
+        self.journal_entries = self.__replay_journal(state)
+        for vertex_id, vertex_state in state["vertex"].items():
+            vertex = Vertex(vertex_id, vertex_state["bacnet_instance"], vertex_state["type"])
+            # Indexed with all its points, a point with the instance of another one is moved after them
+            for device_id, (bacnet_instance, dev_type) in vertex_state["devices"].items():
+                vertex.addDevice(Device(device_id, bacnet_instance, dev_type))
+            for group_id, (bacnet_instance, dev_type) in vertex_state["groups"].items():
+                vertex.addGroup(Group(group_id, bacnet_instance, dev_type))
+            # Held again, a new point must not take over the BACnet object of a removed one after a restart
+            if vertex.bacnet_instance is not None:
+                for point_id, (point_type, bacnet_instance) in vertex_state["retired"].items():
+                    gateway.retire((vertex_id, point_id), (vertex.bacnet_instance, point_type, bacnet_instance))
+            gateway.addVertex(vertex)
+
+        # What is on disk, points the gateway had to renumber (ex: duplicate instances) are saved with the next save
+        self.saved = self.__flatten_state(state)
+        if self.journal_entries > JOURNAL_COMPACT_SIZE:
+            self.compact(gateway)
+        return True
+
+    def loadIdentity(self):
+        """
+        Cached identity of the controller, empty if there is none or it cannot be read
+        """
+        if not self.identity_path.is_file():
+            return {}
+        try:
+            with open(self.identity_path, encoding='utf-8') as handle:
+                identity = json.load(handle)
+        except ValueError:
+            self.logger.warn("Gateway identity cache is damaged, ignoring it")
+            return {}
+        if not isinstance(identity, dict):
+            return {}
+        return identity
+
+    def saveIdentity(self, identity):
+        temp_path = self.identity_path.with_name(self.identity_path.name + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as handle:
+            json.dump(identity, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, self.identity_path)
+
+    def importPickle(self, gateway):
+        """
+        Copy the registry of an old gateway.pickle, keeping the BACnet instance of every point
+        """
+        with open(self.pickle_path, 'rb') as handle:
+            old_gateway = _PickleImporter(handle).load()
+
+        for old_vertex in old_gateway.vertex:
+            vertex = Vertex(old_vertex.id, old_vertex.bacnet_instance, old_vertex.type)
+            for device in old_vertex.devices:
+                vertex.addDevice(Device(device.id, device.bacnet_instance, device.dev_type))
+            for group in old_vertex.groups:
+                vertex.addGroup(Group(group.id, group.bacnet_instance, group.dev_type))
+            gateway.addVertex(vertex)
+
+        self.compact(gateway)
+        self.pickle_path.replace(self.pickle_path.with_name(self.pickle_path.name + ".imported"))
+        self.logger.message(f"Imported {gateway.quantityDevices()} devices and {gateway.quantityGroups()} groups "
+                            f"from {self.pickle_path.name}")
+
+    def save(self, gateway):
+        """
+        Append the changes since the last save to the journal, returns the number of changes
+        """
+        if self.saved is None:
+            self.compact(gateway)
+            return 1
+
+        current = self.__flatten(gateway)
+        changes = self.__diff(self.saved, current)
+        if not len(changes):
+            return 0
+
+        with open(self.journal_path, 'a', encoding='utf-8') as handle:
+            for change in changes:
+                handle.write(json.dumps(change) + "\n")
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        self.saved = current
+        self.journal_entries += len(changes)
+        if self.journal_entries > JOURNAL_COMPACT_SIZE:
+            self.compact(gateway)
+        return len(changes)
+
+    def compact(self, gateway):
+        """
+        Write the whole registry as a new snapshot and start an empty journal
+        """
+        state = {"version": STATE_VERSION, "vertex": []}
+        retired = self.__flatten(gateway)[2]
+        for vertex in gateway.vertex:
+            state["vertex"].append({
+                "id": vertex.id,
+                "bacnet_instance": vertex.bacnet_instance,
+                "type": vertex.type,
+                "devices": [[i.id, i.bacnet_instance, i.dev_type] for i in vertex.devices],
+                "groups": [[i.id, i.bacnet_instance, i.dev_type] for i in vertex.groups],
+                "retired": [[key[1], point_type, bacnet_instance]
+                            for key, (point_type, bacnet_instance) in retired.items() if key[0] == vertex.id],
+            })
+
+        temp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        with open(temp_path, 'w', encoding='utf-8') as handle:
+            json.dump(state, handle, separators=(',', ':'))
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, self.state_path)
+
+        # The snapshot already holds every journal entry
+        with open(self.journal_path, 'w', encoding='utf-8'):
+            pass
+
+        self.saved = self.__flatten(gateway)
+        self.journal_entries = 0
+
+    def __read_snapshot(self):
+        if not self.state_path.is_file():
+            return None
+        with open(self.state_path, encoding='utf-8') as handle:
+            snapshot = json.load(handle)
+        if snapshot.get("version") != STATE_VERSION:
+            raise Exception(f"Unsupported gateway state version {snapshot.get('version')}")
+
+        state = {"version": STATE_VERSION, "vertex": {}}
+        for vertex in snapshot["vertex"]:
+            state["vertex"][vertex["id"]] = {
+                "bacnet_instance": vertex["bacnet_instance"],
+                "type": vertex["type"],
+                "devices": {i[0]: [i[1], i[2]] for i in vertex["devices"]},
+                "groups": {i[0]: [i[1], i[2]] for i in vertex["groups"]},
+                # Snapshots written before removed points were held have none
+                "retired": {i[0]: [i[1], i[2]] for i in vertex.get("retired", [])},
+            }
+        return state
+
+    def __replay_journal(self, state):
+        if not self.journal_path.is_file():
+            return 0
+        entries = 0
+        with open(self.journal_path, encoding='utf-8') as handle:
+            for line in handle:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    # Line cut by a power loss while appending, the following changes were never confirmed
+                    self.logger.warn("Gateway journal ends with an incomplete entry")
+                    break
+                self.__apply(state, change)
+                entries += 1
+        return entries
+
+    @staticmethod
+    def __apply(state, change):
+        op = change["op"]
+        if op == "add_vertex":
+            state["vertex"][change["id"]] = {
+                "bacnet_instance": change["bacnet_instance"],
+                "type": change["type"],
+                "devices": {},
+                "groups": {},
+                "retired": {},
+            }
+        elif op == "remove_vertex":
+            state["vertex"].pop(change["id"], None)
+        elif op in ("add_device", "renumber_device"):
+            state["vertex"][change["vertex"]]["devices"][change["id"]] = [change["bacnet_instance"],
+                                                                          change["dev_type"]]
+        elif op == "remove_device":
+            state["vertex"][change["vertex"]]["devices"].pop(change["id"], None)
+        elif op in ("add_group", "renumber_group"):
+            state["vertex"][change["vertex"]]["groups"][change["id"]] = [change["bacnet_instance"],
+                                                                         change["dev_type"]]
+        elif op == "remove_group":
+            state["vertex"][change["vertex"]]["groups"].pop(change["id"], None)
+        elif op == "retire_point":
+            state["vertex"][change["vertex"]]["retired"][change["id"]] = [change["point_type"],
+                                                                          change["bacnet_instance"]]
+        elif op == "unretire_point":
+            state["vertex"][change["vertex"]]["retired"].pop(change["id"], None)
+
+    @staticmethod
+    def __flatten(gateway):
+        vertex = {}
+        points = {}
+        for i in gateway.vertex:
+            vertex[i.id] = (i.bacnet_instance, i.type)
+            for j in i.devices:
+                points[("device", i.id, j.id)] = (j.bacnet_instance, j.dev_type)
+            for j in i.groups:
+                points[("group", i.id, j.id)] = (j.bacnet_instance, j.dev_type)
+        # Instances held for removed points, {(vertex id, point id): (point type, instance)}
+        retired = {}
+        for (vertex_id, point_id), (vertex_instance, point_type, bacnet_instance) in gateway.retired.items():
+            if vertex.get(vertex_id, (None,))[0] == vertex_instance:
+                retired[(vertex_id, point_id)] = (point_type, bacnet_instance)
+        return vertex, points, retired
+
+    @staticmethod
+    def __flatten_state(state):
+        vertex = {}
+        points = {}
+        retired = {}
+        for vertex_id, vertex_state in state["vertex"].items():
+            vertex[vertex_id] = (vertex_state["bacnet_instance"], vertex_state["type"])
+            for kind in ("device", "group"):
+                for point_id, point in vertex_state[f"{kind}s"].items():
+                    points[(kind, vertex_id, point_id)] = tuple(point)
+            for point_id, point in vertex_state["retired"].items():
+                retired[(vertex_id, point_id)] = tuple(point)
+        return vertex, points, retired
+
+    @staticmethod
+    def __diff(saved, current):
+        saved_vertex, saved_points, saved_retired = saved
+        vertex, points, retired = current
+        changes = []
+
+        for vertex_id in saved_vertex:
+            if vertex_id not in vertex:
+                changes.append({"op": "remove_vertex", "id": vertex_id})
+        for key in saved_points:
+            if key not in points and key[1] in vertex:
+                changes.append({"op": f"remove_{key[0]}", "vertex": key[1], "id": key[2]})
+
+        for vertex_id, (bacnet_instance, _type) in vertex.items():
+            if saved_vertex.get(vertex_id) != (bacnet_instance, _type):
+                if vertex_id in saved_vertex:
+                    # Vertex renumbered, its points are written again under the new entry
+                    changes.append({"op": "remove_vertex", "id": vertex_id})
+                changes.append({"op": "add_vertex", "id": vertex_id, "bacnet_instance": bacnet_instance,
+                                "type": _type})
+
+        for key, (bacnet_instance, dev_type) in points.items():
+            previous = saved_points.get(key)
+            if previous == (bacnet_instance, dev_type) and saved_vertex.get(key[1]) == vertex[key[1]]:
+                continue
+            op = "add"
+            if previous is not None and saved_vertex.get(key[1]) == vertex[key[1]]:
+                op = "renumber"
+            changes.append({"op": f"{op}_{key[0]}", "vertex": key[1], "id": key[2],
+                            "bacnet_instance": bacnet_instance, "dev_type": dev_type})
+
+        for key in saved_retired:
+            if key not in retired and key[0] in vertex:
+                changes.append({"op": "unretire_point", "vertex": key[0], "id": key[1]})
+        for key, (point_type, bacnet_instance) in retired.items():
+            if saved_retired.get(key) == (point_type, bacnet_instance) and \
+                    saved_vertex.get(key[0]) == vertex[key[0]]:
+                continue
+            changes.append({"op": "retire_point", "vertex": key[0], "id": key[1], "point_type": point_type,
+                            "bacnet_instance": bacnet_instance})
+        return changes
@@ -1,9 +1,12 @@
 """
 Vertex storage of setting and data
 """
+from .Slotted import Slotted
 
 
-class Vertex:
+class Vertex(Slotted):
+    __slots__ = ("id", "bacnet_instance", "groups", "devices", "type", "status")
+    DEFAULTS = {"groups": [], "devices": [], "type": "", "status": False}
 
     def __init__(self, _id, bacnet_instance, _type=""):
         self.id = _id